@@ -17,10 +17,13 @@ setup(name='TracDulwich',
       version='0.1.0',
       license="MIT",
       long_description="",
-      packages=['trac_dulwich'],
+      packages=['trac_dulwich', 'trac_dulwich.tests'],
+      test_suite='trac_dulwich.tests.suite',
       entry_points = {'trac.plugins': 
                                 ['dulwich = trac_dulwich.dulwich_fs',
                                  'dulwich.cache = trac_dulwich.cache',
                                  'dulwich.api = trac_dulwich.api',
+                                 'dulwich.search = trac_dulwich.search',
+                                 'dulwich.archive = trac_dulwich.archive',
                                  ]},
 )
@@ -0,0 +1,153 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Line by line annotation (blame) of files.
+
+The history is walked newest first, like `git blame` does. Every commit
+that is visited holds the lines of the file that are not attributed yet,
+as line numbers in its version of the file. When a parent has the same
+blob, all lines move to that parent unchanged. Otherwise the two versions
+are diffed, and only the lines that the parent does not have are
+attributed to the commit. The walk stops as soon as all lines are
+attributed.
+
+When the annotations of an older blob are already known, the lines that
+reach that blob take their commit from those annotations, and the walk
+does not have to continue past it.
+"""
+
+from difflib import SequenceMatcher
+import heapq
+import stat
+
+import dulwich.diff_tree
+
+
+def annotate(repos, rev, path, sha, known=None):
+    """Return the commit that introduced each line of the blob `sha`, which
+    is the file `path` at `rev`.
+
+    `known` is called with a blob sha and a path and returns the annotations
+    of that blob if they are already known, or `None`.
+    """
+    path = path.strip('/').encode('utf-8')
+    dulwichrepo = repos.dulwichrepo
+    lines = _get_lines(dulwichrepo, sha)
+    result = [None] * len(lines)
+    # {commit_id: {(path, blob sha): [(line in blob, line in result)]}}
+    suspects = {rev: {(path, sha): list(enumerate(xrange(len(lines))))}}
+    blob_lines = {sha: lines}
+    remaining = len(lines)
+
+    # only the commits that hold unattributed lines are visited, newest
+    # first, so all children of a commit are done before the commit itself
+    queue = [(-dulwichrepo[rev].commit_time, rev)]
+    while queue and remaining:
+        commit = dulwichrepo[heapq.heappop(queue)[1]]
+        pending = suspects.pop(commit.id)
+        parents = [dulwichrepo[parent] for parent in commit.parents]
+        for (blob_path, blob_sha), line_map in pending.iteritems():
+            for parent in parents:
+                if not line_map:
+                    break
+                parent_path = blob_path
+                entry = repos._lookup_entry(parent.tree, blob_path)
+                if entry is None:
+                    parent_path = _find_rename_source(repos, parent, commit,
+                                                      blob_path)
+                    if parent_path is None:
+                        continue
+                    entry = repos._lookup_entry(parent.tree, parent_path)
+                if entry is None or not stat.S_ISREG(entry[0]):
+                    continue
+                parent_sha = entry[1]
+                if parent_sha == blob_sha:
+                    # unchanged, all lines move to the parent
+                    parent_map = line_map
+                    line_map = []
+                else:
+                    if blob_sha not in blob_lines:
+                        blob_lines[blob_sha] = _get_lines(dulwichrepo,
+                                                          blob_sha)
+                    if parent_sha not in blob_lines:
+                        blob_lines[parent_sha] = _get_lines(dulwichrepo,
+                                                            parent_sha)
+                    parent_map, line_map = _pass_blame(
+                        blob_lines[parent_sha], blob_lines[blob_sha],
+                        line_map)
+                if not parent_map:
+                    continue
+                annotations = known and known(parent_sha,
+                                               parent_path.decode('utf-8'))
+                if annotations is not None:
+                    for line, index in parent_map:
+                        if line < len(annotations):
+                            result[index] = annotations[line]
+                            remaining -= 1
+                    continue
+                blobs = suspects.get(parent.id)
+                if blobs is None:
+                    blobs = suspects[parent.id] = {}
+                    heapq.heappush(queue, (-parent.commit_time, parent.id))
+                blobs.setdefault((parent_path, parent_sha),
+                                 []).extend(parent_map)
+            # the lines that no parent has were introduced by this commit
+            for line, index in line_map:
+                result[index] = commit.id
+                remaining -= 1
+
+    for index, commit_id in enumerate(result):
+        if commit_id is None:
+            # should not happen, unless the history is incomplete
+            result[index] = rev
+    return result
+
+
+def _get_lines(dulwichrepo, sha):
+    return dulwichrepo[sha].as_raw_string().splitlines()
+
+
+def _pass_blame(parent_lines, lines, line_map):
+    """Split `line_map` into the lines that exist in the parent version, with
+    their line number in the parent, and the lines that do not.
+    """
+    matcher = SequenceMatcher(None, parent_lines, lines, autojunk=False)
+    offsets = {}
+    for parent_start, start, size in matcher.get_matching_blocks():
+        for i in xrange(size):
+            offsets[start + i] = parent_start + i
+    parent_map = []
+    unmatched = []
+    for line, index in line_map:
+        if line in offsets:
+            parent_map.append((offsets[line], index))
+        else:
+            unmatched.append((line, index))
+    return parent_map, unmatched
+
+
+def find_rename(repos, parent, commit, path):
+    """Return the rename or copy change that created `path` in `commit`
+    from a path in `parent`, if rename detection is enabled.
+    """
+    rename_detector = repos.get_rename_detector()
+    if rename_detector is None:
+        return None
+    for change in dulwich.diff_tree.tree_changes(
+            repos.dulwichrepo.object_store, parent.tree, commit.tree,
+            rename_detector=rename_detector):
+        if change.type in (dulwich.diff_tree.CHANGE_RENAME,
+                           dulwich.diff_tree.CHANGE_COPY) and \
+                change.new.path == path:
+            return change
+    return None
+
+
+def _find_rename_source(repos, parent, commit, path):
+    """Return the path in `parent` that `path` in `commit` was renamed or
+    copied from, if rename detection is enabled.
+    """
+    change = find_rename(repos, parent, commit, path)
+    return change is not None and change.old.path or None
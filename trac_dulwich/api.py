@@ -10,6 +10,9 @@ from trac.util.compat import set, sorted
 
 import db_default
 
+# Errors that are skipped when old data is reinserted after an upgrade
+_ignored_errors = ('OperationalError', 'IntegrityError')
+
 class TracDulwichSystem(Component):
     """Hook into the environment logic in order to create and maintain the cache database."""
 
@@ -41,18 +44,18 @@ class TracDulwichSystem(Component):
                 
         # Insert the default table
         old_data = {} # {table_name: (col_names, [row, ...]), ...}
-        cursor = db.cursor()
-        if not self.found_db_version:
-            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",(db_default.name, db_default.version))
-        else:
-            cursor.execute("UPDATE system SET value=%s WHERE name=%s",(db_default.version, db_default.name))
+        if self.found_db_version:
             for tbl in db_default.tables:
+                # A failed statement closes the cursor on some backends, so
+                # every statement gets a cursor of its own
+                cursor = db.cursor()
                 try:
                     cursor.execute('SELECT * FROM %s'%tbl.name)
                     old_data[tbl.name] = ([d[0] for d in cursor.description], cursor.fetchall())
                 except Exception, e:
                     if 'OperationalError' not in e.__class__.__name__:
                         raise e # If it is an OperationalError, keep going
+                cursor = db.cursor()
                 try:
                     cursor.execute('DROP TABLE %s'%tbl.name)
                 except Exception, e:
@@ -64,6 +67,7 @@ class TracDulwichSystem(Component):
                 self.log.info('TracDulwich: Running migration %s', migration.__doc__)
                 migration(old_data)          
                 
+        cursor = db.cursor()
         for tbl in db_default.tables:
             for sql in db_manager.to_sql(tbl):
                 cursor.execute(sql)
@@ -73,9 +77,25 @@ class TracDulwichSystem(Component):
                 data = old_data[tbl.name]
                 sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
                       (tbl.name, ','.join(data[0]), ','.join(['%s'] * len(data[0])))
-                for row in data[1]:
-                    try:
-                        cursor.execute(sql, row)
-                    except Exception, e:
-                        if 'OperationalError' not in e.__class__.__name__:
-                            raise e
+                try:
+                    cursor.executemany(sql, data[1])
+                except Exception, e:
+                    if e.__class__.__name__ not in _ignored_errors:
+                        raise e
+                    # Fall back to inserting the rows one by one, skipping
+                    # the ones that fail
+                    for row in data[1]:
+                        cursor = db.cursor()
+                        try:
+                            cursor.execute(sql, row)
+                        except Exception, e:
+                            if e.__class__.__name__ not in _ignored_errors:
+                                raise e
+
+        # The version is written last, as some backends roll back the
+        # transaction when one of the statements above fails
+        cursor = db.cursor()
+        if not self.found_db_version:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",(db_default.name, db_default.version))
+        else:
+            cursor.execute("UPDATE system SET value=%s WHERE name=%s",(db_default.version, db_default.name))
@@ -0,0 +1,460 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Zip and tar archives of a directory at a revision.
+
+Archives are written straight from the tree objects: no nodes are created
+and no history is looked up, and the contents of the blobs are streamed
+into the archive chunk by chunk. Like `git archive`, every entry gets the
+commit time of the revision as its modification time.
+
+An archive is written to a file in the repository control directory before
+it is sent, so its size is known and the memory used does not depend on the
+size of the tree. The files are kept as a cache, keyed by the tree sha and
+the format, and removed oldest first when the cache grows beyond
+`[dulwich] archive_cache_size`. Archives that are not cached, and all
+archives of repositories whose control directory is not writable, are
+written to temporary files instead.
+"""
+
+from fnmatch import fnmatchcase
+import hashlib
+import os
+import posixpath
+import re
+import shutil
+import stat
+import struct
+from StringIO import StringIO
+import tarfile
+import tempfile
+import threading
+import time
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+import zlib
+
+from trac.config import IntOption
+from trac.core import *
+from trac.resource import ResourceNotFound
+from trac.util import content_disposition
+from trac.versioncontrol import NoSuchChangeset, RepositoryManager
+from trac.versioncontrol.web_ui.browser import BrowserModule
+from trac.web.api import HTTPBadRequest, IRequestFilter, IRequestHandler, \
+                         RequestDone
+from trac.web.chrome import add_link
+
+from dulwich.objects import S_ISGITLINK
+
+from blobstream import CHUNK_SIZE, open_blob
+from commitgraph import index_path
+
+ARCHIVE_DIR = 'archives'
+
+# format: (mime type, file extension)
+FORMATS = {'zip': ('application/zip', '.zip'),
+           'tar.gz': ('application/x-gzip', '.tar.gz')}
+
+
+def iter_tree(object_store, tree_sha, path=''):
+    """Generate `(path, mode, sha)` for every entry below the tree
+    `tree_sha`, a directory before its contents. Submodules are skipped.
+    """
+    for name, mode, sha in object_store[tree_sha].iteritems():
+        if S_ISGITLINK(mode):
+            continue
+        entry_path = path and path + '/' + name or name
+        yield entry_path, mode, sha
+        if stat.S_ISDIR(mode):
+            for entry in iter_tree(object_store, sha, entry_path):
+                yield entry
+
+
+def _unix_mode(mode):
+    """Return the file mode to store in an archive for a tree entry."""
+    if stat.S_ISDIR(mode):
+        return stat.S_IFDIR | 0755
+    elif stat.S_ISLNK(mode):
+        return stat.S_IFLNK | 0777
+    return stat.S_IFREG | (mode & 0111 and 0755 or 0644)
+
+
+def _open_blob(object_store, sha):
+    content = open_blob(object_store, sha)
+    if content is None:
+        # not stored in this repository's own object directory
+        data = object_store[sha].as_raw_string()
+        content = StringIO(data)
+        content.size = len(data)
+    return content
+
+
+def _iter_chunks(content):
+    while True:
+        chunk = content.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+class ZipWriter(object):
+    """Write a zip file to a file object that only needs a `write` method.
+
+    The sizes and checksum of an entry follow its data in a data
+    descriptor, so entries are compressed while they are written. Zip64 is
+    not supported, archives are limited to 4 GiB and 65535 entries.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.central = []
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def add(self, name, mode, mtime, content=None):
+        """Add the entry `name` (utf-8) with unix `mode`. `content` is a
+        file object with the contents of a file or symbolic link.
+        """
+        is_dir = stat.S_ISDIR(mode)
+        if is_dir:
+            name += '/'
+        date_time = time.gmtime(mtime)
+        dos_time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+        dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | \
+                   date_time[2]
+        # the "extended-timestamp" field holds the unix time
+        extra = struct.pack('<HHBl', 0x5455, 5, 1, mtime)
+        # utf-8 file name, sizes in a data descriptor
+        flags = 0x800 | 0x08
+        if is_dir:
+            method = ZIP_STORED
+        else:
+            method = ZIP_DEFLATED
+        header_offset = self.offset
+        self._write(struct.pack('<4sHHHHHLLLHH', 'PK\x03\x04', 20, flags,
+                                method, dos_time, dos_date, 0, 0, 0,
+                                len(name), len(extra)) + name + extra)
+        crc = size = compressed_size = 0
+        if not is_dir:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -15)
+            for chunk in _iter_chunks(content):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data = compressor.compress(chunk)
+                compressed_size += len(data)
+                self._write(data)
+            data = compressor.flush()
+            compressed_size += len(data)
+            self._write(data)
+        crc &= 0xffffffff
+        self._write(struct.pack('<4sLLL', 'PK\x07\x08', crc,
+                                compressed_size, size))
+        if self.offset > 0xffffffff or len(self.central) == 0xffff:
+            raise TracError("The archive is too large for the zip format")
+        self.central.append(
+            struct.pack('<4sHHHHHHLLLHHHHHLL', 'PK\x01\x02', 3 << 8 | 20, 20,
+                        flags, method, dos_time, dos_date, crc,
+                        compressed_size, size, len(name), len(extra), 0, 0, 0,
+                        (mode & 0xffff) << 16, header_offset) + name + extra)
+
+    def close(self):
+        start = self.offset
+        for entry in self.central:
+            self._write(entry)
+        self._write(struct.pack('<4sHHHHLLH', 'PK\x05\x06', 0, 0,
+                                len(self.central), len(self.central),
+                                self.offset - start, start, 0))
+
+
+class TarWriter(object):
+    """Write a gzipped tar file, with the same interface as `ZipWriter`."""
+
+    def __init__(self, fileobj):
+        self.tarfile = tarfile.open(mode='w|gz', fileobj=fileobj)
+
+    def add(self, name, mode, mtime, content=None):
+        info = tarfile.TarInfo(name)
+        info.mtime = mtime
+        info.mode = stat.S_IMODE(mode)
+        if stat.S_ISDIR(mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = content.read()
+        else:
+            info.size = content.size
+        self.tarfile.addfile(info, info.isreg() and content or None)
+
+    def close(self):
+        self.tarfile.close()
+
+
+def write_archive(fileobj, object_store, tree_sha, format, prefix, mtime,
+                  can_view=None):
+    """Write the tree `tree_sha` to `fileobj` as an archive in `format`.
+
+    Entry names start with `prefix` (utf-8). `can_view`, if given, is called
+    with the path and the mode of every entry; the entries for which it
+    returns `False` are left out, directories with all their contents.
+    """
+    if format == 'zip':
+        archive = ZipWriter(fileobj)
+    else:
+        archive = TarWriter(fileobj)
+    if prefix:
+        archive.add(prefix.rstrip('/'), _unix_mode(stat.S_IFDIR), mtime)
+    hidden = None
+    for path, mode, sha in iter_tree(object_store, tree_sha):
+        if hidden and path.startswith(hidden):
+            continue
+        if can_view is not None and not can_view(path, mode):
+            hidden = stat.S_ISDIR(mode) and path + '/' or None
+            continue
+        name = prefix + path
+        mode = _unix_mode(mode)
+        content = None
+        if not stat.S_ISDIR(mode):
+            content = _open_blob(object_store, sha)
+        try:
+            archive.add(name, mode, mtime, content)
+        finally:
+            if content is not None:
+                content.close()
+    archive.close()
+
+
+def _write_temporary(object_store, tree_sha, format, prefix, mtime,
+                     can_view):
+    """Write an archive to a temporary file, and return the file."""
+    fileobj = tempfile.TemporaryFile()
+    try:
+        write_archive(fileobj, object_store, tree_sha, format, prefix, mtime,
+                      can_view)
+    except:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+    return fileobj
+
+
+def _open_cached(path):
+    """Open the cached archive at `path` and mark it as used, or return
+    `None` if it is not in the cache.
+    """
+    try:
+        fileobj = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass # pruned in the meantime, the open file can still be read
+    return fileobj
+
+
+def _prune(directory, max_size, keep):
+    """Remove the oldest archives of `directory` until the total size is at
+    most `max_size`. Archives are touched when they are used.
+    """
+    archives = []
+    total = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path == keep or name.endswith('.tmp'):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        archives.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if keep is not None:
+        total += os.path.getsize(keep)
+    for mtime, size, path in sorted(archives):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+class DulwichArchiveModule(Component):
+    """Download a directory of a dulwich repository as a zip or tar
+    archive.
+
+    The "Zip Archive" link of the repository browser is replaced by a link
+    to `/archive/<rev>/<reponame>/<path>?format=zip`, and a link to a
+    gzipped tarball is added next to it.
+    """
+
+    implements(IRequestFilter, IRequestHandler)
+
+    _archive_cache_size = IntOption('dulwich', 'archive_cache_size',
+                                    256 * 1024 * 1024,
+        """Maximum total size in bytes of the archives of each repository
+        that are kept for later downloads. Set to 0 to remove archives once
+        they are sent.""")
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        if template == 'browser.html' and data and data.get('dir') and \
+                hasattr(data.get('repos'), 'dulwichrepo'):
+            self._add_links(req, data)
+        return template, data, content_type
+
+    def _add_links(self, req, data):
+        repos = data['repos']
+        # Trac only adds the zip link for the downloadable paths
+        for link in req.chrome.get('links', {}).get('alternate', []):
+            if link.get('type') == FORMATS['zip'][0]:
+                break
+        else:
+            return
+        args = (data['stickyrev'] or repos.youngest_rev,
+                repos.reponame or None, data['path'])
+        link['href'] = req.href.archive(*args, format='zip')
+        add_link(req, 'alternate', req.href.archive(*args, format='tar.gz'),
+                 'Tarball', FORMATS['tar.gz'][0], 'tgz')
+
+    # IRequestHandler methods
+    def match_request(self, req):
+        match = re.match(r'/archive/([^/]+)(/.*)?$', req.path_info)
+        if match:
+            req.args['rev'], req.args['path'] = match.groups()
+            return True
+
+    def process_request(self, req):
+        format = req.args.get('format')
+        if format not in FORMATS:
+            raise HTTPBadRequest("Unknown archive format '%s'" % format)
+        rm = RepositoryManager(self.env)
+        reponame, repos, path = rm.get_repository_by_path(
+            req.args.get('path') or '/')
+        if not hasattr(repos, 'dulwichrepo'):
+            raise ResourceNotFound("No dulwich repository at '%s'" %
+                                   req.args.get('path'))
+        path = repos.normalize_path(path).strip('/')
+        full_path = posixpath.join(repos.reponame, path).strip('/')
+        if not any(fnmatchcase(full_path, pattern.strip('/'))
+                   for pattern in BrowserModule(self.env).downloadable_paths):
+            raise ResourceNotFound("'%s' can not be downloaded" % full_path)
+        try:
+            rev = repos.normalize_rev(req.args.get('rev'))
+        except NoSuchChangeset, e:
+            raise ResourceNotFound(e.message, 'Invalid Changeset Number')
+        req.perm(repos.resource.child('source', path or '/', version=rev)) \
+            .require('BROWSER_VIEW')
+
+        commit = repos.dulwichrepo[rev]
+        entry = repos._lookup_entry(commit.tree, path)
+        if entry is None or not stat.S_ISDIR(entry[0]):
+            raise ResourceNotFound("No directory '%s' at revision %s" %
+                                   (path, rev))
+        tree_sha = entry[1]
+
+        name = posixpath.basename(path) or reponame or \
+               os.path.basename(repos.dulwichrepo.path.rstrip(os.sep))
+        if name.endswith('.git'):
+            name = name[:-4]
+        basename = '%s-%s' % (name, repos.short_rev(rev))
+        prefix = (basename + '/').encode('utf-8')
+
+        can_view = None
+        if self.config.get('trac', 'authz_file'):
+            # path based permissions, every entry is checked and the archive
+            # is only good for this request
+            def can_view(entry_path, mode):
+                resource = repos.resource.child(
+                    'source', posixpath.join(path, entry_path.decode('utf-8')),
+                    version=rev)
+                action = stat.S_ISDIR(mode) and 'BROWSER_VIEW' or 'FILE_VIEW'
+                return action in req.perm(resource)
+        fileobj = self._get_archive(repos.dulwichrepo, tree_sha, format,
+                                    prefix, commit.commit_time, can_view)
+        try:
+            req.send_response(200)
+            req.send_header('Content-Type', FORMATS[format][0])
+            req.send_header('Content-Disposition',
+                            content_disposition('attachment',
+                                                basename + FORMATS[format][1]))
+            req.send_header('Content-Length',
+                            os.fstat(fileobj.fileno()).st_size)
+            req.end_headers()
+            if req.method != 'HEAD':
+                for chunk in _iter_chunks(fileobj):
+                    req.write(chunk)
+        finally:
+            fileobj.close()
+        raise RequestDone
+
+    def _get_archive(self, dulwichrepo, tree_sha, format, prefix, mtime,
+                     can_view):
+        """Return an open file with the archive of a tree.
+
+        Archives that are not cached are written to a temporary file, which
+        is removed when it is closed. This includes the archives of
+        repositories whose control directory is not writable.
+        """
+        directory = index_path(dulwichrepo, ARCHIVE_DIR)
+        # archives of the same tree at other revisions differ in the prefix
+        # and the times of the entries
+        digest = hashlib.sha1('%s\0%d' % (prefix, mtime)).hexdigest()[:12]
+        path = os.path.join(directory, '%s-%s%s' % (tree_sha, digest,
+                                                    FORMATS[format][1]))
+        cache = can_view is None and self._archive_cache_size > 0
+        if cache:
+            fileobj = _open_cached(path)
+            if fileobj is not None:
+                return fileobj
+            tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                         threading._get_ident())
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                fileobj = open(tmp_path, 'w+b')
+            except (IOError, OSError), e:
+                self.log.warning("Archives of %s are not cached: %s",
+                                 dulwichrepo.path, e)
+                cache = False
+        if not cache:
+            return _write_temporary(dulwichrepo.object_store, tree_sha,
+                                    format, prefix, mtime, can_view)
+        try:
+            write_archive(fileobj, dulwichrepo.object_store, tree_sha, format,
+                          prefix, mtime, can_view)
+        except:
+            fileobj.close()
+            os.remove(tmp_path)
+            raise
+        fileobj.close()
+        if os.path.getsize(tmp_path) <= self._archive_cache_size:
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+            _prune(directory, self._archive_cache_size, path)
+            fileobj = _open_cached(path)
+            if fileobj is not None:
+                return fileobj
+            # pruned by another request in the meantime
+            return _write_temporary(dulwichrepo.object_store, tree_sha,
+                                    format, prefix, mtime, can_view)
+        # too large for the cache
+        fileobj = tempfile.TemporaryFile()
+        tmp_file = open(tmp_path, 'rb')
+        try:
+            shutil.copyfileobj(tmp_file, fileobj, CHUNK_SIZE)
+        finally:
+            tmp_file.close()
+            os.remove(tmp_path)
+        fileobj.seek(0)
+        return fileobj
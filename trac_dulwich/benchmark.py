@@ -0,0 +1,349 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Benchmarks of the repository connector.
+
+Generates a synthetic repository of a configurable shape, and times the
+operations Trac performs most, with and without the cache. The results are
+written as JSON so runs can be compared:
+
+    python -m trac_dulwich.benchmark --commits 2000 --files 500 -o before.json
+
+The same `--seed` always generates the same repository and samples.
+"""
+
+from datetime import datetime
+from optparse import OptionParser
+import json
+import os
+import posixpath
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+import dulwich
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
+from trac.env import Environment
+
+from trac_dulwich import dulwich_fs, objectcache
+from trac_dulwich.cache import sync_repository
+from trac_dulwich.dulwich_fs import DulwichConnector
+
+_WORDS = ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta',
+          'theta', 'iota', 'kappa', 'lambda', 'mu')
+
+
+class RepositoryGenerator(object):
+    """Writes a synthetic history into a new repository.
+
+    Every commit edits a few files and sometimes adds one. Every
+    `merge_every` commits, a side branch of a few commits is merged back.
+    All objects are written as a single pack.
+    """
+
+    def __init__(self, path, commits=1000, files=200, depth=3,
+                 merge_every=20, blob_size=2048, seed=0):
+        self.path = path
+        self.commits = commits
+        self.files = files
+        self.depth = depth
+        self.merge_every = merge_every
+        self.blob_size = blob_size
+        self.random = random.Random(seed)
+        self.objects = []
+        self.contents = {} # {blob sha: data}
+        self.written = set()
+        self.time = 1300000000
+        self.count = 0
+
+    def generate(self):
+        """Create the repository and return its head."""
+        repo = Repo.init(self.path, mkdir=True)
+        dirs = {'': {}} # {directory: {name: (mode, sha)}}
+        paths = []
+        for i in xrange(max(1, self.files // 4)):
+            paths.append(self._add_file(dirs))
+        head = self._commit(dirs, [], 'Initial import')
+
+        while self.count < self.commits:
+            if self.merge_every and self.count % self.merge_every == 0 and \
+                    self.count:
+                side_dirs = self._copy(dirs)
+                side = head
+                for i in xrange(self.random.randint(1, 3)):
+                    self._edit(side_dirs, paths)
+                    side = self._commit(side_dirs, [side], 'Side work')
+                self._edit(dirs, paths)
+                head = self._commit(dirs, [head], 'Main work')
+                # the merge takes the files changed on the side branch
+                for path in paths:
+                    entry = self._get(side_dirs, path)
+                    if entry != self._get(dirs, path):
+                        self._set(dirs, path, entry)
+                head = self._commit(dirs, [head, side], 'Merge side')
+            else:
+                if len(paths) < self.files and self.random.random() < 0.3:
+                    paths.append(self._add_file(dirs))
+                self._edit(dirs, paths)
+                head = self._commit(dirs, [head], 'Work')
+
+        repo.object_store.add_objects(self.objects)
+        repo.refs['refs/heads/master'] = head
+        return head
+
+    def _content(self):
+        size = self.random.randint(self.blob_size // 2, self.blob_size * 2)
+        lines = []
+        length = 0
+        while length < size:
+            line = ' '.join(self.random.choice(_WORDS) for i in xrange(8))
+            lines.append(line)
+            length += len(line) + 1
+        return '\n'.join(lines) + '\n'
+
+    def _add_file(self, dirs):
+        parts = ['dir%d' % self.random.randint(0, 4)
+                 for i in xrange(self.random.randint(0, self.depth))]
+        parts.append('file%d.txt' % self.random.randint(0, 1 << 30))
+        path = '/'.join(parts)
+        self._set(dirs, path, (0100644, self._blob(self._content())))
+        return path
+
+    def _edit(self, dirs, paths):
+        for path in self.random.sample(paths, min(len(paths), 3)):
+            mode, sha = self._get(dirs, path)
+            lines = self.contents[sha].split('\n')
+            index = self.random.randint(0, len(lines) - 1)
+            lines[index] = ' '.join(self.random.choice(_WORDS)
+                                    for i in xrange(8))
+            self._set(dirs, path, (mode, self._blob('\n'.join(lines))))
+
+    def _blob(self, data):
+        blob = Blob.from_string(data)
+        self.contents[blob.id] = data
+        self._write(blob)
+        return blob.id
+
+    def _write(self, obj):
+        if obj.id not in self.written:
+            self.written.add(obj.id)
+            self.objects.append((obj, None))
+
+    def _get(self, dirs, path):
+        directory, name = posixpath.split(path)
+        return dirs.get(directory, {}).get(name)
+
+    def _set(self, dirs, path, entry):
+        directory, name = posixpath.split(path)
+        while name:
+            if directory not in dirs:
+                dirs[directory] = {}
+            dirs[directory][name] = entry
+            # the tree sha is resolved when committing
+            entry = (stat.S_IFDIR, None)
+            directory, name = posixpath.split(directory)
+
+    def _copy(self, dirs):
+        return dict((directory, dict(entries))
+                    for directory, entries in dirs.iteritems())
+
+    def _tree(self, dirs, directory):
+        tree = Tree()
+        for name, (mode, sha) in dirs[directory].iteritems():
+            if stat.S_ISDIR(mode):
+                sha = self._tree(dirs, posixpath.join(directory, name))
+            tree.add(name, mode, sha)
+        self._write(tree)
+        return tree.id
+
+    def _commit(self, dirs, parents, message):
+        self.time += self.random.randint(60, 3600)
+        commit = Commit()
+        commit.tree = self._tree(dirs, '')
+        commit.parents = parents
+        commit.author = commit.committer = 'Benchmark <bench@example.org>'
+        commit.author_time = commit.commit_time = self.time
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.encoding = 'UTF-8'
+        commit.message = '%s %d\n' % (message, self.count)
+        self._write(commit)
+        self.count += 1
+        return commit.id
+
+
+class Timer(object):
+    """Collects the timings of the benchmarked operations."""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name, cache, function, args_list):
+        """Call `function` with every argument tuple of `args_list`,
+        `repeat` times, and record the time of each round.
+        """
+        rounds = []
+        for i in xrange(self.repeat):
+            start = time.time()
+            for args in args_list:
+                function(*args)
+            rounds.append(time.time() - start)
+        self.results.append({'name': name, 'cache': cache,
+                             'calls': len(args_list),
+                             'first': rounds[0], 'best': min(rounds),
+                             'mean': sum(rounds) / len(rounds)})
+
+
+def _clear_process_caches():
+    """Start every configuration with cold in-process caches."""
+    for lru in (objectcache._object_cache, dulwich_fs._changeset_changes,
+                dulwich_fs._annotations):
+        if lru is not None:
+            lru.clear()
+
+
+def _open_environment(path, cache):
+    env = Environment(path, create=True, options=[
+        ('project', 'name', 'benchmark'),
+        ('trac', 'database', 'sqlite:db/trac.db'),
+        ('components', 'trac_dulwich.*', 'enabled'),
+        ('dulwich', 'enable_cache', cache and 'true' or 'false'),
+    ])
+    return env
+
+
+def _open_repository(env, path):
+    return DulwichConnector(env).get_repository('dulwich', path,
+                                                {'id': 1, 'name': 'bench'})
+
+
+def run(options):
+    workdir = tempfile.mkdtemp(prefix='trac-dulwich-bench-')
+    try:
+        repo_path = os.path.join(workdir, 'repo')
+        start = time.time()
+        generator = RepositoryGenerator(repo_path, options.commits,
+                                        options.files, options.depth,
+                                        options.merge_every,
+                                        options.blob_size, options.seed)
+        generator.generate()
+        generate_time = time.time() - start
+
+        timer = Timer(options.repeat)
+        for cache in (False, True):
+            _clear_process_caches()
+            env = _open_environment(os.path.join(workdir,
+                                                 'env-%s' % cache), cache)
+            repos = _open_repository(env, repo_path)
+            if cache:
+                start = time.time()
+                sync_repository(env, repos, options.jobs)
+                timer.results.append({'name': 'sync', 'cache': True,
+                                      'calls': 1,
+                                      'first': time.time() - start})
+                repos = _open_repository(env, repo_path)
+            _time_operations(timer, repos, cache, options)
+            repos.close()
+
+        return {
+            'parameters': dict(vars(options)),
+            'environment': {
+                'python': sys.version.split()[0],
+                'dulwich': '.'.join(map(str, dulwich.__version__)),
+                'date': datetime.utcnow().isoformat(),
+            },
+            'generate': generate_time,
+            'results': timer.results,
+        }
+    finally:
+        if options.keep:
+            print >> sys.stderr, "Kept %s" % workdir
+        else:
+            shutil.rmtree(workdir)
+
+
+def _time_operations(timer, repos, cache, options):
+    sample = random.Random(options.seed)
+    head = repos.get_youngest_rev()
+    revs = [rev for path, rev, change in repos.get_node('/').get_history()]
+    files = []
+    dirs = ['/']
+    for directory in dirs:
+        for node in repos.get_node(directory, head).get_entries():
+            if node.isdir:
+                dirs.append(node.path)
+            else:
+                files.append(node.path)
+
+    def choose(values):
+        return sample.sample(values, min(len(values), options.samples))
+
+    sample_files = [(path, head) for path in choose(files)]
+    sample_dirs = [(path, head) for path in choose(dirs)]
+    sample_revs = [(rev,) for rev in choose(revs)]
+
+    timer.time('get_node', cache, repos.get_node, sample_files)
+    # like the browser, use the last change of every entry
+    timer.time('get_entries', cache,
+               lambda path, rev: [node.rev for node in
+                                  repos.get_node(path, rev).get_entries()],
+               sample_dirs)
+    timer.time('get_history', cache,
+               lambda path, rev: list(repos.get_node(path, rev).get_history(
+                   options.history_limit)),
+               sample_files)
+    timer.time('get_changes', cache,
+               lambda rev: list(repos.get_changeset(rev).get_changes()),
+               sample_revs)
+    timer.time('previous_rev', cache, repos.previous_rev, sample_revs)
+    timer.time('next_rev', cache, repos.next_rev, sample_revs)
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--commits', type='int', default=1000,
+                      help="number of commits to generate [%default]")
+    parser.add_option('--files', type='int', default=200,
+                      help="maximum number of files [%default]")
+    parser.add_option('--depth', type='int', default=3,
+                      help="maximum directory depth [%default]")
+    parser.add_option('--merge-every', type='int', default=20,
+                      help="commits between merges, 0 for none [%default]")
+    parser.add_option('--blob-size', type='int', default=2048,
+                      help="average file size in bytes [%default]")
+    parser.add_option('--seed', type='int', default=0,
+                      help="seed of the generator and samples [%default]")
+    parser.add_option('--samples', type='int', default=50,
+                      help="paths and revisions per operation [%default]")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="rounds per operation [%default]")
+    parser.add_option('--history-limit', type='int', default=100,
+                      help="maximum length of a file history [%default]")
+    parser.add_option('--jobs', type='int', default=1,
+                      help="processes used by the sync [%default]")
+    parser.add_option('-o', '--output', default=None,
+                      help="write the results to this file")
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="keep the generated repository and environments")
+    options, args = parser.parse_args(args)
+
+    result = run(options)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output + '\n')
+        finally:
+            f.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Read blob contents without materializing them in memory.
+
+dulwich always inflates a complete object into memory before it can be
+used. For large files this means the whole blob (and usually a copy of it)
+ends up in the memory of the Trac process. The functions in this module
+read loose and packed blobs directly from disk instead, inflating them
+chunk by chunk. The size of a blob is read from the object header, without
+inflating the contents.
+
+Deltified blobs are streamed as the delta is applied, but the base object of
+the delta and the (compressed much smaller) delta itself are still read in
+full. Git does not deltify files larger than `core.bigFileThreshold`, so the
+large files that matter are stored whole.
+"""
+
+from binascii import hexlify
+import os
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+_BLOB = 3
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+
+class BlobStream(object):
+    """Minimal file-like object over a generator of chunks."""
+
+    def __init__(self, chunks, size):
+        self._chunks = chunks
+        self._buffer = ''
+        self.size = size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = [self._buffer]
+            data.extend(self._chunks)
+            self._buffer = ''
+            return ''.join(data)
+        while len(self._buffer) < size:
+            try:
+                self._buffer += self._chunks.next()
+            except StopIteration:
+                break
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._chunks.close()
+
+
+def open_blob(object_store, sha):
+    """Return a `BlobStream` for the blob `sha`, or `None` if the blob can
+    not be read directly from disk (e.g. it is in an alternate store).
+    """
+    location = _locate(object_store, sha)
+    if location is None:
+        return None
+    size, chunks = location
+    return BlobStream(chunks(), size)
+
+
+def get_blob_size(object_store, sha):
+    """Return the size of the blob `sha` without inflating it, or `None` if
+    it is not stored on disk.
+    """
+    location = _locate(object_store, sha)
+    if location is None:
+        return None
+    return location[0]
+
+
+def _locate(object_store, sha):
+    """Find a blob. Returns its size and a function that generates its
+    contents, or `None`.
+    """
+    if len(sha) == 20:
+        sha = hexlify(sha)
+    path = object_store._get_shafile_path(sha)
+    if os.path.exists(path):
+        return _locate_loose(path)
+    for pack in object_store.packs:
+        try:
+            offset = pack.index.object_index(sha)
+        except KeyError:
+            continue
+        return _locate_packed(object_store, pack, offset)
+    return None
+
+
+def _inflate(fp, decompressor=None):
+    """Generate the inflated data of the zlib stream at the position of
+    `fp`.
+    """
+    if decompressor is None:
+        decompressor = zlib.decompressobj()
+    while not decompressor.unused_data:
+        data = fp.read(CHUNK_SIZE)
+        if not data:
+            break
+        chunk = decompressor.decompress(data)
+        if chunk:
+            yield chunk
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def _locate_loose(path):
+    fp = open(path, 'rb')
+    try:
+        # Inflate just enough to read the "blob <size>\0" header
+        decompressor = zlib.decompressobj()
+        header = ''
+        while '\0' not in header:
+            data = fp.read(64)
+            if not data:
+                return None
+            header += decompressor.decompress(data)
+        header, first = header.split('\0', 1)
+    finally:
+        fp.close()
+    type_name, size = header.split(' ', 1)
+    if type_name != 'blob':
+        return None
+
+    def chunks():
+        fp = open(path, 'rb')
+        try:
+            decompressor = zlib.decompressobj()
+            skip = len(header) + 1
+            for chunk in _inflate(fp, decompressor):
+                if skip:
+                    chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                if chunk:
+                    yield chunk
+        finally:
+            fp.close()
+    return int(size), chunks
+
+
+def _read_pack_header(fp):
+    """Read the header of the pack entry at the position of `fp`.
+
+    Returns the type, the size and the delta base (an offset for offset
+    deltas, a binary sha for reference deltas, or `None`).
+    """
+    byte = ord(fp.read(1))
+    type_num = (byte >> 4) & 0x07
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+        byte = ord(fp.read(1))
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    base = None
+    if type_num == _OFS_DELTA:
+        byte = ord(fp.read(1))
+        base = byte & 0x7f
+        while byte & 0x80:
+            byte = ord(fp.read(1))
+            base = ((base + 1) << 7) | (byte & 0x7f)
+    elif type_num == _REF_DELTA:
+        base = fp.read(20)
+    return type_num, size, base
+
+
+def _read_varint(data, index):
+    value = shift = 0
+    while True:
+        byte = ord(data[index])
+        index += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, index
+
+
+def _locate_packed(object_store, pack, offset):
+    path = pack._data_path
+    fp = open(path, 'rb')
+    try:
+        fp.seek(offset)
+        type_num, size, base = _read_pack_header(fp)
+        data_offset = fp.tell()
+        if type_num in (_OFS_DELTA, _REF_DELTA):
+            # The delta starts with the base and the target size
+            decompressor = zlib.decompressobj()
+            head = ''
+            while len(head) < 20 and not decompressor.unused_data:
+                data = fp.read(64)
+                if not data:
+                    break
+                head += decompressor.decompress(data)
+            base_size, index = _read_varint(head, 0)
+            target_size, index = _read_varint(head, index)
+    finally:
+        fp.close()
+
+    if type_num == _BLOB:
+        def chunks():
+            fp = open(path, 'rb')
+            try:
+                fp.seek(data_offset)
+                for chunk in _inflate(fp):
+                    yield chunk
+            finally:
+                fp.close()
+        return size, chunks
+    elif type_num not in (_OFS_DELTA, _REF_DELTA):
+        return None
+
+    def chunks():
+        if type_num == _OFS_DELTA:
+            base_offset = offset - base
+            base_type, base_chunks = pack.data.resolve_object(
+                base_offset, *pack.data.get_object_at(base_offset))
+            base_data = ''.join(base_chunks)
+        else:
+            base_type, base_data = object_store.get_raw(hexlify(base))
+        fp = open(path, 'rb')
+        try:
+            fp.seek(data_offset)
+            delta = ''.join(_inflate(fp))
+        finally:
+            fp.close()
+        for chunk in _apply_delta(base_data, delta):
+            yield chunk
+    return target_size, chunks
+
+
+def _apply_delta(base, delta):
+    """Generate the result of applying `delta` to `base`, one instruction at
+    a time.
+    """
+    index = _read_varint(delta, 0)[1]
+    index = _read_varint(delta, index)[1]
+    length = len(delta)
+    while index < length:
+        command = ord(delta[index])
+        index += 1
+        if command & 0x80:
+            copy_offset = copy_size = 0
+            for bit in range(4):
+                if command & (1 << bit):
+                    copy_offset |= ord(delta[index]) << (bit * 8)
+                    index += 1
+            for bit in range(3):
+                if command & (1 << (4 + bit)):
+                    copy_size |= ord(delta[index]) << (bit * 8)
+                    index += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            # Yield large copies in pieces to keep the chunks bounded
+            end = copy_offset + copy_size
+            while copy_offset < end:
+                yield base[copy_offset:min(end, copy_offset + CHUNK_SIZE)]
+                copy_offset += CHUNK_SIZE
+        elif command:
+            yield delta[index:index + command]
+            index += command
+        else:
+            raise ValueError("Invalid opcode 0 in delta")
@@ -1,13 +1,36 @@
 from trac.admin import AdminCommandError, IAdminCommandProvider
+from trac.config import BoolOption, IntOption
 from trac.core import *
-from trac.util.text import printout
-from trac.versioncontrol import RepositoryManager
+from trac.util.text import exception_to_unicode, print_table, printout
+from trac.versioncontrol import IRepositoryChangeListener, \
+                                 NoSuchChangeset, RepositoryManager
+from trac.versioncontrol.api import Changeset
 
+import dulwich.diff_tree
+from dulwich.errors import NotTreeError
+from dulwich.object_store import tree_lookup_path
 import dulwich.repo
 import dulwich.objects
 
+from commitgraph import index_path, update_commit_graph
+from pathfilter import has_path_filters, update_path_filters
+from reachability import update_reachability
+from refcache import get_ref_snapshot
+from search import commit_tokens, tokenize
+from stats import load_stats, reset_stats, stats_path
+
+import multiprocessing
 import os.path
+import posixpath
+import Queue
 import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 ######
@@ -18,13 +41,51 @@ class DulwichCacheAdmin(Component):
     """trac-admin command provider for permission system administration."""
      
     implements(IAdminCommandProvider)
+
+    _sync_batch_size = IntOption('dulwich', 'sync_batch_size', 1000,
+        """Number of commits that `trac-admin dulwich sync` writes to the
+        cache in a single transaction.""")
  
     def get_admin_commands(self):
-        yield ('dulwich sync', '<project>',
-                'Synchronize a repository cache',
+        yield ('dulwich sync', '<project|--all> [--jobs N] [--workers N]',
+                """Synchronize a repository cache
+
+                With --jobs, the tree differences of the commits are computed
+                by N worker processes.
+
+                With --all, every dulwich repository is synchronized, by
+                --workers threads (default 4). The repositories with the most
+                new commits are started first, and a summary is printed at
+                the end.""",
                 None, self._do_sync)
+        yield ('dulwich stats', '<project> [--reset]',
+                """Show the totals of the connector statistics
+
+                The statistics are only collected when [dulwich]
+                instrumentation is enabled. With --reset, the totals are
+                cleared.""",
+                None, self._do_stats)
+        yield ('dulwich filters', '<project>',
+                """Write the changed-path filters of a repository
+
+                The filters speed up the history of paths when the cache is
+                disabled. Once written, the synchronization keeps them up to
+                date.""",
+                None, self._do_filters)
+        yield ('dulwich missing', '<project> <rev> <exclude>',
+                """List the commits of a revision that another lacks
+
+                Like `git log exclude..rev`, the commits reachable from <rev>
+                but not from <exclude> are listed. Revisions can be shas or
+                the names of branches and tags. For two synchronized refs the
+                answer comes from their reachability bitmaps.""",
+                None, self._do_missing)
      
-    def _do_sync(self, reponame):
+    def _do_sync(self, reponame, *args):
+        jobs, workers = _parse_sync_options(args)
+        if reponame == '--all':
+            self._sync_all(jobs, workers)
+            return
         rm = RepositoryManager(self.env)
         repos = rm.get_repository(reponame)
         if repos is None:
@@ -32,123 +93,776 @@ class DulwichCacheAdmin(Component):
 
         printout("Synchronizing repository data for repository %s" % 
             (reponame,))
+        if jobs > 1:
+            printout("Computing tree differences in %i processes" % jobs)
 
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        
-        # The database stores the heads up to what it has currently cached. Use
-        # these heads to determine where to stop to only cache the new
-        # revisions
-        exclude_list = []
-        cursor.execute("SELECT head FROM dulwich_heads WHERE repos=%s", 
-                       (repos.id,))
-        
-        for head in set(row[0] for row in cursor):
-            exclude_list.append(head)
-        
-        # Determine all the heads for this repository
-        heads = []
-        refs = repos.dulwichrepo.get_refs()
-        for key in refs.keys():
-            if key.startswith("refs/heads/"):
-                heads.append(refs[key])
-        
-        commit_count = 0
-        object_count = 0
-        
-        walker = repos.dulwichrepo.get_walker(include=heads, 
-                                              exclude=exclude_list)
-        for walk in walker:
-            for change in walk.changes():
-                parents = []
-                if isinstance(change, list):
-                    # The change is a list when the file is a merge from two 
-                    # or more previous changesets
-                    for c in change:
-                        if c.old not in parents:
-                            parents.append(c.old)
-                    change = change[0]
-                else:
-                    parents.append(change.old)
-                
-                if change.type == "delete":
-                    # we don't actually register deletes, they are registered 
-                    # when they are last modified
-                    continue
-
-                # check if this object is already in the database
-                cursor.execute("SELECT commit_id FROM dulwich_objects WHERE repos=%s AND sha=%s", (repos.id, change.new.sha))
-                item = cursor.fetchone()
-                
-                if item:
+        def progress(commit_count, object_count, start):
+            sys.stdout.write(_progress(commit_count, object_count, start) +
+                             '\r')
+            sys.stdout.flush()
+
+        lock = SyncLock(repos.dulwichrepo)
+        if not lock.acquire(blocking=False):
+            printout("Waiting for another synchronization to finish")
+            lock.acquire()
+        try:
+            result = sync_repository(self.env, repos, jobs,
+                                     self._sync_batch_size, progress)
+        finally:
+            lock.release()
+        printout(_progress(result['commits'], result['objects'],
+                           result['start']))
+        printout("Commit graph contains %i commits (%i new)" %
+                 (result['graph_commits'], result['graph_added']))
+
+
+    def _sync_all(self, jobs, workers):
+        rm = RepositoryManager(self.env)
+        names = []
+        for name, info in rm.get_all_repositories().iteritems():
+            if 'alias' in info or not info.get('dir'):
+                continue
+            if (info.get('type') or rm.repository_type) == 'dulwich':
+                names.append(name)
+        if not names:
+            printout("No dulwich repositories found")
+            return
+
+        # Most moved heads first, so the busy repositories do not end up
+        # running alone at the end. The number of new commits is only known
+        # once their synchronization has walked them.
+        queue = Queue.Queue()
+        pending = {}
+        results = {}
+        for name in names:
+            try:
+                pending[name] = count_moved_heads(self.env,
+                                                  rm.get_repository(name))
+            except Exception, e:
+                pending[name] = 0
+                results[name] = {'status': "failed: %s" %
+                                           exception_to_unicode(e),
+                                 'failed': True}
+        for name in sorted(pending, key=lambda name: (-pending[name], name)):
+            if name not in results:
+                queue.put(name)
+        printout("Synchronizing %i repositories with %i workers" %
+                 (queue.qsize(), workers))
+
+        output_lock = threading.Lock()
+
+        def work():
+            try:
+                while True:
                     try:
-                        cursor.execute("UPDATE dulwich_objects SET commit_id=%s WHERE repos=%s AND sha=%s", (walk.commit.id, repos.id, change.new.sha))
-                        db.commit()
-                    except:
-                        # Todo: this is probably all right and has to do with merge changesets, but need to
-                        # verify if it is absolutely the way it should be
-                        pass
-                else:
-                    # in case of add, or a modify of a file that we did not yet encounter (because
-                    #   we run in reverse order)
-                    cursor.execute("INSERT INTO dulwich_objects (repos, sha, path, mode, commit_id) VALUES (%s, %s, %s, %s, %s)",
-                                (repos.id, change.new.sha, change.new.path.decode("utf-8"), change.new.mode, walk.commit.id))
-                    db.commit()
-                    object_count += 1
-                    
-                if change.type == "add":
-                    # above in fetching o we already update the commit_id, so no action here
-                    pass
-                elif change.type == "modify":
-                    for parent in parents:
-                        try:
-                            # actually the commit_id for the old changeset is wrong, but it will be updated in the following runs of the loop
-                            cursor.execute("INSERT INTO dulwich_objects (repos, sha, path, mode, commit_id) VALUES (%s, %s, %s, %s, %s)",
-                                     (repos.id, parent.sha, parent.path.decode("utf-8"), parent.mode, walk.commit.id))
-                            db.commit()
-                            object_count += 1
-                        except: 
-                            # if this fails, it means that the parent object is already in the database
-                            # very likely because of merges. So it is safe to ignore. 
-                            pass
-                        
-
-                # handle the trees
-                path = os.path.split(change.new.path)[0]
-                if not path:
-                    continue
-                current_path = ""
-                tree = repos.dulwichrepo[walk.commit.tree]
-                for part in path.split('/'):
-                    # register each tree into the object store
-                    current_path += part
-                    mode, sha = tree.lookup_path(repos.dulwichrepo.get_object, current_path)
+                        name = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    result = self._sync_one(rm, name, jobs)
+                    output_lock.acquire()
                     try:
-                        cursor.execute("INSERT INTO dulwich_objects (repos, sha, path, mode, commit_id) VALUES (%s, %s, %s, %s, %s)",
-                                 (repos.id, sha, current_path.decode("utf-8"), mode, walk.commit.id))
-                        db.commit()
-                        object_count += 1
-                    except:
-                        # this tree was already registered with a previous path change
-                        pass
-                    current_path += '/'
-            # prepare for next run
-            commit_count += 1
-            if commit_count % 5 == 0:
-                sys.stdout.write('Synchronized %i commits with %i objects\r' % 
-                                 (commit_count, object_count))
-                sys.stdout.flush()
-                
-        # Store the heads
-        cursor.execute("DELETE FROM dulwich_heads WHERE repos=%s", (repos.id,))
-        for head in heads:
-            cursor.execute("""INSERT INTO dulwich_heads (repos, head)  
-                           VALUES (%s, %s)
-                           """, (repos.id, head))
+                        results[name] = result
+                        printout("%s: %s" % (name or '(default)',
+                                             result.get('progress') or
+                                             result['status']))
+                    finally:
+                        output_lock.release()
+            finally:
+                rm.shutdown(threading._get_ident())
+
+        threads = [threading.Thread(target=work)
+                   for i in xrange(min(workers, queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        rows = []
+        failed = 0
+        for name in sorted(names):
+            result = results[name]
+            if result.get('failed'):
+                failed += 1
+            rows.append((name or '(default)', pending[name],
+                         result.get('commits', 0), result.get('objects', 0),
+                         '%.1fs' % result.get('time', 0.0),
+                         result['status']))
+        printout()
+        print_table(rows, ['Repository', 'Heads', 'Commits', 'Objects',
+                           'Time', 'Status'])
+        if failed:
+            raise AdminCommandError("%i of %i repositories failed to "
+                                    "synchronize" % (failed, len(names)))
+
+    def _sync_one(self, rm, reponame, jobs):
+        """Synchronize one repository in a worker thread of `_sync_all`."""
+        start = time.time()
+        try:
+            repos = rm.get_repository(reponame)
+            lock = SyncLock(repos.dulwichrepo)
+            if not lock.acquire(blocking=False):
+                return {'status': "skipped, already being synchronized"}
+            try:
+                result = sync_repository(self.env, repos, jobs,
+                                         self._sync_batch_size)
+            finally:
+                lock.release()
+        except Exception, e:
+            self.log.error("TracDulwich: synchronization of %s failed: %s",
+                           reponame, exception_to_unicode(e, traceback=True))
+            return {'status': "failed: %s" % exception_to_unicode(e),
+                    'failed': True, 'time': time.time() - start}
+        result['time'] = time.time() - start
+        result['progress'] = _progress(result['commits'], result['objects'],
+                                       result['start'])
+        result['status'] = result['commits'] and "ok" or "up to date"
+        return result
+
+    def _do_filters(self, reponame):
+        rm = RepositoryManager(self.env)
+        repos = rm.get_repository(reponame)
+        if repos is None:
+            raise TracError("Repository '%(repo)s' not found", repo=reponame)
+
+        start = time.time()
+        lock = SyncLock(repos.dulwichrepo)
+        lock.acquire()
+        try:
+            heads = get_ref_snapshot(repos.dulwichrepo).get_heads()
+            graph, added = update_commit_graph(repos.dulwichrepo, heads)
+            filters, added = update_path_filters(repos.dulwichrepo, graph)
+        finally:
+            lock.release()
+        printout("Wrote changed-path filters of %i commits (%i new) in %.1fs"
+                 % (len(filters), added, time.time() - start))
+
+    def _do_missing(self, reponame, rev, exclude):
+        rm = RepositoryManager(self.env)
+        repos = rm.get_repository(reponame)
+        if repos is None:
+            raise TracError("Repository '%(repo)s' not found", repo=reponame)
+        try:
+            revs = repos.get_missing_revs(rev, exclude)
+        except NoSuchChangeset, e:
+            raise AdminCommandError(e.message)
+        for sha in revs:
+            message = repos.dulwichrepo[sha].message.decode('utf-8', 'replace')
+            printout("%s %s" % (repos.short_rev(sha),
+                                message.strip().split('\n')[0]))
+
+    def _do_stats(self, reponame, *args):
+        if args and args != ('--reset',):
+            raise AdminCommandError("Invalid arguments: %s" % ' '.join(args))
+        rm = RepositoryManager(self.env)
+        repos = rm.get_repository(reponame)
+        if repos is None:
+            raise TracError("Repository '%(repo)s' not found", repo=reponame)
+        if args:
+            reset_stats(stats_path(self.env, repos.id))
+            printout("Statistics of repository %s cleared" % reponame)
+            return
+
+        totals = load_stats(stats_path(self.env, repos.id))
+        requests = totals['requests']
+        printout("%i requests" % requests)
+        if not requests:
+            return
+        for name, value in sorted(totals['counters'].items()):
+            printout("%-20s %12i %12.1f per request" %
+                     (name, value, float(value) / requests))
+        for name, seconds in sorted(totals['timers'].items()):
+            printout("%-20s %11.3fs %10.2fms per request" %
+                     (name, seconds, seconds * 1000 / requests))
+
+
+######
+# Keeping the cache up to date
+######
+
+class DulwichCacheUpdater(Component):
+    """Keep the cache up to date when Trac is notified of new changesets.
+
+    Repository hooks notify Trac with `trac-admin <env> changeset added
+    <repos> <rev>...`, usually from the post-receive hook. Each notification
+    synchronizes the commits between the cached heads and the current
+    branches of the repository. When another synchronization is running, the
+    notification is skipped, the running synchronization picks up the new
+    commits or the next notification will.
+    """
+
+    implements(IRepositoryChangeListener)
+
+    _sync_on_change = BoolOption('dulwich', 'sync_on_changeset_added', 'true',
+        """Synchronize the cache of a repository when Trac is notified of a
+        new changeset. Only used when `enable_cache` is set.""")
+
+    # IRepositoryChangeListener methods
+    def changeset_added(self, repos, changeset):
+        if not self._sync_on_change or \
+                getattr(repos, 'cache', None) is None or \
+                not hasattr(repos, 'dulwichrepo'):
+            return
+        lock = SyncLock(repos.dulwichrepo)
+        if not lock.acquire(blocking=False):
+            self.log.debug("TracDulwich: cache synchronization of %s already "
+                           "running", repos.reponame)
+            return
+        try:
+            result = sync_repository(self.env, repos)
+        finally:
+            lock.release()
+        self.log.info("TracDulwich: %s", _progress(result['commits'],
+                                                   result['objects'],
+                                                   result['start']))
+
+    def changeset_modified(self, repos, changeset, old_changeset):
+        pass
+
+
+def sync_repository(env, repos, jobs=1, batch_size=1000, progress=None):
+    """Cache the commits of `repos` that are not cached yet.
+
+    Only the commits between the heads stored by the previous
+    synchronization and the current branch heads are processed. The caller
+    is expected to hold the `SyncLock` of the repository. `progress` is
+    called with the commit count, object count and start time after every
+    batch. Returns a dictionary with the statistics of the run.
+    """
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    
+    # The database stores the heads up to what it has currently cached. Use
+    # these heads to determine where to stop to only cache the new
+    # revisions
+    exclude_list = _synced_heads(db, repos.id)
+    
+    # Determine all the heads for this repository
+    snapshot = get_ref_snapshot(repos.dulwichrepo)
+    heads = snapshot.get_heads()
+
+    # Extend the commit graph index used for ancestry queries, and the
+    # reachability bitmaps of the refs
+    graph, added = update_commit_graph(repos.dulwichrepo, heads)
+    update_reachability(repos.dulwichrepo, graph, snapshot.refs)
+    if has_path_filters(repos.dulwichrepo):
+        update_path_filters(repos.dulwichrepo, graph)
+    
+    batch = _SyncBatch(env, repos.id)
+    batch_size = max(1, batch_size)
+    commit_count = 0
+    start = time.time()
+
+    if jobs > 1:
+        entries = _iter_commit_objects_parallel(repos.dulwichrepo, heads,
+                                                exclude_list, jobs)
+    else:
+        entries = _iter_commit_objects(repos.dulwichrepo, heads,
+                                       exclude_list)
+    if exclude_list and not _in_timeline(db, repos.id, exclude_list):
+        # Caches from before the timeline and the search index were added.
+        # The synced heads are written last, so the next synchronization
+        # completes a fill that was interrupted.
+        walker = repos.dulwichrepo.get_walker(include=exclude_list)
+        synced = set(exclude_list)
+        synced_commits = []
+        count = 0
+        for walk in walker:
+            if walk.commit.id in synced:
+                synced_commits.append(walk.commit)
+                continue
+            batch.add_commit(walk.commit)
+            count += 1
+            if count % batch_size == 0:
+                batch.flush()
+        for commit in synced_commits:
+            batch.add_commit(commit)
+        batch.flush()
+    for commit_id, objects, paths in entries:
+        for sha, path, mode, update in objects:
+            batch.add(sha, path, mode, commit_id, update)
+        batch.add_commit(repos.dulwichrepo[commit_id])
+        batch.add_path_changes(graph.ordinal(commit_id), commit_id, paths)
+        commit_count += 1
+        if commit_count % batch_size == 0:
+            batch.flush()
+            if progress:
+                progress(commit_count, batch.object_count, start)
+
+    # Store the heads together with the last batch
+    batch.flush(heads)
+    return {'commits': commit_count, 'objects': batch.object_count,
+            'start': start, 'graph_commits': len(graph),
+            'graph_added': added}
+
+
+def count_moved_heads(env, repos):
+    """Return the number of heads of `repos` that the last synchronization
+    has not seen, without walking any commits.
+    """
+    synced = set(_synced_heads(env.get_db_cnx(), repos.id))
+    heads = get_ref_snapshot(repos.dulwichrepo).get_heads()
+    return len(set(heads) - synced)
+
+
+def _synced_heads(db, repos_id):
+    cursor = db.cursor()
+    cursor.execute("SELECT head FROM dulwich_heads WHERE repos=%s",
+                   (repos_id,))
+    return list(set(row[0] for row in cursor))
+
+
+def _in_timeline(db, repos_id, shas):
+    """Return whether all commits `shas` are in the timeline."""
+    cursor = db.cursor()
+    found = 0
+    for chunk in _chunks(shas, _SyncBatch.chunk_size):
+        cursor.execute("SELECT COUNT(*) FROM dulwich_timeline "
+                       "WHERE repos=%%s AND sha IN (%s)" %
+                       ','.join(['%s'] * len(chunk)), [repos_id] + chunk)
+        found += cursor.fetchone()[0]
+    return found == len(shas)
+
+
+class SyncLock(object):
+    """Inter-process lock that serializes the synchronizations of a
+    repository.
+    """
+
+    def __init__(self, dulwichrepo):
+        self.path = index_path(dulwichrepo, 'sync.lock')
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if fcntl is not None:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX |
+                                (not blocking and fcntl.LOCK_NB or 0))
+            except IOError:
+                os.close(fd)
+                return False
+            self._fd = fd
+            return True
+        while True:
+            try:
+                self._fd = os.open(self.path,
+                                   os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.5)
+
+    def release(self):
+        if self._fd is None:
+            return
+        os.close(self._fd)
+        self._fd = None
+        if fcntl is None:
+            os.remove(self.path)
+
+
+def _progress(commit_count, object_count, start):
+    elapsed = max(time.time() - start, 0.001)
+    return 'Synchronized %i commits with %i objects ' \
+           '(%.1f commits/s, %.1f objects/s)' % \
+           (commit_count, object_count, commit_count / elapsed,
+            object_count / elapsed)
+
+
+def _parse_sync_options(args):
+    """Return the number of jobs and workers given in `args`."""
+    values = {'jobs': 1, 'workers': 4}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        for name in values:
+            option = '--' + name
+            if arg.startswith(option + '='):
+                value = arg[len(option) + 1:]
+                break
+            elif arg == option and args:
+                value = args.pop(0)
+                break
+        else:
+            raise AdminCommandError("Unknown argument '%s'" % arg)
+        try:
+            values[name] = int(value)
+        except ValueError:
+            values[name] = 0
+        if values[name] < 1:
+            raise AdminCommandError("Invalid number of %s '%s'" %
+                                    (name, value))
+    return values['jobs'], values['workers']
+
+
+def _commit_changes(store, commit):
+    """Return the tree changes of a commit, like `WalkEntry.changes()`."""
+    parents = commit.parents
+    if not parents:
+        return dulwich.diff_tree.tree_changes(store, None, commit.tree)
+    elif len(parents) == 1:
+        return dulwich.diff_tree.tree_changes(store, store[parents[0]].tree,
+                                              commit.tree)
+    else:
+        return dulwich.diff_tree.tree_changes_for_merge(
+            store, [store[p].tree for p in parents], commit.tree)
+
+
+def _iter_commit_objects(dulwichrepo, heads, exclude):
+    """Generate `(commit_id, objects, paths)` for every commit to
+    synchronize, newest first.
+    """
+    store = dulwichrepo.object_store
+    walker = dulwichrepo.get_walker(include=heads, exclude=exclude)
+    for walk in walker:
+        changes = walk.changes()
+        yield (walk.commit.id, _commit_objects(store, walk.commit, changes),
+               _commit_paths(store, walk.commit, changes))
+
+
+# maximum number of commits handed to a worker process at once
+_MAX_CHUNK_SIZE = 200
+
+
+def _iter_commit_objects_parallel(dulwichrepo, heads, exclude, jobs):
+    """Like `_iter_commit_objects`, but compute the objects of the commits
+    in a pool of `jobs` worker processes.
+
+    The commits are split into consecutive ranges of the walk order, and the
+    results of the ranges are consumed in that same order, so the writer
+    resolves the commit that introduced each object exactly like a serial
+    synchronization does.
+    """
+    commit_ids = [walk.commit.id for walk in
+                  dulwichrepo.get_walker(include=heads, exclude=exclude)]
+    size = max(1, min(_MAX_CHUNK_SIZE, len(commit_ids) // (jobs * 4)))
+    chunks = [(dulwichrepo.path, commit_ids[i:i + size])
+              for i in xrange(0, len(commit_ids), size)]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for results in pool.imap(_diff_commits, chunks):
+            for result in results:
+                yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+_worker_repos = {}
+
+
+def _diff_commits(args):
+    """Worker process entry point: compute the objects of a commit range."""
+    path, commit_ids = args
+    if path not in _worker_repos:
+        _worker_repos[path] = dulwich.repo.Repo(path)
+    store = _worker_repos[path].object_store
+    results = []
+    for commit_id in commit_ids:
+        commit = store[commit_id]
+        changes = list(_commit_changes(store, commit))
+        results.append((commit_id,
+                        list(_commit_objects(store, commit, changes)),
+                        _commit_paths(store, commit, changes)))
+    return results
+
+
+def _commit_objects(store, commit, changes):
+    """Generate the objects to register in the cache for a commit.
+
+    `changes` are the tree changes of the commit as returned by
+    `WalkEntry.changes()`. Yields `(sha, path, mode, update)` tuples; when
+    `update` is set, the commit is (so far) the oldest known commit that
+    introduced the object, otherwise the object is the old side of a
+    modification and is only registered if it is not yet known.
+    """
+    # directory path -> (mode, sha) in the tree of this commit
+    trees = {}
+    for change in changes:
+        parents = []
+        if isinstance(change, list):
+            # The change is a list when the file is a merge from two 
+            # or more previous changesets, with `None` for the parents
+            # that did not have the file in an octopus merge
+            change = [c for c in change if c is not None]
+            for c in change:
+                if c.old.sha is not None and c.old not in parents:
+                    parents.append(c.old)
+            change = change[0]
+        elif change.old.sha is not None:
+            parents.append(change.old)
+
+        if change.type == "delete":
+            # we don't actually register deletes, they are registered 
+            # when they are last modified
+            continue
+
+        yield change.new.sha, change.new.path, change.new.mode, True
+        if change.type == "modify":
+            # actually the commit_id for the old object is wrong, but it
+            # will be updated when the older commits are processed
+            for parent in parents:
+                yield parent.sha, parent.path, parent.mode, False
+
+        # handle the trees, resolving each directory once per commit
+        tree_sha = commit.tree
+        current_path = ''
+        for part in change.new.path.split('/')[:-1]:
+            current_path = current_path and current_path + '/' + part or part
+            if current_path not in trees:
+                trees[current_path] = store[tree_sha][part]
+                mode, sha = trees[current_path]
+                yield sha, current_path, mode, True
+            tree_sha = trees[current_path][1]
+
+
+_PATH_CHANGES = {dulwich.diff_tree.CHANGE_ADD: Changeset.ADD,
+                 dulwich.diff_tree.CHANGE_DELETE: Changeset.DELETE}
+
+
+def _commit_paths(store, commit, changes):
+    """Return the `(path, change)` pairs of the files and directories that a
+    commit changed, without the root directory. `change` is one of
+    `Changeset.ADD`, `Changeset.EDIT` or `Changeset.DELETE`.
+    """
+    paths = {}
+    for change in changes:
+        if not isinstance(change, list):
+            change = [change]
+        # for a merge, the change against each of the parents, or `None`
+        # for the parents of an octopus merge that did not have the path
+        change = [c for c in change if c is not None]
+        kinds = set(_PATH_CHANGES.get(c.type, Changeset.EDIT) for c in change)
+        kind = len(kinds) == 1 and kinds.pop() or Changeset.EDIT
+        path = change[0].new.path or change[0].old.path
+        paths[path] = kind
+
+    # Like the walker, a directory changed when its tree differs from the
+    # trees of all parents. In a merge, a directory can differ from all
+    # parents without any single file doing so.
+    touched = set(paths)
+    if len(commit.parents) > 1:
+        for parent in commit.parents:
+            for change in dulwich.diff_tree.tree_changes(
+                    store, store[parent].tree, commit.tree):
+                touched.add(change.new.path or change.old.path)
+    directories = set()
+    for path in touched:
+        directory = posixpath.dirname(path)
+        while directory and directory not in directories:
+            directories.add(directory)
+            directory = posixpath.dirname(directory)
+    parent_trees = [store[parent].tree for parent in commit.parents]
+    for directory in directories:
+        entry = _lookup_path(store, commit.tree, directory)
+        parent_entries = [_lookup_path(store, tree, directory)
+                          for tree in parent_trees]
+        if entry in parent_entries or \
+                (entry is None and not any(parent_entries)):
+            continue
+        if entry is None:
+            paths[directory] = Changeset.DELETE
+        elif any(parent_entries):
+            paths[directory] = Changeset.EDIT
+        else:
+            paths[directory] = Changeset.ADD
+    return paths.items()
+
+
+def _lookup_path(store, tree, path):
+    try:
+        return tree_lookup_path(store.__getitem__, tree, path)
+    except (KeyError, NotTreeError):
+        return None
+
+
+class _SyncBatch(object):
+    """Accumulates cache rows in memory and writes them in one transaction.
+
+    Objects are keyed by sha and path, so objects seen several times within
+    a batch (unchanged trees, reverted files) are only written once. Paths
+    and commits are interned in the `dulwich_paths` and `dulwich_commits`
+    tables. Every commit added with `add_commit` is also written to the
+    timeline and the search index.
+    """
+
+    # maximum number of parameters in a single IN (...) query
+    chunk_size = 500
+
+    def __init__(self, env, repos_id):
+        self.env = env
+        self.repos_id = repos_id
+        self.objects = {}
+        self.commits = []
+        self.path_changes = []
+        self.tokens = []
+        self.object_count = 0
+
+    def add(self, sha, path, mode, commit_id, update):
+        key = (sha, path)
+        entry = self.objects.get(key)
+        if entry is None:
+            self.objects[key] = [mode, commit_id, update]
+        elif update:
+            entry[1] = commit_id
+            entry[2] = True
+
+    def add_commit(self, commit):
+        self.commits.append((self.repos_id, commit.id, commit.author_time,
+                             commit.commit_time))
+        self.tokens.append((commit.id, commit_tokens(commit)))
+
+    def add_path_changes(self, ordinal, commit_id, paths):
+        for path, change in paths:
+            self.path_changes.append((path.decode('utf-8'), ordinal,
+                                      commit_id, change))
+
+    def _flushed_commits(self, cursor):
+        """Return the commits of the batch that are in the timeline already.
+
+        An interrupted synchronization keeps the batches it wrote, but not
+        its heads, and the next one processes their commits again. The
+        timeline row of a commit is written in the same transaction as its
+        path changes and words.
+        """
+        flushed = set()
+        shas = [commit[1] for commit in self.commits]
+        for chunk in _chunks(shas, self.chunk_size):
+            cursor.execute("SELECT sha FROM dulwich_timeline "
+                           "WHERE repos=%%s AND sha IN (%s)" %
+                           ','.join(['%s'] * len(chunk)),
+                           [self.repos_id] + chunk)
+            flushed.update(row[0] for row in cursor)
+        return flushed
+
+    def flush(self, heads=None):
+        """Write the pending objects and commits, and the new `heads` if
+        given.
+        """
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        flushed = self._flushed_commits(cursor)
+        paths = set(path.decode('utf-8') for sha, path in self.objects)
+        paths.update(change[0] for change in self.path_changes)
+        path_ids = _intern(cursor, self.repos_id, 'dulwich_paths', 'path',
+                           paths)
+        commits = set(entry[1] for entry in self.objects.itervalues())
+        commits.update(change[2] for change in self.path_changes)
+        commits.update(commit_id for commit_id, tokens in self.tokens)
+        commit_ids = _intern(cursor, self.repos_id, 'dulwich_commits', 'sha',
+                             commits)
+        objects = {}
+        for (sha, path), entry in self.objects.iteritems():
+            objects[(sha, path_ids[path.decode('utf-8')])] = entry
+
+        existing = set()
+        shas = list(set(sha for sha, path_id in objects))
+        for chunk in _chunks(shas, self.chunk_size):
+            cursor.execute("SELECT sha, path_id FROM dulwich_objects "
+                           "WHERE repos=%%s AND sha IN (%s)" %
+                           ','.join(['%s'] * len(chunk)),
+                           [self.repos_id] + chunk)
+            existing.update(cursor)
+
+        inserts = []
+        updates = []
+        for (sha, path_id), (mode, commit_id, update) in objects.iteritems():
+            commit_id = commit_ids[commit_id]
+            if (sha, path_id) not in existing:
+                inserts.append((self.repos_id, sha, path_id, mode, commit_id))
+            elif update:
+                updates.append((commit_id, self.repos_id, sha, path_id))
+        if inserts:
+            cursor.executemany("INSERT INTO dulwich_objects "
+                               "(repos, sha, path_id, mode, commit_id) "
+                               "VALUES (%s, %s, %s, %s, %s)", inserts)
+        if updates:
+            cursor.executemany("UPDATE dulwich_objects SET commit_id=%s "
+                               "WHERE repos=%s AND sha=%s AND path_id=%s",
+                               updates)
+        path_changes = [(self.repos_id, path_ids[path], ordinal,
+                         commit_ids[commit_id], change)
+                        for path, ordinal, commit_id, change
+                        in self.path_changes if commit_id not in flushed]
+        if path_changes:
+            cursor.executemany("INSERT INTO dulwich_path_changes "
+                               "(repos, path_id, ordinal, commit_id, change) "
+                               "VALUES (%s, %s, %s, %s, %s)", path_changes)
+        tokens = [(self.repos_id, token, commit_ids[commit_id])
+                  for commit_id, words in self.tokens
+                  if commit_id not in flushed
+                  for token in words]
+        if tokens:
+            cursor.executemany("INSERT INTO dulwich_tokens "
+                               "(repos, token, commit_id) VALUES (%s, %s, %s)",
+                               tokens)
+        timeline = [commit for commit in self.commits
+                    if commit[1] not in flushed]
+        if timeline:
+            cursor.executemany("INSERT INTO dulwich_timeline "
+                               "(repos, sha, author_time, commit_time) "
+                               "VALUES (%s, %s, %s, %s)", timeline)
+        if heads is not None:
+            cursor.execute("DELETE FROM dulwich_heads WHERE repos=%s",
+                           (self.repos_id,))
+            cursor.executemany("INSERT INTO dulwich_heads (repos, head) "
+                               "VALUES (%s, %s)",
+                               [(self.repos_id, head) for head in heads])
         db.commit()
-        printout('Synchronized %i commits with %i objects' %
-                 (commit_count, object_count))
-        
+        self.object_count += len(inserts)
+        self.objects.clear()
+        del self.commits[:]
+        del self.path_changes[:]
+        del self.tokens[:]
+
+
+def _chunks(values, size):
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _next_prefix(prefix):
+    """Return the first string after all strings that start with
+    `prefix`."""
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def _intern(cursor, repos_id, table, column, values):
+    """Return a dictionary that maps `values` to their id in `table`, adding
+    the values that are not in the table yet.
+
+    New ids are allocated from the highest id in use; this relies on the
+    caller holding the `SyncLock` of the repository.
+    """
+    ids = {}
+    values = list(values)
+    for chunk in _chunks(values, _SyncBatch.chunk_size):
+        cursor.execute("SELECT %s, id FROM %s WHERE repos=%%s AND %s IN (%s)"
+                       % (column, table, column,
+                          ','.join(['%s'] * len(chunk))),
+                       [repos_id] + chunk)
+        ids.update(cursor)
+    missing = [value for value in values if value not in ids]
+    if missing:
+        cursor.execute("SELECT MAX(id) FROM %s WHERE repos=%%s" % table,
+                       (repos_id,))
+        next_id = (cursor.fetchone()[0] or 0) + 1
+        rows = []
+        for value in missing:
+            ids[value] = next_id
+            rows.append((repos_id, next_id, value))
+            next_id += 1
+        cursor.executemany("INSERT INTO %s (repos, id, %s) VALUES (%%s, %%s, "
+                           "%%s)" % (table, column), rows)
+    return ids
 
 
 #####
@@ -156,29 +870,210 @@ class DulwichCacheAdmin(Component):
 #####
 
 class DulwichCache(object):
+    """Lookups in the object cache of a repository.
+
+    A `DulwichCache` lives as long as its repository object, which Trac
+    creates for every request. Results are remembered for that lifetime,
+    including the objects that are not in the cache.
+    """
+
     def __init__(self, repos, log, repos_id, env):
         self.repos = repos
         self.logger = log
         self.env = env
+        self._commits = {} # {(sha, path): commit_id or None}
+        self._shas = {} # {sha: bool}
+        self._heads = None
+        self._has_timeline = None
+        self._path_changes = {} # {path: [(ordinal, commit sha, change)]}
+        self.queries = 0
                 
     def exists(self, sha):
+        if sha not in self._shas:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            self._execute(cursor, "SELECT 1 FROM dulwich_objects "
+                          "WHERE repos=%s AND sha=%s", (self.repos.id, sha))
+            self._shas[sha] = cursor.fetchone() is not None
+        return self._shas[sha]
+
+    def _execute(self, cursor, sql, args):
+        """Run a query, counting it and the time it takes."""
+        start = time.time()
+        cursor.execute(sql, args)
+        self.repos.stats.add_time('sql', time.time() - start)
+        self.repos.stats.count('sql queries')
+        self.queries += 1
+
+    def get_commit_shas_for_objects(self, objects):
+        """Return a dictionary that maps `(sha, path)` pairs of the given
+        objects to the commit that introduced them, for all objects that are
+        in the cache.
+        """
+        wanted = set((sha, path.strip('/')) for sha, path in objects)
+        missing = [key for key in wanted if key not in self._commits]
+        if missing:
+            self._fetch(missing)
+        result = {}
+        for key in wanted:
+            commit_id = self._commits[key]
+            if commit_id is not None:
+                result[key] = commit_id
+        self.repos.stats.count('cache hits', len(result))
+        self.repos.stats.count('cache misses', len(wanted) - len(result))
+        return result
+
+    def get_commit_sha_for_object(self, sha, path):
+        key = (sha, path.strip('/'))
+        if key not in self._commits:
+            self._fetch([key])
+        commit_id = self._commits[key]
+        if commit_id is None:
+            self.repos.stats.count('cache misses')
+            self.logger.debug("Object %s not in cache!" % (sha))
+        else:
+            self.repos.stats.count('cache hits')
+        return commit_id
+
+    def _fetch(self, keys):
+        keys = set(keys)
+        shas = list(set(sha for sha, path in keys))
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-        cursor.execute("SELECT sha FROM dulwich_objects WHERE repos=%s", (self.repos.id,))
-        sha = cursor.fetchone()
-        if sha:
-            return sha[0]
-        else:
-            return None
-                
-    def get_commit_sha_for_object(self, sha):
+        for chunk in _chunks(shas, _SyncBatch.chunk_size):
+            self._execute(cursor,
+                          "SELECT o.sha, p.path, c.sha FROM dulwich_objects o "
+                          "INNER JOIN dulwich_paths p "
+                          "ON (p.repos=o.repos AND p.id=o.path_id) "
+                          "INNER JOIN dulwich_commits c "
+                          "ON (c.repos=o.repos AND c.id=o.commit_id) "
+                          "WHERE o.repos=%%s AND o.sha IN (%s)" %
+                          ','.join(['%s'] * len(chunk)),
+                          [self.repos.id] + chunk)
+            for sha, path, commit_id in cursor:
+                # the other paths of the object are remembered as well
+                self._shas[sha] = True
+                self._commits[(sha, path)] = commit_id
+        for sha, path in keys:
+            self._shas.setdefault(sha, False)
+            self._commits.setdefault((sha, path), None)
+
+    def get_synced_heads(self):
+        """Return the heads stored by the last completed synchronization."""
+        if self._heads is None:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            self._execute(cursor, "SELECT head FROM dulwich_heads "
+                          "WHERE repos=%s", (self.repos.id,))
+            self._heads = [row[0] for row in cursor]
+        return self._heads
+
+    def get_path_changes(self, path):
+        """Return the commits that changed `path`, as `(ordinal, commit sha,
+        change)` tuples in descending order of the commit graph ordinal.
+        """
+        path = path.strip('/')
+        if path not in self._path_changes:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            self._execute(cursor,
+                          "SELECT pc.ordinal, c.sha, pc.change "
+                          "FROM dulwich_path_changes pc "
+                          "INNER JOIN dulwich_paths p "
+                          "ON (p.repos=pc.repos AND p.id=pc.path_id) "
+                          "INNER JOIN dulwich_commits c "
+                          "ON (c.repos=pc.repos AND c.id=pc.commit_id) "
+                          "WHERE pc.repos=%s AND p.path=%s "
+                          "ORDER BY pc.ordinal DESC", (self.repos.id, path))
+            self._path_changes[path] = cursor.fetchall()
+        return self._path_changes[path]
+
+    def has_timeline(self):
+        """Return whether the timeline holds all commits of the last
+        completed synchronization.
+        """
+        if self._has_timeline is None:
+            heads = self.get_synced_heads()
+            self._has_timeline = bool(heads) and \
+                _in_timeline(self.env.get_db_cnx(), self.repos.id, heads)
+        return self._has_timeline
+
+    def get_commits_between(self, start, stop):
+        """Return the `(sha, author_time)` of the commits authored at or
+        after `start` and before `stop` (timestamps), newest first.
+        """
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-        cursor.execute("SELECT commit_id FROM dulwich_objects WHERE repos=%s AND sha=%s", (self.repos.id, sha))
-        item = cursor.fetchone()
-        if item:
-            self.logger.debug("Fetching object %s from cache!" % (sha))
-            return item[0]
-        else:
-            self.logger.info("Object %s not in cache!" % (sha))
+        self._execute(cursor, "SELECT sha, author_time FROM dulwich_timeline "
+                      "WHERE repos=%s AND author_time>=%s AND author_time<%s "
+                      "ORDER BY author_time DESC",
+                      (self.repos.id, start, stop))
+        return [(sha, author_time) for sha, author_time in cursor]
+
+    def search_commits(self, terms):
+        """Return the shas of the commits that have, for every word of the
+        search `terms`, a word in their message, author or committer that
+        starts with it. Returns nothing when the terms have no indexed words.
+        """
+        prefixes = set()
+        for term in terms:
+            prefixes.update(tokenize(term))
+        if not prefixes:
+            return []
+        # A prefix is looked up as a range of the token key, which every
+        # backend answers from the index, unlike LIKE
+        sql = ["SELECT c.sha FROM dulwich_commits c WHERE c.repos=%s"]
+        args = [self.repos.id]
+        for prefix in sorted(prefixes):
+            sql.append("AND c.id IN (SELECT commit_id FROM dulwich_tokens "
+                       "WHERE repos=%s AND token>=%s AND token<%s)")
+            args.extend([self.repos.id, prefix, _next_prefix(prefix)])
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        self._execute(cursor, ' '.join(sql), args)
+        return [row[0] for row in cursor]
+
+    def get_annotations(self, sha, path, renames):
+        """Return the stored annotations of the blob `sha` at `path`,
+        computed with the rename detection settings `renames`, or `None`.
+        """
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        self._execute(cursor, "SELECT revs FROM dulwich_annotations "
+                      "WHERE repos=%s AND sha=%s AND path=%s AND renames=%s",
+                      (self.repos.id, sha, path.strip('/'), renames))
+        row = cursor.fetchone()
+        if not row:
             return None
+        annotations = []
+        for run in row[0].split():
+            commit_id, count = run.split(':')
+            annotations.extend([str(commit_id)] * int(count))
+        return annotations
+
+    def set_annotations(self, sha, path, renames, annotations):
+        runs = []
+        for commit_id in annotations:
+            if runs and runs[-1][0] == commit_id:
+                runs[-1][1] += 1
+            else:
+                runs.append([commit_id, 1])
+        revs = ' '.join('%s:%d' % (commit_id, count)
+                        for commit_id, count in runs)
+        path = path.strip('/')
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        try:
+            cursor.execute("DELETE FROM dulwich_annotations "
+                           "WHERE repos=%s AND sha=%s AND path=%s "
+                           "AND renames=%s",
+                           (self.repos.id, sha, path, renames))
+            cursor.execute("INSERT INTO dulwich_annotations "
+                           "(repos, sha, path, renames, revs) "
+                           "VALUES (%s, %s, %s, %s, %s)",
+                           (self.repos.id, sha, path, renames, revs))
+            db.commit()
+        except Exception, e:
+            # Another request stored the same annotations
+            if 'IntegrityError' not in e.__class__.__name__:
+                raise e
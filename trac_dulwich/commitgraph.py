@@ -0,0 +1,385 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Persistent commit graph index.
+
+The commit graph stores, for every commit reachable from the synchronized
+heads, its parents, its generation number and its commit time. Commits are
+stored in topological order (parents always come before their children), so
+the position of a commit in the file (its ordinal) doubles as a cheap
+ancestry filter: an ancestor always has a lower ordinal and a lower
+generation than its descendants.
+
+The file lives in the repository control directory and is written by
+`trac-admin dulwich sync`. Readers only ever see complete files, as the
+index is written to a temporary file and renamed into place.
+"""
+
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+import heapq
+import os
+import struct
+import sys
+import threading
+
+INDEX_DIR = 'trac-dulwich'
+GRAPH_FILE = 'commit-graph'
+
+_MAGIC = 'TDCG'
+_VERSION = 1
+# magic, version, number of commits, number of parent references
+_HEADER = struct.Struct('<4sIII')
+
+
+def index_path(dulwichrepo, name):
+    """Return the path of the index file `name` for a dulwich repository."""
+    return os.path.join(dulwichrepo.controldir(), INDEX_DIR, name)
+
+
+def _read_array(typecode, data, offset, count):
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    values.fromstring(data[offset:end])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values, end
+
+
+def _write_array(fp, values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    fp.write(values.tostring())
+
+
+class _SortedShas(object):
+    """Sequence view over the graph's shas in sorted order, for bisect."""
+
+    def __init__(self, shas, order):
+        self.shas = shas
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        start = self.order[index] * 20
+        return self.shas[start:start + 20]
+
+
+class CommitGraph(object):
+    """In-memory view of a commit graph index.
+
+    Commits are addressed by their ordinal; use `ordinal()` to translate a
+    hex sha into an ordinal and `sha()` for the reverse.
+    """
+
+    def __init__(self, shas='', generations=None, times=None,
+                 parent_offsets=None, parents=None):
+        self.shas = shas
+        self.generations = generations or array('I')
+        self.times = times or array('d')
+        self.parent_offsets = parent_offsets or array('I', [0])
+        self.parent_list = parents or array('I')
+        self._sorted = None
+        self._children = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.generations)
+
+    def __contains__(self, sha):
+        return self.ordinal(sha) is not None
+
+    # Reading and writing
+
+    @classmethod
+    def read(cls, path):
+        fp = open(path, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        magic, version, count, parent_count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("%s is not a commit graph index" % path)
+        offset = _HEADER.size
+        shas = data[offset:offset + 20 * count]
+        offset += 20 * count
+        generations, offset = _read_array('I', data, offset, count)
+        times, offset = _read_array('d', data, offset, count)
+        parent_offsets, offset = _read_array('I', data, offset, count + 1)
+        parents, offset = _read_array('I', data, offset, parent_count)
+        order, offset = _read_array('I', data, offset, count)
+        graph = cls(shas, generations, times, parent_offsets, parents)
+        graph._sorted = _SortedShas(shas, order)
+        return graph
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fp = open(tmp_path, 'wb')
+        try:
+            fp.write(_HEADER.pack(_MAGIC, _VERSION, len(self),
+                                  len(self.parent_list)))
+            fp.write(self.shas)
+            _write_array(fp, self.generations)
+            _write_array(fp, self.times)
+            _write_array(fp, self.parent_offsets)
+            _write_array(fp, self.parent_list)
+            _write_array(fp, self._get_sorted().order)
+        finally:
+            fp.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    # Lookups
+
+    def _get_sorted(self):
+        if self._sorted is None:
+            shas = self.shas
+            order = array('I', sorted(xrange(len(self)),
+                                      key=lambda o: shas[o * 20:o * 20 + 20]))
+            self._sorted = _SortedShas(shas, order)
+        return self._sorted
+
+    def ordinal(self, sha):
+        """Return the ordinal of the commit with hex `sha`, or `None`."""
+        if not sha or len(sha) != 40:
+            return None
+        try:
+            binsha = unhexlify(sha)
+        except TypeError:
+            return None
+        view = self._get_sorted()
+        index = bisect_left(view, binsha)
+        if index < len(view) and view[index] == binsha:
+            return view.order[index]
+        return None
+
+    def sha(self, ordinal):
+        return hexlify(self.shas[ordinal * 20:ordinal * 20 + 20])
+
+    def parents(self, ordinal):
+        return self.parent_list[self.parent_offsets[ordinal]:
+                                self.parent_offsets[ordinal + 1]]
+
+    def children(self, ordinal):
+        if self._children is None:
+            self._lock.acquire()
+            try:
+                if self._children is None:
+                    children = [()] * len(self)
+                    for child in xrange(len(self)):
+                        for parent in self.parents(child):
+                            children[parent] += (child,)
+                    self._children = children
+            finally:
+                self._lock.release()
+        return self._children[ordinal]
+
+    def generation(self, ordinal):
+        return self.generations[ordinal]
+
+    def commit_time(self, ordinal):
+        return self.times[ordinal]
+
+    # Graph queries
+
+    def is_ancestor(self, ancestor, descendant):
+        """Return whether ordinal `ancestor` is reachable from `descendant`.
+
+        A commit is considered to be its own ancestor. The search only visits
+        commits whose generation is not lower than that of `ancestor`.
+        """
+        if ancestor == descendant:
+            return True
+        if ancestor > descendant or \
+                self.generations[ancestor] >= self.generations[descendant]:
+            return False
+        generation = self.generations[ancestor]
+        seen = set([descendant])
+        stack = [descendant]
+        while stack:
+            for parent in self.parents(stack.pop()):
+                if parent == ancestor:
+                    return True
+                if parent in seen or parent < ancestor or \
+                        self.generations[parent] <= generation:
+                    continue
+                seen.add(parent)
+                stack.append(parent)
+        return False
+
+    def oldest(self):
+        """Return the ordinal of the oldest root commit."""
+        if not len(self):
+            return None
+        return 0
+
+    def previous(self, ordinal):
+        """Return the parent that a date ordered walk visits next."""
+        parents = self.parents(ordinal)
+        if not parents:
+            return None
+        return max(parents, key=lambda p: (self.times[p], p))
+
+    def next(self, ordinal, head):
+        """Return the oldest child of `ordinal` that is reachable from
+        `head`.
+        """
+        children = [c for c in self.children(ordinal)
+                    if self.is_ancestor(c, head)]
+        if not children:
+            return None
+        return min(children, key=lambda c: (self.times[c], c))
+
+    def iter_ancestors(self, ordinal):
+        """Generate the ancestors of `ordinal` (inclusive), newest first."""
+        seen = set([ordinal])
+        queue = [(-self.times[ordinal], -ordinal)]
+        while queue:
+            current = -heapq.heappop(queue)[1]
+            yield current
+            for parent in self.parents(current):
+                if parent not in seen:
+                    seen.add(parent)
+                    heapq.heappush(queue, (-self.times[parent], -parent))
+
+    def filter_ancestors(self, ordinal, candidates):
+        """Generate the ordinals in `candidates` that are ancestors of
+        `ordinal` (inclusive). `candidates` must be in descending order.
+
+        Ancestors are visited in descending ordinal order, and only down to
+        the last candidate that is consumed: every path from `ordinal` to a
+        candidate only passes through higher ordinals.
+        """
+        seen = set([ordinal])
+        queue = [-ordinal]
+        for candidate in candidates:
+            while queue and -queue[0] > candidate:
+                for parent in self.parents(-heapq.heappop(queue)):
+                    if parent not in seen:
+                        seen.add(parent)
+                        heapq.heappush(queue, -parent)
+            if candidate in seen:
+                yield candidate
+
+    # Building
+
+    def extend(self, object_store, heads):
+        """Return a new graph that also contains every commit reachable from
+        the hex shas in `heads`.
+
+        Only commits that are not yet in the graph are read from the object
+        store. Returns the new graph and the number of commits added.
+        """
+        commits = {}
+        stack = [sha for sha in heads if self.ordinal(sha) is None]
+        while stack:
+            sha = stack.pop()
+            if sha in commits:
+                continue
+            commit = object_store[sha]
+            commits[sha] = (commit.commit_time, commit.parents)
+            for parent in commit.parents:
+                if parent not in commits and self.ordinal(parent) is None:
+                    stack.append(parent)
+        if not commits:
+            return self, 0
+
+        # Kahn's algorithm, visiting the oldest ready commit first
+        pending = dict((sha, 0) for sha in commits)
+        children = {}
+        for sha, (commit_time, parents) in commits.iteritems():
+            for parent in parents:
+                if parent in commits:
+                    pending[sha] += 1
+                    children.setdefault(parent, []).append(sha)
+        ready = [(commits[sha][0], sha) for sha, count in pending.iteritems()
+                 if count == 0]
+        heapq.heapify(ready)
+
+        shas = [self.shas]
+        generations = array('I', self.generations)
+        times = array('d', self.times)
+        parent_offsets = array('I', self.parent_offsets)
+        parent_list = array('I', self.parent_list)
+        ordinals = {}
+        while ready:
+            commit_time, sha = heapq.heappop(ready)
+            generation = 0
+            for parent in commits[sha][1]:
+                if parent in ordinals:
+                    parent_ordinal = ordinals[parent]
+                else:
+                    parent_ordinal = self.ordinal(parent)
+                parent_list.append(parent_ordinal)
+                generation = max(generation, generations[parent_ordinal])
+            ordinals[sha] = len(generations)
+            shas.append(unhexlify(sha))
+            generations.append(generation + 1)
+            times.append(commit_time)
+            parent_offsets.append(len(parent_list))
+            for child in children.get(sha, ()):
+                pending[child] -= 1
+                if pending[child] == 0:
+                    heapq.heappush(ready, (commits[child][0], child))
+
+        graph = CommitGraph(''.join(shas), generations, times,
+                            parent_offsets, parent_list)
+        return graph, len(commits)
+
+
+_graph_cache = {}
+_graph_cache_lock = threading.Lock()
+
+
+def load_commit_graph(dulwichrepo):
+    """Return the commit graph for a repository, or `None` if the index has
+    not been built yet.
+
+    Graphs are shared between all repository instances of a process and are
+    reloaded when the file on disk changes.
+    """
+    path = index_path(dulwichrepo, GRAPH_FILE)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = (st.st_mtime, st.st_size, st.st_ino)
+    _graph_cache_lock.acquire()
+    try:
+        cached = _graph_cache.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+    finally:
+        _graph_cache_lock.release()
+    try:
+        graph = CommitGraph.read(path)
+    except (IOError, ValueError, struct.error):
+        return None
+    _graph_cache_lock.acquire()
+    try:
+        _graph_cache[path] = (signature, graph)
+    finally:
+        _graph_cache_lock.release()
+    return graph
+
+
+def update_commit_graph(dulwichrepo, heads):
+    """Extend the on-disk commit graph with every commit reachable from
+    `heads` and return the updated graph and the number of added commits.
+    """
+    graph = load_commit_graph(dulwichrepo) or CommitGraph()
+    graph, added = graph.extend(dulwichrepo.object_store, heads)
+    if added or not os.path.exists(index_path(dulwichrepo, GRAPH_FILE)):
+        graph.write(index_path(dulwichrepo, GRAPH_FILE))
+    return graph, added
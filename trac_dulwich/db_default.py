@@ -1,19 +1,122 @@
-from trac.db import Table, Column
+from trac.db import Table, Column, Index
 
 name = 'dulwich'
-version = 1
+version = 7
 tables = [
-    Table('dulwich_objects', key=('repos', 'sha', 'path', 'commit_id'))[
+    # Paths and commits are stored once per repository, the objects refer to
+    # them by their id
+    Table('dulwich_paths', key=('repos', 'id'))[
+        Column('repos', type="int"),
+        Column('id', type="int"),
+        Column('path', key_size=255),
+        Index(['repos', 'path']),
+    ],
+    Table('dulwich_commits', key=('repos', 'id'))[
+        Column('repos', type="int"),
+        Column('id', type="int"),
+        Column('sha', key_size=40),
+        Index(['repos', 'sha'], unique=True),
+    ],
+    Table('dulwich_objects', key=('repos', 'sha', 'path_id'))[
         Column('repos', type="int"),
         Column('sha', key_size=40),
-        Column('path'),
+        Column('path_id', type="int"),
         Column('mode', type='integer'),
-        Column('commit_id', key_size=40),
+        Column('commit_id', type="int"),
+        Index(['repos', 'path_id', 'commit_id']),
     ],
     Table('dulwich_heads', key=('repos', 'head'))[
         Column('repos', type="int"),
         Column('head', key_size=40),
     ],
+    # Dates of the synchronized commits, for the timeline
+    Table('dulwich_timeline', key=('repos', 'sha'))[
+        Column('repos', type="int"),
+        Column('sha', key_size=40),
+        Column('author_time', type="int64"),
+        Column('commit_time', type="int64"),
+        Index(['repos', 'author_time']),
+    ],
+    # The files and directories changed by each commit, for the history of
+    # a path. Commits are ordered by their ordinal in the commit graph.
+    Table('dulwich_path_changes', key=('repos', 'path_id', 'ordinal'))[
+        Column('repos', type="int"),
+        Column('path_id', type="int"),
+        Column('ordinal', type="int"),
+        Column('commit_id', type="int"),
+        Column('change'),
+    ],
+    # The words of the message, author and committer of each commit, for
+    # the search
+    Table('dulwich_tokens', key=('repos', 'token', 'commit_id'))[
+        Column('repos', type="int"),
+        Column('token', key_size=64),
+        Column('commit_id', type="int"),
+    ],
+    # Line annotations of a file, as run-length encoded commit shas, for
+    # the rename detection settings they were computed with
+    Table('dulwich_annotations', key=('repos', 'sha', 'path', 'renames'))[
+        Column('repos', type="int"),
+        Column('sha', key_size=40),
+        Column('path', key_size=255),
+        Column('renames', key_size=64),
+        Column('revs'),
+    ],
 ]
 
-migrations = []
\ No newline at end of file
+def intern_rows(old_data):
+    """Intern the paths and commits of the version 1 object cache."""
+    if 'dulwich_objects' not in old_data:
+        return
+    columns, rows = old_data['dulwich_objects']
+    paths = {}
+    commits = {}
+    objects = {}
+    for row in rows:
+        row = dict(zip(columns, row))
+        repos = row['repos']
+        path_key = (repos, row['path'])
+        path_id = paths.get(path_key)
+        if path_id is None:
+            path_id = paths[path_key] = len(paths) + 1
+        commit_key = (repos, row['commit_id'])
+        commit_id = commits.get(commit_key)
+        if commit_id is None:
+            commit_id = commits[commit_key] = len(commits) + 1
+        objects[(repos, row['sha'], path_id)] = (row['mode'], commit_id)
+    old_data['dulwich_paths'] = (
+        ['repos', 'id', 'path'],
+        [(repos, path_id, path)
+         for (repos, path), path_id in paths.iteritems()])
+    old_data['dulwich_commits'] = (
+        ['repos', 'id', 'sha'],
+        [(repos, commit_id, sha)
+         for (repos, sha), commit_id in commits.iteritems()])
+    old_data['dulwich_objects'] = (
+        ['repos', 'sha', 'path_id', 'mode', 'commit_id'],
+        [(repos, sha, path_id, mode, commit_id)
+         for (repos, sha, path_id), (mode, commit_id)
+         in objects.iteritems()])
+
+def drop_sync_state(old_data):
+    """Make the next sync process the complete history again, to fill the
+    path change index."""
+    for name in ('dulwich_heads', 'dulwich_timeline'):
+        old_data.pop(name, None)
+
+def drop_timeline(old_data):
+    """Make the next sync fill the timeline again, together with the
+    commit message index."""
+    old_data.pop('dulwich_timeline', None)
+
+def drop_annotations(old_data):
+    """Drop the annotations, which do not record the rename detection
+    settings they were computed with."""
+    old_data.pop('dulwich_annotations', None)
+
+migrations = [
+    (xrange(1, 2), intern_rows),
+    (xrange(1, 5), drop_sync_state),
+    (xrange(5, 6), drop_timeline),
+    (xrange(1, 7), drop_annotations),
+]
@@ -4,22 +4,43 @@
 #
 
 from trac.core import *
-from trac.config import BoolOption, Option
+from trac.config import BoolOption, IntOption, Option
+from trac.resource import Resource
 from trac.util.datefmt import FixedOffset, to_timestamp, format_datetime
 from trac.versioncontrol.api import Changeset, Node, Repository, \
                                     IRepositoryConnector, NoSuchChangeset, \
                                     NoSuchNode
 
 import dulwich.diff_tree
-from dulwich.objects import Blob, Commit, Tree
-from dulwich.repo import Repo
+from dulwich.objects import S_ISGITLINK, Tree
 import dulwich.walk
 
+from annotate import annotate, find_rename
+from blobstream import get_blob_size, open_blob
 from cache import DulwichCache
+from commitgraph import load_commit_graph
+from objectcache import LRUObjectCache, get_object_cache, open_repository
+from pathfilter import PathFilteredWalker, load_path_filters
+from reachability import iter_ordinals, load_reachability, peel
+from refcache import get_ref_snapshot
+from shaindex import MIN_ABBREV, get_sha_index
+from stats import NULL_STATS, Stats, instrument_repository, \
+                  instrument_walker, save_stats, stats_path
+from renames import SimilarityRenameDetector
 
 from datetime import datetime
+import posixpath
+import stat
 from StringIO import StringIO
 
+# Maximum number of objects that an abbreviated sha is resolved among
+MAX_CANDIDATES = 16
+
+# Memoized changes of changesets, shared by all repositories
+_changeset_changes = LRUObjectCache(8 * 1024 * 1024)
+# {(repository path, blob sha, path, rename key): [commit_id, ...]}
+_annotations = LRUObjectCache(8 * 1024 * 1024)
+
 # Utils from TracGit
 
 def _last_iterable(iterable):
@@ -32,11 +53,102 @@ def _last_iterable(iterable):
     yield True, v
 
 
+def _iter_changes(changes):
+    """Flatten the changes of a walk entry, which are nested lists for
+    merge commits.
+    """
+    for change in changes:
+        if isinstance(change, list):
+            for merge_change in change:
+                if merge_change is not None:
+                    yield merge_change
+        else:
+            yield change
+
+
+def _combined_tree_changes(store, tree_id, parent_tree_ids, path=''):
+    """Generate the paths of a merge tree that differ from all parents.
+
+    The merge tree and its parent trees are walked simultaneously. As soon
+    as an entry (blob or subtree) equals the entry of any parent, it is
+    skipped without descending any further. Yields
+    `(path, entry, parent_entries)` for every file, where the entries are
+    `(mode, sha)` tuples or `None` if the file does not exist on that side.
+    """
+    def entries(tree_id):
+        if tree_id is None:
+            return {}
+        return dict((name, (mode, sha)) for name, mode, sha
+                    in store[tree_id].iteritems())
+
+    tree = entries(tree_id)
+    parents = [entries(parent_id) for parent_id in parent_tree_ids]
+    names = set(tree)
+    for parent in parents:
+        names.update(parent)
+
+    for name in sorted(names):
+        entry = tree.get(name)
+        parent_entries = [parent.get(name) for parent in parents]
+        if entry in parent_entries:
+            continue
+        subpath = path and path + '/' + name or name
+
+        def subtree(entry):
+            if entry is not None and stat.S_ISDIR(entry[0]):
+                return entry[1]
+            return None
+
+        def blob(entry):
+            if entry is not None and not stat.S_ISDIR(entry[0]):
+                return entry
+            return None
+
+        if subtree(entry) or any(map(subtree, parent_entries)):
+            for change in _combined_tree_changes(
+                    store, subtree(entry), map(subtree, parent_entries),
+                    subpath):
+                yield change
+        blob_entry = blob(entry)
+        blob_parents = map(blob, parent_entries)
+        if (blob_entry is not None or any(blob_parents)) and \
+                blob_entry not in blob_parents:
+            yield subpath, blob_entry, blob_parents
+
+
 class DulwichConnector(Component):
     implements(IRepositoryConnector)
 
     _enable_cache = BoolOption('dulwich', 'enable_cache', 'false',
                                'enable caching of the repositories')
+
+    _object_cache_size = IntOption('dulwich', 'object_cache_size',
+                                   32 * 1024 * 1024,
+        """Maximum size in bytes of the process wide cache of parsed commits
+        and trees. Set to 0 to disable the cache.""")
+
+    _detect_renames = BoolOption('dulwich', 'detect_renames', 'false',
+        """Detect renamed and copied files in changesets, and follow them in
+        the history of a file.""")
+
+    _detect_copies = BoolOption('dulwich', 'detect_copies', 'false',
+        """Also consider unmodified files as the source of copies. This is
+        considerably more expensive. Only used with `detect_renames`.""")
+
+    _rename_threshold = IntOption('dulwich', 'rename_threshold', 60,
+        """Minimum similarity, in percent, of a deleted and an added file to
+        be reported as a rename or copy.""")
+
+    _rename_max_pairs = IntOption('dulwich', 'rename_max_pairs', 10000,
+        """Maximum number of file pairs that are compared for content
+        similarity in a single changeset.""")
+
+    _instrumentation = BoolOption('dulwich', 'instrumentation', 'false',
+        """Count and time history walks, object reads, tree lookups and
+        cache queries. The statistics of every request are logged at debug
+        level, and their totals are shown by `trac-admin dulwich stats`.
+        Every process adds its statistics to the totals at most once a
+        minute.""")
     
     def __init__(self):
         self.log.info("Dulwich plugin loaded")
@@ -49,61 +161,253 @@ class DulwichConnector(Component):
     
     def get_repository(self, type, directory, params):
         assert type =="dulwich"
-        return DulwichRepository(directory, params, self.log, self._enable_cache, self.env)
+        object_cache = None
+        if self._object_cache_size > 0:
+            object_cache = get_object_cache(self._object_cache_size)
+        rename_detection = None
+        if self._detect_renames:
+            rename_detection = {'rename_threshold': self._rename_threshold,
+                                'max_pairs': self._rename_max_pairs,
+                                'find_copies_harder': self._detect_copies}
+        stats = None
+        if self._instrumentation:
+            stats = Stats()
+        return DulwichRepository(directory, params, self.log, self._enable_cache, self.env,
+                                 object_cache, rename_detection, stats)
 
 class DulwichRepository(Repository):
-    def __init__(self, path, params, log, cache, env):
+    def __init__(self, path, params, log, cache, env, object_cache=None,
+                 rename_detection=None, stats=None):
         self.params = params
+        self.rename_detection = rename_detection
         self.path = path
         self.logger = log
-        self.dulwichrepo = Repo(path)
+        self.object_cache = object_cache
+        self.stats = stats or NULL_STATS
+        self.dulwichrepo = open_repository(path, object_cache, self.stats)
+        if self.stats.enabled:
+            instrument_repository(self.dulwichrepo, self.stats)
+            self._stats_path = stats_path(env, params['id'])
         if cache:
             self.cache = DulwichCache(self, log, params['id'], env)
         else:
             self.cache = None
+        self._commit_graph = None
+        self._ref_snapshot = None
+        self._path_filters = None
+        self._reachability = None
+        self._sha_index = None
+        self._short_revs = {}
+        self._indexed = {} # {ordinal: bool}
         Repository.__init__(self, "dulwich:"+path, self.params, log)
     
     def close(self):
+        if self.object_cache is not None:
+            self.logger.debug("Dulwich object cache: %d hits, %d misses, "
+                              "%d objects, %d bytes",
+                              self.object_cache.hits, self.object_cache.misses,
+                              len(self.object_cache), self.object_cache.size)
+        if self.cache is not None:
+            self.logger.debug("Dulwich cache: %d queries", self.cache.queries)
+        if self.stats.enabled:
+            self.logger.debug("Dulwich statistics: %s", self.stats.format())
+            save_stats(self._stats_path, self.stats, self.logger)
+            self.dulwichrepo.object_store.stats = NULL_STATS
         self.dulwichrepo = None
+
+    def get_rename_detector(self):
+        """Return a rename detector, or `None` if rename detection is
+        disabled.
+        """
+        if self.rename_detection is None:
+            return None
+        return SimilarityRenameDetector(self.dulwichrepo.object_store,
+                                        **self.rename_detection)
+
+    def get_rename_key(self):
+        """Return a string that identifies the rename detection settings,
+        for the results that depend on them.
+        """
+        if self.rename_detection is None:
+            return ''
+        return '%(rename_threshold)d:%(max_pairs)d:%(find_copies_harder)d' \
+               % self.rename_detection
+    rename_key = property(get_rename_key)
+
+    def get_commit_graph(self):
+        """Return the commit graph index, or `None` if it was not built."""
+        if self._commit_graph is None:
+            self._commit_graph = load_commit_graph(self.dulwichrepo)
+        return self._commit_graph
+    commit_graph = property(get_commit_graph)
+
+    def get_path_filters(self):
+        """Return the changed-path filters, or `None` if they were not built
+        for the current commit graph.
+        """
+        if self._path_filters is None:
+            graph = self.commit_graph
+            if graph is not None:
+                self._path_filters = load_path_filters(self.dulwichrepo,
+                                                       graph)
+        return self._path_filters
+    path_filters = property(get_path_filters)
+
+    def _get_path_walker(self, include, paths, **kwargs):
+        """Return a walker of the commits reachable from `include` that
+        changed one of `paths`. The changed-path filters, when built, rule
+        out most commits without comparing their trees.
+        """
+        filters = self.path_filters
+        if filters is None:
+            return self.dulwichrepo.get_walker(include=include, paths=paths,
+                                               **kwargs)
+        repo = self.dulwichrepo
+        walker = PathFilteredWalker(
+            repo.object_store, include, filters, self.commit_graph,
+            self.stats, paths=paths,
+            get_parents=lambda commit: repo.get_parents(commit.id, commit),
+            **kwargs)
+        if self.stats.enabled:
+            walker = instrument_walker(walker, self.stats)
+        return walker
+
+    def _may_have_changed(self, commit_id, path):
+        """Return `False` if the changed-path filters tell that `path` is the
+        same in the commit `commit_id` and its first parent.
+        """
+        filters = self.path_filters
+        if filters is None:
+            return True
+        return filters.may_have_changed(self.commit_graph.ordinal(commit_id),
+                                        [path])
+
+    def get_ref_snapshot(self):
+        """Return the refs of the repository, read once per repository
+        object.
+        """
+        if self._ref_snapshot is None:
+            self._ref_snapshot = get_ref_snapshot(self.dulwichrepo)
+        return self._ref_snapshot
+    ref_snapshot = property(get_ref_snapshot)
+
+    def get_reachability(self):
+        """Return the reachability bitmaps of the refs, or `None` if they
+        were not built for the current commit graph.
+        """
+        if self._reachability is None:
+            graph = self.commit_graph
+            if graph is not None:
+                self._reachability = load_reachability(self.dulwichrepo,
+                                                       graph)
+        return self._reachability
+    reachability = property(get_reachability)
+
+    def get_containing_refs(self, rev):
+        """Return the sorted names of the refs below `refs/` whose history
+        contains the commit `rev`.
+
+        The refs are only answered from the reachability bitmaps, so this is
+        cheap enough for every changeset page. Refs that moved since the last
+        synchronization, and all refs without a reachability index, are left
+        out rather than walking their history.
+        """
+        graph = self.commit_graph
+        index = self.reachability
+        if graph is None or index is None:
+            return []
+        ordinal = graph.ordinal(rev)
+        if ordinal is None:
+            return []
+        return [name for name, sha
+                in sorted(self.ref_snapshot.refs.iteritems())
+                if index.contains(name, sha, ordinal)]
+
+    def get_missing_revs(self, include, exclude):
+        """Return the commits reachable from `include` but not from
+        `exclude`, like `git log exclude..include`.
+
+        When both revisions are the commit of a ref, the commits are the
+        difference of their reachability bitmaps, in descending order of the
+        commit graph. Otherwise the history is walked, newest first.
+        """
+        include = self.normalize_rev(include)
+        exclude = self.normalize_rev(exclude)
+        graph = self.commit_graph
+        index = self.reachability
+        if index is not None:
+            bits = index.difference(graph.ordinal(include),
+                                    graph.ordinal(exclude))
+            if bits is not None:
+                return [graph.sha(ordinal) for ordinal in iter_ordinals(bits)]
+        return [walk.commit.id for walk in
+                self.dulwichrepo.get_walker(include=[include],
+                                            exclude=[exclude])]
+
+    def get_sha_index(self):
+        """Return the index of the object names, for abbreviated shas."""
+        if self._sha_index is None:
+            self._sha_index = get_sha_index(self.dulwichrepo)
+        return self._sha_index
+    sha_index = property(get_sha_index)
     
     def get_quickjump_entries(self, rev):
         """Retrieve known branches, as (name, id) pairs.
 
         For now, ignores `rev` and always takes the last revision.
         """
-        refs = self.dulwichrepo.get_refs()
-        # sort the refs
-        branches = []
-        tags = []
-        remotes = []
-        
-        for key in refs.keys():
-            if key.startswith("refs/heads/"):
-                branches.append(key)
-            elif key.startswith("refs/tags/"):
-                tags.append(key)
-            elif key.startswith("refs/remotes/"):
-                remotes.append(key)
-
-        for n in sorted(branches):
-            yield 'branches', n[11:], '/', refs[n]
-        for n in sorted(tags):
-            yield 'tags', n[10:], '/', refs[n]
-        for n in sorted(remotes):
-            yield 'remotes', n[13:], '/', refs[n]
+        refs = self.ref_snapshot
+        for name, sha in refs.branches:
+            yield 'branches', name, '/', sha
+        for name, sha in refs.tags:
+            yield 'tags', name, '/', sha
+        for name, sha in refs.remotes:
+            yield 'remotes', name, '/', sha
         
     
     def get_changeset(self, rev):
         return DulwichChangeset(self, rev)    
 
+    def get_changesets(self, start, stop):
+        if not self.cache or not self.cache.has_timeline():
+            # before the first synchronization, and while the timeline of an
+            # older cache is not filled yet
+            for changeset in Repository.get_changesets(self, start, stop):
+                yield changeset
+            return
+        start = to_timestamp(start)
+        stop = to_timestamp(stop)
+        commits = self.cache.get_commits_between(start, stop)
+        # the commits since the last synchronization are not in the timeline
+        synced = [sha for sha in self.cache.get_synced_heads()
+                  if sha in self.dulwichrepo]
+        heads = self.ref_snapshot.get_heads()
+        if not set(heads) <= set(synced):
+            known = set(sha for sha, author_time in commits)
+            walker = self.dulwichrepo.get_walker(include=heads,
+                                                 exclude=synced)
+            commits.extend((walk.commit.id, walk.commit.author_time)
+                           for walk in walker
+                           if start <= walk.commit.author_time < stop and
+                              walk.commit.id not in known)
+            commits.sort(key=lambda commit: commit[1], reverse=True)
+        for rev, author_time in commits:
+            try:
+                yield DulwichChangeset(self, rev)
+            except NoSuchChangeset:
+                # the commit was removed from the repository
+                pass
+
     def get_node(self, path, rev=None):
         if not rev:
-            rev = self.dulwichrepo.head()
+            rev = self.ref_snapshot.head
         return DulwichNode(self, path, rev)
     
     def get_oldest_rev(self):
         # Get the oldest rev there is (relative to the current head)
-        # This should absolutely be cached...
+        graph = self.commit_graph
+        if graph is not None and len(graph):
+            return graph.sha(graph.oldest())
         walker = self.dulwichrepo.get_walker()
         rev = None
         for walk in walker:
@@ -111,13 +415,20 @@ class DulwichRepository(Repository):
         return rev
     
     def get_youngest_rev(self):
-        return self.dulwichrepo.head()
+        return self.ref_snapshot.head
 
     def previous_rev(self, rev, path=''):
         if len(path) > 0:
             node = self.get_node(path, rev)
             return node.get_previous_change()
 
+        graph = self.commit_graph
+        if graph is not None:
+            ordinal = graph.ordinal(rev)
+            if ordinal is not None:
+                previous = graph.previous(ordinal)
+                return previous is not None and graph.sha(previous) or None
+
         walker = self.dulwichrepo.get_walker(include=[rev], max_entries=2)
         for walk in walker:
             if rev == walk.commit.id:
@@ -130,7 +441,16 @@ class DulwichRepository(Repository):
             node = self.get_node(path, rev)
             return node.get_next_change()
 
-        walker = self.dulwichrepo.get_walker(include=[self.dulwichrepo.head()],
+        head = self.ref_snapshot.head
+        graph = self.commit_graph
+        if graph is not None:
+            ordinal = graph.ordinal(rev)
+            head_ordinal = graph.ordinal(head)
+            if ordinal is not None and head_ordinal is not None:
+                following = graph.next(ordinal, head_ordinal)
+                return following is not None and graph.sha(following) or None
+
+        walker = self.dulwichrepo.get_walker(include=[head],
                                              exclude=[rev], reverse=True)
         for walk in walker:
             return walk.commit.id
@@ -142,33 +462,318 @@ class DulwichRepository(Repository):
     def rev_older_than(self, rev1, rev2):
         if not rev1 or not rev2:
             return False
+        graph = self.commit_graph
+        if graph is not None:
+            ordinal1 = graph.ordinal(rev1)
+            ordinal2 = graph.ordinal(rev2)
+            if ordinal1 is not None and ordinal2 is not None:
+                return graph.is_ancestor(ordinal1, ordinal2)
         commit1 = self.dulwichrepo[rev1]
         return commit1 in self.dulwichrepo.revision_history(rev2)
         
+    def get_last_changes(self, rev, path, entries):
+        """Find the last change of every entry of a directory at once.
+
+        `entries` is a list of `(name, sha)` pairs of the directory `path` at
+        `rev`. Returns a dictionary that maps the names to the commit that
+        introduced the entry. The cache is consulted with one batched query;
+        the remaining entries are resolved in a single history traversal.
+        """
+        result = {}
+        if self.cache:
+            paths = dict((name, posixpath.join(path.strip('/'),
+                                               name.decode('utf-8')))
+                         for name, sha in entries)
+            commits = self.cache.get_commit_shas_for_objects(
+                [(sha, paths[name]) for name, sha in entries])
+            for name, sha in entries:
+                commit_id = commits.get((sha, paths[name]))
+                if commit_id is not None:
+                    result[name] = commit_id
+
+        pending = dict((name, sha) for name, sha in entries
+                       if name not in result)
+        if not pending:
+            return result
+        path = path.strip('/')
+        repo = self.dulwichrepo
+        for walk in repo.get_walker(include=[rev]):
+            commit = walk.commit
+            if path and not self._may_have_changed(commit.id, path):
+                # the directory is the same as in the first parent
+                continue
+            tree_sha = self._lookup_tree(commit.tree, path)
+            if tree_sha is None:
+                continue
+            parent_trees = [self._lookup_tree(repo[parent].tree, path)
+                            for parent in commit.parents]
+            if tree_sha in parent_trees:
+                # nothing in this directory differs from all the parents
+                continue
+            tree = repo[tree_sha]
+            parent_trees = [repo[sha] for sha in parent_trees
+                            if sha is not None]
+            for name, sha in pending.items():
+                if name not in tree or tree[name][1] != sha:
+                    continue
+                for parent_tree in parent_trees:
+                    if name in parent_tree and parent_tree[name][1] == sha:
+                        break
+                else:
+                    # this commit introduced the entry
+                    result[name] = commit.id
+                    del pending[name]
+            if not pending:
+                break
+        return result
+
+    def _lookup_entry(self, tree_sha, path):
+        """Return the `(mode, sha)` of `path` below the tree `tree_sha`, or
+        `None` if there is no such path.
+        """
+        self.stats.count('tree lookups')
+        mode = stat.S_IFDIR
+        for part in path and path.split('/') or []:
+            if not stat.S_ISDIR(mode):
+                return None
+            tree = self.dulwichrepo[tree_sha]
+            if part not in tree:
+                return None
+            mode, tree_sha = tree[part]
+        return mode, tree_sha
+
+    def _lookup_tree(self, tree_sha, path):
+        """Return the sha of the tree at `path` below the tree `tree_sha`,
+        or `None` if there is no such tree.
+        """
+        entry = self._lookup_entry(tree_sha, path)
+        if entry is None or not stat.S_ISDIR(entry[0]):
+            return None
+        return entry[1]
+
+    def _iter_path_changes(self, rev, path):
+        """Generate `(commit_id, change)` for the commits reachable from `rev`
+        that changed `path`, newest first.
+        """
+        changes = self._indexed_path_changes(rev, path)
+        if changes is None:
+            changes = self._walk_path_changes(rev, path)
+        return changes
+
+    def _indexed_path_changes(self, rev, path):
+        """Return an iterator of `(commit_id, change)` for the commits
+        reachable from `rev` that changed `path`, in descending order of the
+        commit graph, from the path change index of the cache.
+
+        Returns `None` when the index cannot answer: without cache or commit
+        graph, for the root directory, and when `rev` is not synchronized
+        yet.
+        """
+        path = path.strip('/')
+        if not self.cache or not path:
+            return None
+        graph = self.commit_graph
+        if graph is None:
+            return None
+        ordinal = graph.ordinal(rev)
+        if ordinal is None or not self._is_indexed(graph, ordinal):
+            return None
+        rows = self.cache.get_path_changes(path)
+        changes = {}
+        for row_ordinal, commit_id, change in rows:
+            if row_ordinal >= len(graph) or \
+                    graph.sha(row_ordinal) != commit_id:
+                # the commit graph was rebuilt since the synchronization
+                return None
+            changes[row_ordinal] = change
+        self.stats.count('indexed histories')
+        return ((graph.sha(o), changes[o]) for o in
+                graph.filter_ancestors(ordinal, [row[0] for row in rows]))
+
+    def _is_indexed(self, graph, ordinal):
+        """Return whether the commit `ordinal` and all its ancestors are in
+        the path change index, that is, whether it is reachable from the
+        heads of the last completed synchronization.
+        """
+        if ordinal not in self._indexed:
+            heads = [graph.ordinal(head)
+                     for head in self.cache.get_synced_heads()]
+            self._indexed[ordinal] = any(graph.is_ancestor(ordinal, head)
+                                         for head in heads
+                                         if head is not None)
+        return self._indexed[ordinal]
+
+    def _walk_path_changes(self, rev, path):
+        """Generate `(commit_id, change)` for the commits reachable from `rev`
+        that changed `path`, newest first, by walking the history.
+
+        Like the dulwich walker, a merge only counts as a change when the
+        path differs from all of its parents. Only the entries along `path`
+        are compared, so unrelated subtrees are never read.
+        """
+        repo = self.dulwichrepo
+        for walk in repo.get_walker(include=[rev]):
+            commit = walk.commit
+            if not self._may_have_changed(commit.id, path):
+                continue
+            entry = self._lookup_entry(commit.tree, path)
+            parent_entries = [self._lookup_entry(repo[parent].tree, path)
+                              for parent in commit.parents]
+            if entry in parent_entries or \
+                    (entry is None and not any(parent_entries)):
+                continue
+            if entry is None:
+                change = Changeset.DELETE
+            elif any(parent_entries):
+                change = Changeset.EDIT
+            else:
+                change = Changeset.ADD
+            yield commit.id, change
+
     def get_path_history(self, path, rev=None, limit=None):
-        raise NotImplementedError
+        path = self.normalize_path(path)
+        if path == '/':
+            path = ''
+        if not rev:
+            rev = self.ref_snapshot.head
+        count = 0
+        for commit_id, change in self._iter_path_changes(rev, path):
+            yield '/' + path, commit_id, change
+            count += 1
+            if limit and count >= limit:
+                break
     
+    def get_annotations(self, rev, path, sha):
+        """Return the commit that introduced each line of the blob `sha`,
+        which is the file `path` at `rev`.
+        """
+        path = path.strip('/')
+        annotations = self._get_known_annotations(sha, path)
+        if annotations is None:
+            self.stats.count('files annotated')
+            annotations = annotate(self, rev, path, sha,
+                                   self._get_known_annotations)
+            _annotations.put((self.path, sha, path, self.rename_key),
+                             annotations, len(annotations) * 8 + 256)
+            if self.cache:
+                self.cache.set_annotations(sha, path, self.rename_key,
+                                           annotations)
+        return annotations
+
+    def _get_known_annotations(self, sha, path):
+        key = (self.path, sha, path, self.rename_key)
+        annotations = _annotations.get(key)
+        if annotations is None and self.cache:
+            annotations = self.cache.get_annotations(sha, path,
+                                                     self.rename_key)
+            if annotations is not None:
+                _annotations.put(key, annotations,
+                                 len(annotations) * 8 + 256)
+        return annotations
+
     def normalize_rev(self, rev):
         if not rev:
-            return self.dulwichrepo.head()
-        test = self.dulwichrepo.get_object(rev)
-        if not isinstance(test, Commit):
+            return self.ref_snapshot.head
+        sha = self._resolve_rev(rev)
+        if sha is None:
             raise NoSuchChangeset(rev)
-        return rev 
+        return sha
 
+    def _resolve_rev(self, rev):
+        """Return the sha of the commit named by `rev`, which is a full or
+        abbreviated sha, or the name of a branch, tag or other ref. As in
+        git, a full sha comes before a ref name, and a ref name before an
+        abbreviated sha.
+        """
+        if isinstance(rev, unicode):
+            rev = rev.encode('utf-8')
+        rev = str(rev)
+        is_hex = MIN_ABBREV <= len(rev) <= 40 and \
+                 not rev.lower().strip('0123456789abcdef')
+        if is_hex and len(rev) == 40 and rev.lower() in self.dulwichrepo:
+            return self._peel(rev.lower())
+        refs = self.ref_snapshot.refs
+        for name in (rev, 'refs/' + rev, 'refs/tags/' + rev,
+                     'refs/heads/' + rev, 'refs/remotes/' + rev):
+            if name in refs:
+                return self._peel(refs[name])
+        if not is_hex:
+            return None
+        # an ambiguous prefix is accepted when only one of the objects is a
+        # commit, or a tag of one. A prefix of more objects than are checked
+        # is ambiguous.
+        shas = self.sha_index.lookup(rev, limit=MAX_CANDIDATES + 1)
+        if len(shas) > MAX_CANDIDATES:
+            return None
+        commits = set()
+        for sha in shas:
+            commit_id = self._peel(sha)
+            if commit_id is not None:
+                commits.add(commit_id)
+        if len(commits) != 1:
+            return None
+        return commits.pop()
+
+    def _peel(self, sha):
+        return peel(self.dulwichrepo, sha)
     
     def short_rev(self, rev):
-        #NOTE: This should actually verify whether the names clash. At the 
-        # other hand this is never used programmatically, and users running 
-        # into problems should be skilled enought to work it out themselves.
-        return rev[0:7]
+        """Return the shortest abbreviation of at least 7 digits that names
+        no other object.
+        """
+        if len(rev) != 40:
+            return rev[0:7]
+        if rev not in self._short_revs:
+            self._short_revs[rev] = \
+                self.sha_index.shortest_abbreviation(rev)
+        return self._short_revs[rev]
     
     def display_rev(self, rev):
         return self.short_rev(rev)
         
     def get_changes(self, old_path, old_rev, new_path, new_rev,
                         ignore_ancestry=1):
-        raise NotImplementedError
+        old_path = old_path.strip('/')
+        new_path = new_path.strip('/')
+        old_rev = self.normalize_rev(old_rev)
+        new_rev = self.normalize_rev(new_rev)
+        old_entry = self._lookup_entry(self.dulwichrepo[old_rev].tree,
+                                       old_path)
+        if old_entry is None:
+            raise NoSuchNode(old_path, old_rev)
+        new_entry = self._lookup_entry(self.dulwichrepo[new_rev].tree,
+                                       new_path)
+        if new_entry is None:
+            raise NoSuchNode(new_path, new_rev)
+
+        if not stat.S_ISDIR(old_entry[0]) or not stat.S_ISDIR(new_entry[0]):
+            if old_entry[1] != new_entry[1]:
+                yield (DulwichNode(self, old_path, old_rev, old_entry[1],
+                                   old_rev),
+                       DulwichNode(self, new_path, new_rev, new_entry[1],
+                                   new_rev),
+                       Node.FILE, Changeset.EDIT)
+            return
+
+        # tree_changes is lazy and does not descend into identical subtrees
+        for change in dulwich.diff_tree.tree_changes(
+                self.dulwichrepo.object_store, old_entry[1], new_entry[1]):
+            if S_ISGITLINK(change.old.mode or 0) or \
+                    S_ISGITLINK(change.new.mode or 0):
+                continue
+            old_node = new_node = None
+            if change.old.sha is not None:
+                old_node = DulwichNode(self,
+                                       posixpath.join(old_path,
+                                                      change.old.path),
+                                       old_rev, change.old.sha, old_rev)
+            if change.new.sha is not None:
+                new_node = DulwichNode(self,
+                                       posixpath.join(new_path,
+                                                      change.new.path),
+                                       new_rev, change.new.sha, new_rev)
+            yield (old_node, new_node, Node.FILE,
+                   DulwichChangeset.CHANGE_TYPES[change.type])
 
     
 class DulwichChangeset(Changeset):
@@ -178,14 +783,36 @@ class DulwichChangeset(Changeset):
         
         self.dulwichrepo = repo.dulwichrepo
         self.rev = rev
-        message = self.dulwichrepo[rev].message.decode('utf-8')
-        author =  self.dulwichrepo[rev].author
-        timezonestring = self.dulwichrepo[rev].author_timezone
+        commit = self.dulwichrepo[rev]
+        message = commit.message.decode('utf-8')
+        author = commit.author
+        timezonestring = commit.author_timezone
         timezone = FixedOffset(int(timezonestring)/60, timezonestring)
-        date = datetime.fromtimestamp(float(self.dulwichrepo[rev].author_time),
-                                      timezone)
+        date = datetime.fromtimestamp(float(commit.author_time), timezone)
         Changeset.__init__(self, repo, rev, message, author, date)
 
+    # Trac property names of the kinds of refs
+    REF_PROPERTIES = [('refs/heads/', 'Branches'),
+                      ('refs/tags/', 'Tags'),
+                      ('refs/remotes/', 'Remotes')]
+
+    def get_properties(self):
+        properties = {}
+        refs = self.repos.get_containing_refs(self.rev)
+        for prefix, name in self.REF_PROPERTIES:
+            names = [ref[len(prefix):] for ref in refs
+                     if ref.startswith(prefix)]
+            if names:
+                properties[name] = ', '.join(names)
+        return properties
+
+    def get_branches(self):
+        heads = dict(self.repos.ref_snapshot.branches)
+        return [(ref[len('refs/heads/'):],
+                 heads.get(ref[len('refs/heads/'):]) == self.rev)
+                for ref in self.repos.get_containing_refs(self.rev)
+                if ref.startswith('refs/heads/')]
+
     # Constants for get_changes
     CHANGE_TYPES = { dulwich.diff_tree.CHANGE_ADD: Changeset.ADD,
                      dulwich.diff_tree.CHANGE_COPY: Changeset.COPY,
@@ -208,109 +835,274 @@ class DulwichChangeset(Changeset):
         The `base_path` and `base_rev` are the source path and rev for the
         action (`None` and `-1` in the case of an ADD change).
         """
-        # get the changes to the previous revision...
-        # TODO: check whether the first revision works
-        # TODO: instead of getting the changes like this, we should only get 
-        # the changes in the merge
-        previous_rev = self.repos.previous_rev(self.rev)
-        
-        for parent in self.dulwichrepo[self.rev].parents:        
-            changes = dulwich.diff_tree.tree_changes(
-                                            self.dulwichrepo.object_store,
-                                            self.dulwichrepo[parent].tree,
-                                            self.dulwichrepo[self.rev].tree)
-            for change in changes:
-                yield(change.new.path, self.KIND_TYPES[self.dulwichrepo[change.new.sha].__class__], 
-                      self.CHANGE_TYPES[change.type], 
-                      change.old.path if not change.type == dulwich.diff_tree.CHANGE_ADD else None,
-                      previous_rev if not change.type == dulwich.diff_tree.CHANGE_ADD else None)
+        key = (self.dulwichrepo.path, self.rev, self.repos.rename_detection
+               and tuple(sorted(self.repos.rename_detection.items())))
+        changes = _changeset_changes.get(key)
+        if changes is None:
+            self.repos.stats.count('changesets diffed')
+            changes = list(self._compute_changes())
+            _changeset_changes.put(key, changes, 
+                                   sum(len(c[0]) + 64 for c in changes) + 64)
+        return iter(changes)
+
+    def _compute_changes(self):
+        commit = self.dulwichrepo[self.rev]
+        store = self.dulwichrepo.object_store
+
+        if len(commit.parents) > 1:
+            # Only report what the merge itself changed: the paths that
+            # differ from every parent
+            parent_trees = [self.dulwichrepo[p].tree for p in commit.parents]
+            for path, entry, parent_entries in _combined_tree_changes(
+                    store, commit.tree, parent_trees):
+                for index, parent_entry in enumerate(parent_entries):
+                    if parent_entry is not None:
+                        base_rev = commit.parents[index]
+                        break
+                else:
+                    yield path, Node.FILE, Changeset.ADD, None, None
+                    continue
+                if entry is None:
+                    yield path, Node.FILE, Changeset.DELETE, path, base_rev
+                else:
+                    yield path, Node.FILE, Changeset.EDIT, path, base_rev
+            return
+
+        if commit.parents:
+            base_rev = commit.parents[0]
+            base_tree = self.dulwichrepo[base_rev].tree
+        else:
+            # the first revision adds everything
+            base_rev = base_tree = None
+        changes = dulwich.diff_tree.tree_changes(
+                                    store, base_tree, commit.tree,
+                                    rename_detector=self.repos.get_rename_detector())
+        for change in changes:
+            if change.type == dulwich.diff_tree.CHANGE_DELETE:
+                entry = change.old
+            else:
+                entry = change.new
+            yield(entry.path,
+                  stat.S_ISDIR(entry.mode) and Node.DIRECTORY or Node.FILE,
+                  self.CHANGE_TYPES[change.type], 
+                  change.old.path if not change.type == dulwich.diff_tree.CHANGE_ADD else None,
+                  base_rev if not change.type == dulwich.diff_tree.CHANGE_ADD else None)
                     
 
+class _LastChanges(object):
+    """The last changes of the entries of a directory, all resolved with one
+    `get_last_changes` call when the first one is requested.
+    """
+
+    def __init__(self, repos, rev, path, entries):
+        self.repos = repos
+        self.rev = rev
+        self.path = path
+        self.entries = entries
+        self._changes = None
+
+    def get(self, name):
+        if self._changes is None:
+            self._changes = self.repos.get_last_changes(self.rev, self.path,
+                                                        self.entries)
+        return self._changes.get(name)
+
+
 class DulwichNode(Node):
-    def __init__(self, repos, path, rev, sha=None):
+    def __init__(self, repos, path, rev, sha=None, created_rev=None,
+                 mode=None, last_changes=None):
         self.repos = repos
         self.dulwichrepo = repos.dulwichrepo
+        self._dulwichobject = None
+        # The revision the node was requested at. The last change of the
+        # node is only looked up when `rev` or `created_rev` is used.
+        self._rev = rev
+        self._last_changes = last_changes
         
         if sha == None and path == "/":
             # get the tree
-            self.dulwichobject = self.dulwichrepo[self.dulwichrepo[rev].tree]
+            self.sha = self.dulwichrepo[rev].tree
             kind = Node.DIRECTORY
+            created_rev = rev
         elif sha:
-            self.dulwichobject = self.dulwichrepo[sha]
-            if isinstance(self.dulwichobject, Tree):
+            self.sha = sha
+            if mode is not None:
+                # the mode of the tree entry tells the kind, so a blob does
+                # not have to be read before its contents are requested
+                is_dir = stat.S_ISDIR(mode)
+            else:
+                is_dir = isinstance(self.dulwichobject, Tree)
+            if is_dir:
                 kind = Node.DIRECTORY
             else:
                 kind = Node.FILE
-            rev = self.get_last_change(rev, path)
         else:
             root_tree = repos.dulwichrepo[repos.dulwichrepo[rev].tree]
             try:
-                mode, sha = root_tree.lookup_path(repos.dulwichrepo.get_object, 
-                                                  path.strip('/'))
-                self.dulwichobject = repos.dulwichrepo[sha]
+                mode, self.sha = root_tree.lookup_path(
+                    repos.dulwichrepo.get_object, path.strip('/'))
             except KeyError:
                 raise NoSuchNode(path, rev)
-            rev = self.get_last_change(rev, path.strip('/'))
-            # finally we should have an object in self.dulwichobject
-            if isinstance (self.dulwichobject, Tree):
+            if stat.S_ISDIR(mode):
                 kind = Node.DIRECTORY
                 path += '/'
-            elif isinstance(self.dulwichobject, Blob):
+            elif not S_ISGITLINK(mode):
                 kind = Node.FILE
             else:
                 raise TracError("Weird kind of Dulwich object for " + path)
         
         #required by the Node class to set up ourselves
         self.created_path = path 
-        self.created_rev = rev
-        
-        Node.__init__(self, repos, path, rev, kind)
+        # `rev` and `created_rev` are the same property, `None` leaves it
+        # unresolved
+        Node.__init__(self, repos, path, created_rev, kind)
+
+    def _get_created_rev(self):
+        if self._created_rev is None:
+            if self._last_changes is not None:
+                name = posixpath.basename(self.path.rstrip('/'))
+                self._created_rev = self._last_changes.get(
+                    name.encode('utf-8'))
+            if self._created_rev is None:
+                self._created_rev = self.get_last_change(
+                    self._rev, self.path.strip('/') or '/')
+        return self._created_rev
+
+    def _set_created_rev(self, rev):
+        self._created_rev = rev
+
+    created_rev = property(_get_created_rev, _set_created_rev)
+    rev = created_rev
+
+    @property
+    def resource(self):
+        # permission checks of the entries of a listing must not resolve
+        # their last change, the node is the same at the requested revision
+        return Resource('source', self.path, version=self._rev,
+                        parent=self.repos.resource)
+    
+    @property
+    def dulwichobject(self):
+        if self._dulwichobject is None:
+            self._dulwichobject = self.dulwichrepo[self.sha]
+        return self._dulwichobject
     
     def get_content(self):
         if not self.isfile:
             return None
-        return StringIO(self.dulwichobject.as_raw_string())
+        content = open_blob(self.dulwichrepo.object_store, self.sha)
+        if content is None:
+            # not stored in this repository's own object directory
+            content = StringIO(self.dulwichobject.as_raw_string())
+        return content
 
     def get_entries(self):
         if not self.isdir:
             return
         
-        for rubbish, name, sha in self.dulwichobject.entries():
-            yield DulwichNode(self.repos, self.path + name, self.rev, sha)
+        entries = self.dulwichobject.entries()
+        last_changes = _LastChanges(
+            self.repos, self._rev, self.path,
+            [(name, sha) for mode, name, sha in entries])
+        for mode, name, sha in entries:
+            yield DulwichNode(self.repos, posixpath.join(self.path, name),
+                              self._rev, sha, mode=mode,
+                              last_changes=last_changes)
     
     def get_history(self, limit=None):
         # get the backward history for this node
-        # TODO: follow moves/copies
         if self.path == "/":
             # each node is in the root path
-            walker = self.dulwichrepo.get_walker(include=[self.rev], 
-                                                 max_entries=limit)
+            graph = self.repos.commit_graph
+            ordinal = None
+            if graph is not None:
+                ordinal = graph.ordinal(self.rev)
+            if ordinal is not None:
+                revs = (graph.sha(o) for o in graph.iter_ancestors(ordinal))
+            else:
+                revs = (walk.commit.id for walk in
+                        self.dulwichrepo.get_walker(include=[self.rev]))
             count = 0
-            for is_last, walk in _last_iterable(walker):
-                print(walk.commit.id)
-                yield(self.path, walk.commit.id, 
+            for is_last, rev in _last_iterable(revs):
+                yield(self.path, rev, 
                       Changeset.EDIT if not is_last else Changeset.ADD )
                 count += 1
                 if limit and count == limit:
                     break
         else:
-            path = self.path.strip('/')
-            walker = self.dulwichrepo.get_walker(include=[self.rev], 
-                max_entries=limit, paths=[path])
+            changes = self.repos._indexed_path_changes(self.rev, self.path)
+            if changes is not None:
+                for entry in self._get_indexed_history(changes, limit):
+                    yield entry
+                return
+            path = self.path.strip('/').encode('utf-8')
+            # with rename detection enabled, the walker follows moves and
+            # copies of files; it cannot follow a directory
+            rename_detector = None
+            if self.isfile:
+                rename_detector = self.repos.get_rename_detector()
+            walker = self.repos._get_path_walker([self.rev], [path],
+                max_entries=limit,
+                rename_detector=rename_detector,
+                follow=rename_detector is not None)
             # TODO: this code is also used in _get_last_change. Combine and 
             # make much nicer. It can probably also be reused in 
             # DulwichRepository.get_path_history
-            operation = Changeset.EDIT
             for walk in walker:
-                for change in walk.changes():
+                operation = Changeset.EDIT
+                old_path = path
+                for change in _iter_changes(walk.changes()):
                     if change.new.path == path:
                         if change.type == "add":
                             operation = Changeset.ADD
+                        elif change.type in (dulwich.diff_tree.CHANGE_RENAME,
+                                             dulwich.diff_tree.CHANGE_COPY):
+                            operation = DulwichChangeset.CHANGE_TYPES[
+                                change.type]
+                            old_path = change.old.path
                 
-                yield(self.path, walk.commit.id, operation)
+                yield('/' + path.decode('utf-8'), walk.commit.id, operation)
                 if operation == Changeset.ADD: break
+                path = old_path
                 
                 
+    def _get_indexed_history(self, changes, limit=None):
+        """Generate the history from the path change index, following
+        renames and copies like the walker does.
+        """
+        path = self.path.strip('/')
+        count = 0
+        while changes is not None:
+            source = None
+            for commit_id, change in changes:
+                if change == Changeset.ADD:
+                    commit = self.dulwichrepo[commit_id]
+                    for parent in commit.parents:
+                        rename = find_rename(self.repos,
+                                             self.dulwichrepo[parent], commit,
+                                             path.encode('utf-8'))
+                        if rename is not None:
+                            change = DulwichChangeset.CHANGE_TYPES[
+                                rename.type]
+                            source = (parent,
+                                      rename.old.path.decode('utf-8'))
+                            break
+                yield '/' + path, commit_id, change
+                count += 1
+                if limit and count >= limit:
+                    return
+                if change != Changeset.EDIT:
+                    break
+            if source is None:
+                break
+            rev, path = source
+            changes = self.repos._indexed_path_changes(rev, path)
+
+    def get_annotations(self):
+        if not self.isfile:
+            return []
+        return self.repos.get_annotations(self.rev, self.path, self.sha)
+
     def get_properties(self):
         # no properties defined yet...
         return {}
@@ -321,29 +1113,45 @@ class DulwichNode(Node):
         # git does no accounting
         return ''
 
+    def get_last_modified(self):
+        commit = self.dulwichrepo[self.created_rev]
+        timezone = FixedOffset(int(commit.commit_timezone) / 60,
+                               commit.commit_timezone)
+        return datetime.fromtimestamp(float(commit.commit_time), timezone)
+
     def get_content_length(self):
         if self.isdir:
             return None
-        return self.dulwichobject.raw_length()
+        size = get_blob_size(self.dulwichrepo.object_store, self.sha)
+        if size is None:
+            size = self.dulwichobject.raw_length()
+        return size
         
     # Dulwich specific
     def get_last_change(self, rev, path):
         """
         Find the last change for the given path since a specified rev
         """
-        
-        # Try the cache
-        if self.repos.cache:
-            cache_rev = self.repos.cache.get_commit_sha_for_object(self.dulwichobject.id)
-            if cache_rev is not None:
-                return cache_rev
-        
         if path == "/":
             # requesting top-level tree, which is always at the requested rev
             return rev
+
+        changes = self.repos._indexed_path_changes(rev, path)
+        if changes is not None:
+            for commit_id, change in changes:
+                return commit_id
+
+        # Try the object cache. It knows the oldest commit that introduced
+        # the object at the path, which is not the last change when the path
+        # was reverted to an earlier version.
+        if self.repos.cache:
+            cache = self.repos.cache
+            cache_rev = cache.get_commit_sha_for_object(self.sha, path)
+            if cache_rev is not None:
+                return cache_rev
         
-        walker = self.dulwichrepo.get_walker(include=[rev], max_entries=1, 
-                                             paths=[path.strip('/')]) 
+        walker = self.repos._get_path_walker(
+            [rev], [path.strip('/').encode('utf-8')], max_entries=1)
         for walk in walker:
             return walk.commit.id
         raise TracError("Unknown error in TracDulwich (_get_last_change)")
@@ -352,25 +1160,40 @@ class DulwichNode(Node):
         """
         Find the previous revision of this node
         """
-        walker = self.dulwichrepo.get_walker(include=[self.created_rev], 
-                                             max_entries=2, 
-                                             paths=[self.created_path])
-        rev = None
-        for walk in walker:
-            rev = walk.commit.id
-        return rev
+        changes = self.repos._indexed_path_changes(self.created_rev,
+                                                   self.created_path)
+        if changes is not None:
+            history = list(self._get_indexed_history(changes, 2))
+            return len(history) > 1 and history[1][1] or None
+        path = self.created_path.strip('/').encode('utf-8')
+        walker = self.repos._get_path_walker([self.created_rev], [path],
+                                             max_entries=2)
+        for i, walk in enumerate(walker):
+            if i == 1:
+                return walk.commit.id
+        return None
 
     def get_next_change(self):
         """
         Find the next revision of this node
         """
-        walker = self.dulwichrepo.get_walker(include=[self.dulwichrepo.head()],
-                                             exclude=[self.created_rev], 
-                                             max_entries=2, 
-                                             paths=[self.created_path], 
+        head = self.repos.ref_snapshot.head
+        changes = self.repos._indexed_path_changes(head, self.created_path)
+        graph = self.repos.commit_graph
+        if changes is not None and graph.ordinal(self.created_rev) is not None:
+            # the oldest change between the node and the head
+            created = graph.ordinal(self.created_rev)
+            rev = None
+            for commit_id, change in changes:
+                if graph.ordinal(commit_id) <= created:
+                    break
+                rev = commit_id
+            return rev
+        path = self.created_path.strip('/').encode('utf-8')
+        walker = self.repos._get_path_walker([head], [path],
+                                             exclude=[self.created_rev],
                                              reverse=True)
-        rev = None
         for walk in walker:
-            rev = walk.commit.id
-        return rev
+            return walk.commit.id
+        return None
     
@@ -0,0 +1,196 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Process wide cache of parsed git objects.
+
+Trac creates a new repository object for every request. Without this
+module, every request opens the pack files again and inflates the same
+commits and trees over and over. Here, parsed commits and trees are kept in
+a size bounded LRU cache that is shared by all repositories of the process,
+and each thread keeps its object stores (and thus its open pack files and
+pack indexes) around between requests.
+"""
+
+from binascii import hexlify
+import threading
+import time
+
+from dulwich.object_store import DiskObjectStore
+from dulwich.objects import Commit, Tree
+from dulwich.repo import Repo
+
+from stats import NULL_STATS
+
+# Approximate memory overhead of a parsed object on top of its raw size
+_OBJECT_OVERHEAD = 256
+
+
+class LRUObjectCache(object):
+    """Thread safe least recently used cache, bounded by the total size of
+    the cached values in bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        # circular doubly linked list of [prev, next, key, value, size]
+        # entries, the most recently used entry follows the root
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._unlink(entry)
+            self._link_first(entry)
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, size):
+        if size > self.max_size:
+            return
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.size -= entry[4]
+            entry = [None, None, key, value, size]
+            self._link_first(entry)
+            self._entries[key] = entry
+            self.size += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def resize(self, max_size):
+        self._lock.acquire()
+        try:
+            self.max_size = max_size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None, 0]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        root = self._root
+        while self.size > self.max_size:
+            oldest = root[0]
+            self._unlink(oldest)
+            del self._entries[oldest[2]]
+            self.size -= oldest[4]
+            self.evictions += 1
+
+    def _unlink(self, entry):
+        prev, next = entry[0], entry[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_first(self, entry):
+        root = self._root
+        first = root[1]
+        entry[0] = root
+        entry[1] = first
+        first[0] = entry
+        root[1] = entry
+
+
+class CachingObjectStore(DiskObjectStore):
+    """Object store that keeps parsed commits and trees in a shared
+    `LRUObjectCache`.
+
+    Blobs are not cached, they are potentially large and are usually read
+    only once per request.
+    """
+
+    _cached_types = (Commit.type_num, Tree.type_num)
+
+    def __init__(self, path, object_cache):
+        DiskObjectStore.__init__(self, path)
+        self.object_cache = object_cache
+        self.stats = NULL_STATS
+
+    def __getitem__(self, sha):
+        if len(sha) == 20:
+            sha = hexlify(sha)
+        key = (self.path, sha)
+        obj = self.object_cache.get(key)
+        self.stats.count('objects read')
+        if obj is None:
+            if self.stats.enabled:
+                start = time.time()
+                obj = DiskObjectStore.__getitem__(self, sha)
+                self.stats.add_time('object inflation', time.time() - start)
+                self.stats.count('objects inflated')
+            else:
+                obj = DiskObjectStore.__getitem__(self, sha)
+            if obj.type_num in self._cached_types:
+                self.object_cache.put(key, obj,
+                                      obj.raw_length() + _OBJECT_OVERHEAD)
+        return obj
+
+
+_object_cache = None
+_object_cache_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_object_cache(max_size):
+    """Return the process wide object cache, sized to `max_size` bytes."""
+    global _object_cache
+    _object_cache_lock.acquire()
+    try:
+        if _object_cache is None:
+            _object_cache = LRUObjectCache(max_size)
+        elif _object_cache.max_size != max_size:
+            _object_cache.resize(max_size)
+        return _object_cache
+    finally:
+        _object_cache_lock.release()
+
+
+def open_repository(path, object_cache=None, stats=NULL_STATS):
+    """Open a dulwich repository.
+
+    When an `object_cache` is given, the repository uses a `CachingObjectStore`
+    that is reused by the calling thread for later requests, so the pack files
+    and their indexes stay open. Its object reads are counted in `stats`.
+    """
+    repo = Repo(path)
+    if object_cache is None:
+        return repo
+    stores = getattr(_local, 'stores', None)
+    if stores is None:
+        stores = _local.stores = {}
+    store_path = repo.object_store.path
+    store = stores.get(store_path)
+    if store is None or store.object_cache is not object_cache:
+        store = stores[store_path] = CachingObjectStore(store_path,
+                                                        object_cache)
+    store.stats = stats
+    repo.object_store = store
+    return repo
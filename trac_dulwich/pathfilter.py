@@ -0,0 +1,261 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Changed-path Bloom filters of the commits of the commit graph.
+
+For every commit, a small Bloom filter holds the paths that differ from its
+first parent, together with their leading directories. A walk limited to a
+path skips the commits whose filter does not contain the path, without
+comparing any trees. A filter never misses a changed path; a false positive
+only costs the tree comparison that would have been done anyway.
+
+Like the changed-path filters of git, a filter uses 10 bits per path and 7
+hash functions, and a commit that changes more than `MAX_CHANGED_PATHS`
+paths gets a filter with all bits set. Filters are addressed by the ordinal
+of their commit in the commit graph. Commits that were added to the graph
+after the filters were written have no filter and are always compared.
+
+The file is written by `trac-admin <env> dulwich filters <repository>`, and
+kept up to date by the synchronization once it exists.
+"""
+
+from array import array
+from binascii import unhexlify
+import hashlib
+import os
+import struct
+import threading
+
+import dulwich.diff_tree
+from dulwich.walk import Walker
+
+from commitgraph import _read_array, _write_array, index_path
+
+FILTERS_FILE = 'path-filters'
+
+MAX_CHANGED_PATHS = 512
+BITS_PER_PATH = 10
+HASH_COUNT = 7
+
+_MAGIC = 'TDPF'
+_VERSION = 1
+# magic, version, number of commits, size of the filter data, sha of the
+# last commit
+_HEADER = struct.Struct('<4sIII20s')
+_HASH = struct.Struct('<II')
+# every bit set, for the commits that change too many paths
+_FULL = '\xff'
+
+
+def _path_hashes(path):
+    """Return the `HASH_COUNT` hashes of `path`, by double hashing."""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    h1, h2 = _HASH.unpack(hashlib.md5(path).digest()[:_HASH.size])
+    return [(h1 + i * h2) & 0xffffffff for i in xrange(HASH_COUNT)]
+
+
+def _make_filter(paths):
+    if len(paths) > MAX_CHANGED_PATHS:
+        return _FULL
+    if not paths:
+        return ''
+    size = (len(paths) * BITS_PER_PATH + 7) // 8
+    bits = array('B', [0]) * size
+    for path in paths:
+        for h in _path_hashes(path):
+            h %= size * 8
+            bits[h >> 3] |= 1 << (h & 7)
+    return bits.tostring()
+
+
+def _changed_paths(store, commit):
+    """Return the paths that differ between `commit` and its first parent,
+    with their leading directories, but without the root.
+    """
+    parent_tree = None
+    if commit.parents:
+        parent_tree = store[commit.parents[0]].tree
+    paths = set()
+    for change in dulwich.diff_tree.tree_changes(store, parent_tree,
+                                                 commit.tree):
+        for path in (change.old.path, change.new.path):
+            while path and path not in paths:
+                paths.add(path)
+                path = path.rpartition('/')[0]
+    return paths
+
+
+class PathFilters(object):
+    """The changed-path filters of the first `len()` commits of a commit
+    graph.
+    """
+
+    def __init__(self, offsets=None, data='', last_sha=None):
+        self.offsets = offsets or array('I', [0])
+        self.data = data
+        self.last_sha = last_sha
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def read(cls, path):
+        fp = open(path, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        magic, version, count, size, last_sha = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("%s is not a path filter index" % path)
+        offsets, offset = _read_array('I', data, _HEADER.size, count + 1)
+        if len(data) != offset + size:
+            raise ValueError("%s is truncated" % path)
+        return cls(offsets, data[offset:], count and last_sha or None)
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fp = open(tmp_path, 'wb')
+        try:
+            fp.write(_HEADER.pack(_MAGIC, _VERSION, len(self),
+                                  len(self.data), self.last_sha or '\0' * 20))
+            _write_array(fp, self.offsets)
+            fp.write(self.data)
+        finally:
+            fp.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def matches(self, graph):
+        """Return whether the filters were built for `graph`, or for an
+        older version of it.
+        """
+        if not len(self):
+            return True
+        return len(self) <= len(graph) and \
+               unhexlify(graph.sha(len(self) - 1)) == self.last_sha
+
+    def may_have_changed(self, ordinal, paths):
+        """Return whether the commit `ordinal` may have changed one of
+        `paths`, which are paths of the repository without leading slash.
+        """
+        if ordinal is None or ordinal >= len(self):
+            return True
+        start = self.offsets[ordinal]
+        size = self.offsets[ordinal + 1] - start
+        if size == 0:
+            return False
+        bit_count = size * 8
+        data = self.data
+        for path in paths:
+            if not path:
+                # the root changes with every path
+                return True
+            for h in _path_hashes(path):
+                h %= bit_count
+                if not ord(data[start + (h >> 3)]) & (1 << (h & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def extend(self, object_store, graph):
+        """Return new filters that also cover the commits of `graph` that are
+        not covered yet, and the number of commits added.
+        """
+        count = len(self)
+        if count == len(graph):
+            return self, 0
+        offsets = array('I', self.offsets)
+        data = [self.data]
+        size = len(self.data)
+        for ordinal in xrange(count, len(graph)):
+            commit = object_store[graph.sha(ordinal)]
+            bits = _make_filter(_changed_paths(object_store, commit))
+            data.append(bits)
+            size += len(bits)
+            offsets.append(size)
+        filters = PathFilters(offsets, ''.join(data),
+                              unhexlify(graph.sha(len(graph) - 1)))
+        return filters, len(graph) - count
+
+
+class PathFilteredWalker(Walker):
+    """A walker limited to paths, that does not compare the trees of the
+    commits whose filter rules out every walked path.
+    """
+
+    def __init__(self, store, include, filters, graph, stats, **kwargs):
+        Walker.__init__(self, store, include, **kwargs)
+        self._filters = filters
+        self._graph = graph
+        self._stats = stats
+
+    def _should_return(self, entry):
+        if self.paths is not None and not self._filters.may_have_changed(
+                self._graph.ordinal(entry.commit.id), self.paths):
+            self._stats.count('commits filtered')
+            return None
+        return Walker._should_return(self, entry)
+
+
+_filters_cache = {}
+_filters_cache_lock = threading.Lock()
+
+
+def load_path_filters(dulwichrepo, graph):
+    """Return the path filters of a repository if they were built for
+    `graph`, otherwise `None`.
+
+    Like commit graphs, the filters are shared between all repository
+    instances of a process and reloaded when the file on disk changes.
+    """
+    path = index_path(dulwichrepo, FILTERS_FILE)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = (st.st_mtime, st.st_size, st.st_ino)
+    _filters_cache_lock.acquire()
+    try:
+        cached = _filters_cache.get(path)
+    finally:
+        _filters_cache_lock.release()
+    if cached and cached[0] == signature:
+        filters = cached[1]
+    else:
+        try:
+            filters = PathFilters.read(path)
+        except (IOError, ValueError, struct.error):
+            return None
+        _filters_cache_lock.acquire()
+        try:
+            _filters_cache[path] = (signature, filters)
+        finally:
+            _filters_cache_lock.release()
+    if not filters.matches(graph):
+        return None
+    return filters
+
+
+def has_path_filters(dulwichrepo):
+    return os.path.exists(index_path(dulwichrepo, FILTERS_FILE))
+
+
+def update_path_filters(dulwichrepo, graph):
+    """Extend the path filters of a repository to every commit of `graph`
+    and return the filters and the number of added commits. The filters are
+    rebuilt when the commit graph was rebuilt.
+    """
+    filters = load_path_filters(dulwichrepo, graph) or PathFilters()
+    filters, added = filters.extend(dulwichrepo.object_store, graph)
+    if added or not has_path_filters(dulwichrepo):
+        filters.write(index_path(dulwichrepo, FILTERS_FILE))
+    return filters, added
@@ -0,0 +1,306 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Reachability bitmaps of the refs of a repository.
+
+For every branch, tag and remote ref whose commit is in the commit graph, a
+bitmap holds the ordinals of all commits reachable from the ref. Whether a
+ref contains a commit is a single bit test, and the commits of one ref that
+are not in another are the difference of two bitmaps. Bitmaps are Python
+longs, stored zlib compressed.
+
+The index is written by `trac-admin <env> dulwich sync`. Bitmaps are only
+computed for refs that moved: the walk of a new ref stops at the commits
+that already have a bitmap, and merges their bitmaps instead. A ref that
+moved after the last synchronization no longer matches its stored target,
+and is not answered from the index.
+"""
+
+from binascii import hexlify, unhexlify
+import os
+import struct
+import threading
+import zlib
+
+from dulwich.objects import Commit, Tag
+
+from commitgraph import index_path
+
+REACHABILITY_FILE = 'reachability'
+
+_MAGIC = 'TDRB'
+_VERSION = 1
+# magic, version, number of refs, number of commits in the graph, sha of the
+# last commit
+_HEADER = struct.Struct('<4sIII20s')
+# length of the name, sha of the ref, ordinal of its commit, length of the
+# bitmap data
+_ENTRY = struct.Struct('<H20sII')
+
+
+def _to_bytes(bits, size):
+    """Return the bitmap `bits` as a little endian bytearray of `size`."""
+    if not bits:
+        return bytearray(size)
+    return bytearray(unhexlify('%0*x' % (size * 2, bits)))[::-1]
+
+
+def _from_bytes(data):
+    if not data:
+        return 0L
+    return long(hexlify(str(data[::-1])), 16)
+
+
+def _encode(bits):
+    data = '%x' % bits
+    if len(data) & 1:
+        data = '0' + data
+    return zlib.compress(unhexlify(data))
+
+
+def _decode(data):
+    data = zlib.decompress(data)
+    if not data:
+        return 0L
+    return long(hexlify(data), 16)
+
+
+def iter_ordinals(bits):
+    """Generate the ordinals of the bits set in `bits`, in descending
+    order.
+    """
+    data = _to_bytes(bits, (bits.bit_length() + 7) // 8)
+    for index in xrange(len(data) - 1, -1, -1):
+        byte = data[index]
+        if byte:
+            for bit in xrange(7, -1, -1):
+                if byte & (1 << bit):
+                    yield index * 8 + bit
+
+
+def peel(object_store, sha):
+    """Return the commit that `sha` is or that it tags, or `None`.
+    `object_store` is anything that maps shas to objects, like a repository.
+    """
+    try:
+        obj = object_store[sha]
+        while isinstance(obj, Tag):
+            obj = object_store[obj.object[1]]
+    except KeyError:
+        return None
+    if not isinstance(obj, Commit):
+        return None
+    return obj.id
+
+
+class ReachabilityIndex(object):
+    """The reachability bitmaps of the refs of a repository, for the first
+    `graph_size` commits of a commit graph.
+    """
+
+    def __init__(self, entries=None, graph_size=0, last_sha=None):
+        # {ref name: (sha of the ref, ordinal, compressed bitmap)}
+        self.entries = entries or {}
+        self.graph_size = graph_size
+        self.last_sha = last_sha
+        self._bitmaps = {} # {ordinal: bitmap}
+        self._ordinals = dict((ordinal, data) for sha, ordinal, data
+                              in self.entries.itervalues())
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def read(cls, path):
+        fp = open(path, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        magic, version, count, graph_size, last_sha = \
+            _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("%s is not a reachability index" % path)
+        offset = _HEADER.size
+        entries = {}
+        for i in xrange(count):
+            name_size, binsha, ordinal, size = \
+                _ENTRY.unpack_from(data, offset)
+            offset += _ENTRY.size
+            name = data[offset:offset + name_size]
+            offset += name_size
+            entries[name] = (hexlify(binsha), ordinal,
+                             data[offset:offset + size])
+            offset += size
+        if offset != len(data):
+            raise ValueError("%s is truncated" % path)
+        return cls(entries, graph_size, graph_size and last_sha or None)
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fp = open(tmp_path, 'wb')
+        try:
+            fp.write(_HEADER.pack(_MAGIC, _VERSION, len(self),
+                                  self.graph_size,
+                                  self.last_sha or '\0' * 20))
+            for name, (sha, ordinal, data) in sorted(self.entries.items()):
+                fp.write(_ENTRY.pack(len(name), unhexlify(sha), ordinal,
+                                     len(data)))
+                fp.write(name)
+                fp.write(data)
+        finally:
+            fp.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def matches(self, graph):
+        """Return whether the index was built for `graph`, or for an older
+        version of it.
+        """
+        if not self.graph_size:
+            return True
+        return self.graph_size <= len(graph) and \
+               unhexlify(graph.sha(self.graph_size - 1)) == self.last_sha
+
+    # Queries
+
+    def bitmap(self, ordinal):
+        """Return the bitmap of the commits reachable from the commit
+        `ordinal`, or `None` if no ref points to it.
+        """
+        if ordinal not in self._bitmaps:
+            data = self._ordinals.get(ordinal)
+            if data is None:
+                return None
+            self._bitmaps[ordinal] = _decode(data)
+        return self._bitmaps[ordinal]
+
+    def contains(self, name, sha, ordinal):
+        """Return whether the ref `name`, which points to `sha`, contains the
+        commit `ordinal`. Returns `None` if the index does not know the ref
+        at `sha`.
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != sha:
+            return None
+        return bool(self.bitmap(entry[1]) >> ordinal & 1)
+
+    def difference(self, include, exclude):
+        """Return the bitmap of the commits reachable from the commit
+        `include` but not from `exclude`, or `None` if one of them has no
+        bitmap.
+        """
+        included = self.bitmap(include)
+        excluded = self.bitmap(exclude)
+        if included is None or excluded is None:
+            return None
+        return included & ~excluded
+
+    # Building
+
+    def update(self, object_store, graph, refs):
+        """Return a new index for `refs`, a dictionary of ref names to shas,
+        and the number of bitmaps that were computed.
+
+        Refs that did not move keep their bitmap, as do the refs that point
+        to a commit that already has one.
+        """
+        targets = {}
+        for name, sha in refs.iteritems():
+            if not name.startswith('refs/'):
+                continue
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == sha:
+                targets[name] = (sha, entry[1])
+                continue
+            ordinal = graph.ordinal(peel(object_store, sha))
+            if ordinal is not None:
+                targets[name] = (sha, ordinal)
+
+        size = (len(graph) + 7) // 8
+        known = dict(self._ordinals)
+        computed = 0
+        # Older commits first, so newer refs stop at their bitmaps
+        for ordinal in sorted(set(o for sha, o in targets.itervalues())):
+            if ordinal in known:
+                continue
+            bitset = bytearray(size)
+            stack = [ordinal]
+            while stack:
+                current = stack.pop()
+                if bitset[current >> 3] & (1 << (current & 7)):
+                    continue
+                data = known.get(current)
+                if data is not None:
+                    bitset = _to_bytes(_from_bytes(bitset) |
+                                       _decode(data), size)
+                    continue
+                bitset[current >> 3] |= 1 << (current & 7)
+                stack.extend(graph.parents(current))
+            known[ordinal] = _encode(_from_bytes(bitset))
+            computed += 1
+
+        entries = dict((name, (sha, ordinal, known[ordinal]))
+                       for name, (sha, ordinal) in targets.iteritems())
+        index = ReachabilityIndex(entries, len(graph),
+                                  len(graph) and
+                                  unhexlify(graph.sha(len(graph) - 1)))
+        return index, computed
+
+
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+
+
+def load_reachability(dulwichrepo, graph):
+    """Return the reachability index of a repository if it was built for
+    `graph`, otherwise `None`.
+
+    Like commit graphs, indexes are shared between all repository instances
+    of a process and reloaded when the file on disk changes.
+    """
+    path = index_path(dulwichrepo, REACHABILITY_FILE)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = (st.st_mtime, st.st_size, st.st_ino)
+    _index_cache_lock.acquire()
+    try:
+        cached = _index_cache.get(path)
+    finally:
+        _index_cache_lock.release()
+    if cached and cached[0] == signature:
+        index = cached[1]
+    else:
+        try:
+            index = ReachabilityIndex.read(path)
+        except (IOError, ValueError, struct.error, zlib.error):
+            return None
+        _index_cache_lock.acquire()
+        try:
+            _index_cache[path] = (signature, index)
+        finally:
+            _index_cache_lock.release()
+    if not index.matches(graph):
+        return None
+    return index
+
+
+def update_reachability(dulwichrepo, graph, refs):
+    """Update the reachability index of a repository for `refs` and return
+    the index and the number of computed bitmaps. The index is rebuilt when
+    the commit graph was rebuilt.
+    """
+    path = index_path(dulwichrepo, REACHABILITY_FILE)
+    old_index = load_reachability(dulwichrepo, graph) or ReachabilityIndex()
+    index, computed = old_index.update(dulwichrepo.object_store, graph, refs)
+    if index.entries != old_index.entries or not os.path.exists(path):
+        index.write(path)
+    return index, computed
@@ -0,0 +1,101 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Process wide snapshots of the refs of a repository.
+
+Reading all refs means reading the packed-refs file and every loose ref
+below `refs/`. Repositories with many tags make this expensive, and Trac
+needs the refs on every page. A `RefSnapshot` keeps the refs, the sorted
+branch, tag and remote lists and the resolved HEAD, and is reused until
+HEAD, packed-refs or one of the ref directories changes on disk. Git
+replaces loose refs by renaming a lock file, which always updates the
+modification time of the directory that holds the ref.
+"""
+
+import os
+import threading
+
+
+class RefSnapshot(object):
+    """The refs of a repository at one point in time."""
+
+    def __init__(self, refs):
+        self.refs = refs
+        self.head = refs.get('HEAD')
+        self.branches = self._names(refs, 'refs/heads/')
+        self.tags = self._names(refs, 'refs/tags/')
+        self.remotes = self._names(refs, 'refs/remotes/')
+
+    def _names(self, refs, prefix):
+        """Return the sorted `(short name, sha)` pairs of the refs that start
+        with `prefix`.
+        """
+        return sorted((name[len(prefix):], sha)
+                      for name, sha in refs.iteritems()
+                      if name.startswith(prefix))
+
+    def get_heads(self):
+        """Return the shas of all branches, each sha once."""
+        heads = []
+        seen = set()
+        for name, sha in self.branches:
+            if sha not in seen:
+                seen.add(sha)
+                heads.append(sha)
+        return heads
+
+
+_snapshots = {} # {controldir: (key, RefSnapshot, ref directories)}
+_snapshots_lock = threading.Lock()
+
+
+def get_ref_snapshot(dulwichrepo):
+    """Return the current `RefSnapshot` of `dulwichrepo`."""
+    controldir = dulwichrepo.controldir()
+    _snapshots_lock.acquire()
+    try:
+        cached = _snapshots.get(controldir)
+    finally:
+        _snapshots_lock.release()
+    if cached is not None:
+        key, snapshot, directories = cached
+        if _stat_key(controldir, directories) == key:
+            return snapshot
+
+    # Read the directories first, so a change that happens while the refs
+    # are read invalidates the snapshot on the next call
+    directories = _ref_directories(controldir)
+    key = _stat_key(controldir, directories)
+    snapshot = RefSnapshot(dulwichrepo.get_refs())
+    _snapshots_lock.acquire()
+    try:
+        _snapshots[controldir] = (key, snapshot, directories)
+    finally:
+        _snapshots_lock.release()
+    return snapshot
+
+
+def _ref_directories(controldir):
+    directories = []
+    for root, dirs, files in os.walk(os.path.join(controldir, 'refs')):
+        directories.append(root)
+    return directories
+
+
+def _stat_key(controldir, directories):
+    key = []
+    for name in ('HEAD', 'packed-refs'):
+        try:
+            st = os.stat(os.path.join(controldir, name))
+        except OSError:
+            key.append(None)
+        else:
+            key.append((st.st_ino, st.st_size, st.st_mtime))
+    for directory in directories:
+        try:
+            key.append(os.stat(directory).st_mtime)
+        except OSError:
+            key.append(None)
+    return key
@@ -0,0 +1,105 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Rename and copy detection with a bounded cost.
+
+dulwich's `RenameDetector` compares every deleted file with every added
+file, and gives up entirely once the number of pairs exceeds `max_files`
+squared. Large refactoring commits therefore either cost a lot of CPU time
+or are not analysed at all.
+
+`SimilarityRenameDetector` only compares files whose sizes are close enough
+to possibly reach the similarity threshold (the similarity score can never
+exceed the ratio of the smaller to the larger size), computes the chunk
+fingerprints of every blob only once, and stops looking for new candidates
+after a fixed number of compared pairs instead of skipping detection.
+"""
+
+from bisect import bisect_left, bisect_right
+import stat
+
+from dulwich.diff_tree import RenameDetector, TreeChange, _count_blocks, \
+                              _common_bytes, _MAX_SCORE
+from dulwich.objects import S_ISGITLINK
+
+
+class SimilarityRenameDetector(RenameDetector):
+    """Rename detector that buckets candidates by size and caps the number
+    of compared pairs.
+    """
+
+    def __init__(self, store, rename_threshold=60, max_pairs=10000,
+                 find_copies_harder=False):
+        RenameDetector.__init__(self, store,
+                                rename_threshold=rename_threshold,
+                                find_copies_harder=find_copies_harder)
+        self._max_pairs = max_pairs
+
+    def _reset(self):
+        RenameDetector._reset(self)
+        self._blocks = {}
+        self._sizes = {}
+
+    def _should_find_content_renames(self):
+        return bool(self._adds and self._deletes)
+
+    def _get_size(self, sha):
+        size = self._sizes.get(sha)
+        if size is None:
+            size = self._sizes[sha] = self._store[sha].raw_length()
+        return size
+
+    def _get_blocks(self, sha):
+        blocks = self._blocks.get(sha)
+        if blocks is None:
+            blocks = self._blocks[sha] = _count_blocks(self._store[sha])
+        return blocks
+
+    def _find_content_rename_candidates(self):
+        candidates = self._candidates = []
+        if not self._should_find_content_renames():
+            return
+
+        threshold = self._rename_threshold
+        check_paths = threshold is not None
+        adds = [(self._get_size(add.new.sha), add) for add in self._adds
+                if not S_ISGITLINK(add.new.mode)]
+        adds.sort(key=lambda item: item[0])
+        add_sizes = [size for size, add in adds]
+
+        pairs = 0
+        for delete in self._deletes:
+            if S_ISGITLINK(delete.old.mode):
+                continue  # Git links don't exist in this repo.
+            old_size = self._get_size(delete.old.sha)
+            # Only sizes within this range can reach the threshold
+            if threshold:
+                low = old_size * threshold // _MAX_SCORE
+                high = old_size * _MAX_SCORE // threshold
+            else:
+                low, high = 0, max(add_sizes or [0])
+            for index in xrange(bisect_left(add_sizes, low),
+                                bisect_right(add_sizes, high)):
+                new_size, add = adds[index]
+                if stat.S_IFMT(delete.old.mode) != \
+                        stat.S_IFMT(add.new.mode):
+                    continue
+                if pairs >= self._max_pairs:
+                    return
+                pairs += 1
+                score = self._score(delete.old.sha, old_size,
+                                    add.new.sha, new_size)
+                if score > threshold:
+                    new_type = self._rename_type(check_paths, delete, add)
+                    rename = TreeChange(new_type, delete.old, add.new)
+                    candidates.append((-score, rename))
+
+    def _score(self, old_sha, old_size, new_sha, new_size):
+        max_size = max(old_size, new_size)
+        if not max_size:
+            return _MAX_SCORE
+        common = _common_bytes(self._get_blocks(old_sha),
+                               self._get_blocks(new_sha))
+        return int(float(common) * _MAX_SCORE / max_size)
@@ -0,0 +1,89 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Search of the changesets of the cached repositories.
+
+The synchronization stores the words of the message, author and committer of
+every commit in the `dulwich_tokens` table. A search term selects the
+commits that have, for each word of the term, a word that starts with it.
+Only these candidates are read from the repository, and checked against the
+complete terms like the other search sources of Trac do.
+"""
+
+import re
+
+from trac.core import *
+from trac.search import ISearchSource, shorten_result
+from trac.util.text import shorten_line
+from trac.versioncontrol import RepositoryManager
+from trac.versioncontrol.web_ui.changeset import ChangesetModule
+
+# Words are stored lower case, and cut to the size of the token column
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 64
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the set of words of `text` that are indexed."""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return set(token[:MAX_TOKEN_LENGTH]
+               for token in _TOKEN_RE.findall(text.lower())
+               if len(token) >= MIN_TOKEN_LENGTH)
+
+
+def _commit_text(commit):
+    return '\n'.join((commit.message, commit.author, commit.committer))
+
+
+def commit_tokens(commit):
+    """Return the indexed words of the message, author and committer of a
+    dulwich commit.
+    """
+    return tokenize(_commit_text(commit))
+
+
+class DulwichSearchModule(Component):
+    """Search the messages, authors and committers of the changesets of the
+    cached dulwich repositories.
+    """
+
+    implements(ISearchSource)
+
+    # ISearchSource methods
+    def get_search_filters(self, req):
+        # The changeset module of Trac provides the same filter
+        if 'CHANGESET_VIEW' in req.perm and \
+                not self.env.is_component_enabled(ChangesetModule):
+            yield ('changeset', 'Changesets')
+
+    def get_search_results(self, req, terms, filters):
+        if 'changeset' not in filters:
+            return
+        lower_terms = [term.lower() for term in terms]
+        rm = RepositoryManager(self.env)
+        for repos in rm.get_real_repositories():
+            if getattr(repos, 'cache', None) is None or \
+                    not hasattr(repos, 'dulwichrepo'):
+                continue
+            for sha in repos.cache.search_commits(terms):
+                if sha not in repos.dulwichrepo:
+                    # the commit was removed from the repository
+                    continue
+                resource = repos.resource.child('changeset', sha)
+                if 'CHANGESET_VIEW' not in req.perm(resource):
+                    continue
+                text = _commit_text(repos.dulwichrepo[sha])
+                text = text.decode('utf-8', 'replace').lower()
+                if not all(term in text for term in lower_terms):
+                    continue
+                changeset = repos.get_changeset(sha)
+                yield (req.href.changeset(sha, repos.reponame or None),
+                       '[%s]: %s' % (repos.display_rev(sha),
+                                     shorten_line(changeset.message)),
+                       changeset.date, changeset.author,
+                       shorten_result(changeset.message, terms))
@@ -0,0 +1,247 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Sorted index of the object names of a repository, for abbreviated shas.
+
+The names of all packed objects are merged from the pack indexes into one
+sorted file of binary shas, which is memory mapped and searched by
+bisection. The file records the pack indexes it was built from and is
+rebuilt when they change, e.g. after a `git gc` or a push. Loose objects are
+not part of the file; as in git, only the directory of the first two hex
+digits of a prefix is listed.
+"""
+
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import threading
+
+from dulwich.pack import load_pack_index
+
+from commitgraph import index_path
+
+SHA_INDEX_FILE = 'sha-index'
+
+# The shortest abbreviation that is accepted and produced
+MIN_ABBREV = 4
+DEFAULT_ABBREV = 7
+
+_MAGIC = 'TDSI'
+_VERSION = 1
+# magic, version, number of shas, digest of the pack index names
+_HEADER = struct.Struct('<4sII20s')
+
+
+def _pack_indexes(object_store):
+    pack_dir = os.path.join(object_store.path, 'pack')
+    try:
+        names = os.listdir(pack_dir)
+    except OSError:
+        return []
+    return sorted(os.path.join(pack_dir, name) for name in names
+                  if name.startswith('pack-') and name.endswith('.idx'))
+
+
+def _digest(paths):
+    return hashlib.sha1('\n'.join(os.path.basename(path)
+                                  for path in paths)).digest()
+
+
+class _Shas(object):
+    """Sequence view over the binary shas of the index data, for bisect."""
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = _HEADER.size + index * 20
+        return self.data[start:start + 20]
+
+
+class ShaIndex(object):
+    """Sorted names of the packed objects of a repository, together with
+    the loose objects of the object store.
+    """
+
+    def __init__(self, objects_path, data, count):
+        self.objects_path = objects_path
+        self.shas = _Shas(data, count)
+
+    def __len__(self):
+        return len(self.shas)
+
+    def _loose(self, prefix):
+        """Return the hex shas of the loose objects that start with the hex
+        `prefix` of at least two digits.
+        """
+        directory = os.path.join(self.objects_path, prefix[:2])
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        return [prefix[:2] + name for name in names
+                if len(name) == 38 and name.startswith(prefix[2:])]
+
+    def _packed(self, prefix, limit):
+        """Return up to `limit` hex shas of packed objects that start with
+        the hex `prefix`.
+        """
+        lower = unhexlify(prefix[:len(prefix) & ~1])
+        if len(prefix) & 1:
+            lower += unhexlify(prefix[-1] + '0')
+        shas = self.shas
+        index = bisect_left(shas, lower)
+        result = []
+        while index < len(shas) and len(result) < limit:
+            sha = hexlify(shas[index])
+            if not sha.startswith(prefix):
+                break
+            result.append(sha)
+            index += 1
+        return result
+
+    def lookup(self, prefix, limit=2):
+        """Return the hex shas of the objects that start with the hex
+        `prefix`, at most `limit` of them when the prefix is not unique.
+        """
+        prefix = prefix.lower()
+        found = self._packed(prefix, limit)
+        for sha in self._loose(prefix):
+            if sha not in found:
+                found.append(sha)
+        return sorted(found)[:limit]
+
+    def shortest_abbreviation(self, sha, minimum=DEFAULT_ABBREV):
+        """Return the shortest prefix of the hex `sha` of at least `minimum`
+        digits that does not start the name of another object.
+        """
+        binsha = unhexlify(sha)
+        shas = self.shas
+        index = bisect_left(shas, binsha)
+        neighbours = []
+        if index > 0:
+            neighbours.append(hexlify(shas[index - 1]))
+        if index < len(shas) and shas[index] == binsha:
+            index += 1
+        if index < len(shas):
+            neighbours.append(hexlify(shas[index]))
+        neighbours.extend(name for name in self._loose(sha[:2])
+                          if name != sha)
+        length = minimum
+        for other in neighbours:
+            common = 0
+            while common < 40 and sha[common] == other[common]:
+                common += 1
+            length = max(length, common + 1)
+        return sha[:min(length, 40)]
+
+
+def _read(path, digest):
+    """Map the index file at `path`, if it was built from the pack indexes
+    with `digest`. Returns the data and the number of shas, or `None`.
+    """
+    try:
+        fp = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        header = fp.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            return None
+        magic, version, count, file_digest = _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION or file_digest != digest:
+            return None
+        if not count:
+            return header, 0
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) != _HEADER.size + count * 20:
+            data.close()
+            return None
+        return data, count
+    finally:
+        fp.close()
+
+
+def _build(paths, digest):
+    """Merge the names of the pack indexes at `paths` into index data."""
+    indexes = [load_pack_index(path) for path in paths]
+    try:
+        shas = []
+        last = None
+        for sha in heapq.merge(*[index._itersha() for index in indexes]):
+            # objects can be in more than one pack
+            if sha != last:
+                shas.append(sha)
+                last = sha
+    finally:
+        for index in indexes:
+            index.close()
+    return _HEADER.pack(_MAGIC, _VERSION, len(shas), digest) + ''.join(shas)
+
+
+def _write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fp = open(tmp_path, 'wb')
+    try:
+        fp.write(data)
+    finally:
+        fp.close()
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+_indexes = {} # {object store path: (digest, ShaIndex)}
+_indexes_lock = threading.Lock()
+
+
+def get_sha_index(dulwichrepo):
+    """Return the `ShaIndex` of `dulwichrepo`.
+
+    Indexes are shared by all repository objects of a process. The index
+    file is rebuilt, and the index reloaded, when the set of pack indexes
+    changes. When the file cannot be written, the index is kept in memory.
+    """
+    object_store = dulwichrepo.object_store
+    paths = _pack_indexes(object_store)
+    digest = _digest(paths)
+    _indexes_lock.acquire()
+    try:
+        cached = _indexes.get(object_store.path)
+    finally:
+        _indexes_lock.release()
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+
+    path = index_path(dulwichrepo, SHA_INDEX_FILE)
+    result = _read(path, digest)
+    if result is None:
+        data = _build(paths, digest)
+        try:
+            _write(path, data)
+        except (IOError, OSError):
+            pass
+        result = _read(path, digest) or (data, (len(data) - _HEADER.size)
+                                               // 20)
+    index = ShaIndex(object_store.path, *result)
+    _indexes_lock.acquire()
+    try:
+        # a replaced index may still be in use, its map is closed when it is
+        # garbage collected
+        _indexes[object_store.path] = (digest, index)
+    finally:
+        _indexes_lock.release()
+    return index
@@ -0,0 +1,238 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+"""Counters and timers of the expensive operations of the connector.
+
+Every repository object (one per request) gets a `Stats` when the
+`[dulwich] instrumentation` option is enabled, and the shared `NULL_STATS`
+otherwise, whose methods do nothing. When the repository is closed, the
+statistics of the request are logged and added to the totals that
+`trac-admin <env> dulwich stats` reports.
+
+The totals are kept in the db directory of the Trac environment. Every
+process buffers the statistics of its requests, and adds them to the file
+at most once per `FLUSH_INTERVAL`, and when it exits.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Seconds between two writes of the statistics buffered by a process
+FLUSH_INTERVAL = 60
+
+
+class Stats(object):
+    """Counters and cumulative timers of one request."""
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def format(self):
+        """Return the statistics as a single line."""
+        items = ['%s=%d' % item for item in sorted(self.counters.items())]
+        items.extend('%s=%.1fms' % (name, seconds * 1000)
+                     for name, seconds in sorted(self.timers.items()))
+        return ', '.join(items)
+
+
+class _NullStats(Stats):
+    """Statistics that are not collected."""
+
+    enabled = False
+
+    def count(self, name, n=1):
+        pass
+
+    def add_time(self, name, seconds):
+        pass
+
+
+NULL_STATS = _NullStats()
+
+
+class _TimedIterator(object):
+    """Iterates over `iterable`, counting the items and the time spent in
+    producing them.
+    """
+
+    def __init__(self, iterable, stats, counter, timer):
+        self._iterator = iter(iterable)
+        self._stats = stats
+        self._counter = counter
+        self._timer = timer
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            item = self._iterator.next()
+        finally:
+            self._stats.add_time(self._timer, time.time() - start)
+        self._stats.count(self._counter)
+        return item
+
+
+def instrument_repository(dulwichrepo, stats):
+    """Count the walkers created on `dulwichrepo`, and the commits they
+    produce and the time they take.
+    """
+    get_walker = dulwichrepo.get_walker
+
+    def instrumented_get_walker(*args, **kwargs):
+        return instrument_walker(get_walker(*args, **kwargs), stats)
+    dulwichrepo.get_walker = instrumented_get_walker
+
+
+def instrument_walker(walker, stats):
+    """Count `walker`, and the commits it produces and the time it takes."""
+    stats.count('walkers')
+    return _TimedIterator(walker, stats, 'commits walked', 'walk')
+
+
+def stats_path(env, repos_id):
+    """Return the path of the file with the totals of a repository."""
+    return os.path.join(env.path, 'db', 'dulwich-stats-%s.json' % repos_id)
+
+
+def _empty():
+    return {'requests': 0, 'counters': {}, 'timers': {}}
+
+
+def _add(totals, requests, counters, timers):
+    totals['requests'] += requests
+    for name, value in counters.iteritems():
+        totals['counters'][name] = totals['counters'].get(name, 0) + value
+    for name, value in timers.iteritems():
+        totals['timers'][name] = totals['timers'].get(name, 0.0) + value
+
+
+# The functions that write the totals are also called at exit, when the
+# globals of the module can already be gone. They get what they use as
+# default arguments.
+
+def _read(fd, _os=os, _json=json, _empty=_empty):
+    totals = _empty()
+    chunks = []
+    while True:
+        chunk = _os.read(fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    try:
+        totals.update(_json.loads(''.join(chunks)))
+    except ValueError:
+        pass # empty or damaged, start over
+    return totals
+
+
+def _write(path, totals, log, _os=os, _json=json, _fcntl=fcntl,
+           _read=_read, _add=_add):
+    try:
+        directory = _os.path.dirname(path)
+        if not _os.path.isdir(directory):
+            _os.makedirs(directory)
+        fd = _os.open(path, _os.O_RDWR | _os.O_CREAT, 0666)
+        try:
+            if _fcntl is not None:
+                _fcntl.flock(fd, _fcntl.LOCK_EX)
+            stored = _read(fd)
+            _add(stored, totals['requests'], totals['counters'],
+                 totals['timers'])
+            _os.lseek(fd, 0, _os.SEEK_SET)
+            _os.ftruncate(fd, 0)
+            _os.write(fd, _json.dumps(stored))
+        finally:
+            _os.close(fd)
+    except (IOError, OSError), e:
+        if log is not None:
+            log.warning("Dulwich statistics not saved to %s: %s", path, e)
+
+
+_pending = {} # {path: [buffered totals, time of the last write]}
+_pending_lock = threading.Lock()
+
+
+def save_stats(path, stats, log=None):
+    """Add `stats` to the totals stored at `path`.
+
+    The statistics are buffered, and written when the totals of the process
+    were last written more than `FLUSH_INTERVAL` seconds ago. Failures to
+    write are logged to `log`, and do not fail the request.
+    """
+    now = time.time()
+    _pending_lock.acquire()
+    try:
+        pending = _pending.get(path)
+        if pending is None:
+            pending = _pending[path] = [_empty(), now]
+        _add(pending[0], 1, stats.counters, stats.timers)
+        if now - pending[1] < FLUSH_INTERVAL:
+            return
+        totals = pending[0]
+        pending[:] = [_empty(), now]
+    finally:
+        _pending_lock.release()
+    _write(path, totals, log)
+
+
+def flush_stats(log=None, _pending=_pending, _pending_lock=_pending_lock,
+                _write=_write):
+    """Write the statistics buffered by the process."""
+    _pending_lock.acquire()
+    try:
+        pending = [(path, totals) for path, (totals, written)
+                   in _pending.iteritems() if totals['requests']]
+        _pending.clear()
+    finally:
+        _pending_lock.release()
+    for path, totals in pending:
+        _write(path, totals, log)
+
+atexit.register(flush_stats)
+
+
+def load_stats(path):
+    """Return the totals stored at `path`, as a dictionary with the number
+    of `requests`, and the `counters` and `timers`.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return _empty()
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        return _read(fd)
+    finally:
+        os.close(fd)
+
+
+def reset_stats(path):
+    _pending_lock.acquire()
+    try:
+        _pending.pop(path, None)
+    finally:
+        _pending_lock.release()
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,27 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import unittest
+
+from trac_dulwich.tests import archive, cache, commitgraph, dulwich_fs, \
+                               objectcache, pathfilter, reachability, \
+                               search, stats
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(archive.suite())
+    suite.addTest(cache.suite())
+    suite.addTest(commitgraph.suite())
+    suite.addTest(dulwich_fs.suite())
+    suite.addTest(objectcache.suite())
+    suite.addTest(pathfilter.suite())
+    suite.addTest(reachability.suite())
+    suite.addTest(search.suite())
+    suite.addTest(stats.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
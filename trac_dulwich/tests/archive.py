@@ -0,0 +1,88 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import zipfile
+from StringIO import StringIO
+
+from dulwich.objects import Blob, Tree
+from dulwich.repo import Repo
+
+from trac_dulwich.archive import write_archive
+
+
+def _has_unzip():
+    try:
+        subprocess.call(['unzip', '-v'], stdout=open(os.devnull, 'w'))
+    except OSError:
+        return False
+    return True
+
+
+class ZipArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = Repo.init_bare(self.tmpdir).object_store
+        readme = Blob.from_string('Read me\n')
+        source = Blob.from_string('print "hello"\n' * 1000)
+        subdir = Tree()
+        subdir.add('hello.py', 0100644, source.id)
+        root = Tree()
+        root.add('README', 0100644, readme.id)
+        root.add('src', 0040000, subdir.id)
+        for obj in (readme, source, subdir, root):
+            self.store.add_object(obj)
+        self.tree_sha = root.id
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_zip(self):
+        path = os.path.join(self.tmpdir, 'archive.zip')
+        fileobj = open(path, 'wb')
+        try:
+            write_archive(fileobj, self.store, self.tree_sha, 'zip',
+                          'r-abc/', 1300000000)
+        finally:
+            fileobj.close()
+        return path
+
+    def test_zipfile(self):
+        archive = zipfile.ZipFile(self._write_zip())
+        try:
+            self.assertEqual(None, archive.testzip())
+            self.assertEqual(['r-abc/', 'r-abc/README', 'r-abc/src/',
+                              'r-abc/src/hello.py'],
+                             sorted(archive.namelist()))
+            for name in ('r-abc/', 'r-abc/src/'):
+                self.assertEqual(zipfile.ZIP_STORED,
+                                 archive.getinfo(name).compress_type)
+            self.assertEqual('Read me\n', archive.read('r-abc/README'))
+            self.assertEqual('print "hello"\n' * 1000,
+                             archive.read('r-abc/src/hello.py'))
+        finally:
+            archive.close()
+
+    @unittest.skipUnless(_has_unzip(), "unzip is not installed")
+    def test_unzip(self):
+        process = subprocess.Popen(['unzip', '-t', self._write_zip()],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode, output)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ZipArchiveTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
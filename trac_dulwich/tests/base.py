@@ -0,0 +1,87 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import shutil
+import stat
+import tempfile
+import unittest
+
+from trac.test import EnvironmentStub
+
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
+
+from trac_dulwich.api import TracDulwichSystem
+from trac_dulwich.dulwich_fs import DulwichRepository
+
+
+class GitRepositoryTestCase(unittest.TestCase):
+    """Creates a bare repository to add commits to."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = Repo.init_bare(self.tmpdir)
+        self.store = self.repo.object_store
+        self.time = 1300000000
+        self.env = EnvironmentStub(enable=['trac.*', 'trac_dulwich.*'])
+        TracDulwichSystem(self.env).environment_created()
+        self.repositories = []
+
+    def tearDown(self):
+        for repos in self.repositories:
+            repos.close()
+        shutil.rmtree(self.tmpdir)
+
+    def tree(self, files):
+        """Add the trees of `files`, a dictionary of paths to contents, and
+        return the sha of the root tree.
+        """
+        directories = {}
+        for path, content in files.iteritems():
+            name, _, rest = path.partition('/')
+            if rest:
+                directories.setdefault(name, {})[rest] = content
+        tree = Tree()
+        for name, subfiles in directories.iteritems():
+            tree.add(name, stat.S_IFDIR, self.tree(subfiles))
+        for path, content in files.iteritems():
+            if '/' not in path:
+                blob = Blob.from_string(content)
+                self.store.add_object(blob)
+                tree.add(path, 0100644, blob.id)
+        self.store.add_object(tree)
+        return tree.id
+
+    def commit(self, files, parents=(), message='Change'):
+        """Add a commit with the `files`, a dictionary of paths to contents,
+        and return its sha.
+        """
+        commit = Commit()
+        commit.tree = self.tree(files)
+        commit.parents = list(parents)
+        commit.author = commit.committer = 'Tester <tester@example.org>'
+        self.time += 60
+        commit.author_time = commit.commit_time = self.time
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = message
+        self.store.add_object(commit)
+        return commit.id
+
+    def history(self, changes, branch='master'):
+        """Commit `changes`, a list of dictionaries of files, one after
+        another on `branch`. Returns the shas of the commits.
+        """
+        shas = []
+        for files in changes:
+            shas.append(self.commit(files, shas[-1:]))
+        self.repo.refs['refs/heads/' + branch] = shas[-1]
+        return shas
+
+    def repository(self, cache=False, **kwargs):
+        """Return a `DulwichRepository` of the repository."""
+        repos = DulwichRepository(self.tmpdir, {'id': 1, 'name': ''},
+                                  self.env.log, cache, self.env, **kwargs)
+        self.repositories.append(repos)
+        return repos
@@ -0,0 +1,114 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import unittest
+
+from trac.versioncontrol.api import Changeset
+
+from trac_dulwich import db_default
+from trac_dulwich.cache import _commit_changes, _commit_objects, \
+                               _commit_paths, sync_repository
+from trac_dulwich.tests.base import GitRepositoryTestCase
+
+
+class CommitChangesTestCase(GitRepositoryTestCase):
+
+    def test_octopus_merge_delete(self):
+        # the merge deletes a file that one of its parents never had, which
+        # makes dulwich report `None` for the change against that parent
+        base = self.commit({'a': '1'})
+        first = self.commit({'a': '1', 'x': '2'}, [base])
+        second = self.commit({'a': '1', 'x': '3'}, [base])
+        merge = self.commit({'a': '1'}, [base, first, second])
+        commit = self.store[merge]
+        changes = list(_commit_changes(self.store, commit))
+        self.assertEqual(None, changes[0][0])
+        self.assertEqual([('x', Changeset.DELETE)],
+                         _commit_paths(self.store, commit, changes))
+        self.assertEqual([], list(_commit_objects(self.store, commit,
+                                                  changes)))
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class SyncTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        files = {}
+        parents = []
+        for i in xrange(60):
+            files['file%d' % (i % 7)] = 'content %d' % i
+            parents = [self.commit(files, parents, 'Change number %d' % i)]
+        self.repo.refs['refs/heads/master'] = parents[0]
+        self.repos = self.repository(cache=True)
+
+    def _clear(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        for table in db_default.tables:
+            cursor.execute("DELETE FROM %s" % table.name)
+        db.commit()
+
+    def _count(self, table):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        return cursor.fetchone()[0]
+
+    def _sync(self, progress=None):
+        return sync_repository(self.env, self.repos, batch_size=20,
+                               progress=progress)
+
+    def _tables(self):
+        return dict((table, self._count(table)) for table in
+                    ('dulwich_objects', 'dulwich_path_changes',
+                     'dulwich_timeline', 'dulwich_tokens'))
+
+    def test_resume_interrupted_sync(self):
+        self._sync()
+        expected = self._tables()
+        self._clear()
+
+        def interrupt(commit_count, object_count, start):
+            raise _Interrupted()
+        self.assertRaises(_Interrupted, self._sync, interrupt)
+        self.assertEqual(20, self._count('dulwich_timeline'))
+        self.assertEqual(0, self._count('dulwich_heads'))
+        self.assertEqual(60, self._sync()['commits'])
+        self.assertEqual(expected, self._tables())
+        self.assertEqual(0, self._sync()['commits'])
+
+    def test_resume_interrupted_timeline_fill(self):
+        self._sync()
+        expected = self._tables()
+        # the state of a fill of the timeline of an older cache that wrote
+        # the 20 newest commits below the synced head
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT sha FROM dulwich_timeline "
+                       "ORDER BY commit_time DESC")
+        shas = [row[0] for row in cursor]
+        for sha in shas[:1] + shas[21:]:
+            cursor.execute("DELETE FROM dulwich_tokens WHERE commit_id="
+                           "(SELECT id FROM dulwich_commits WHERE sha=%s)",
+                           (sha,))
+            cursor.execute("DELETE FROM dulwich_timeline WHERE sha=%s",
+                           (sha,))
+        db.commit()
+        self.assertEqual(20, self._count('dulwich_timeline'))
+        self.assertEqual(0, self._sync()['commits'])
+        self.assertEqual(expected, self._tables())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CommitChangesTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SyncTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,88 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import unittest
+
+from trac_dulwich.commitgraph import load_commit_graph, update_commit_graph
+from trac_dulwich.tests.base import GitRepositoryTestCase
+
+
+class CommitGraphTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        # master: m0 - m1 - m2 - merge
+        #                \         /
+        # feature:        f0 ----
+        self.master = self.history([{'a': '0'}, {'a': '1'}, {'a': '2'}])
+        # the clock of the author of f0 is an hour behind
+        self.time -= 3600
+        self.feature = self.commit({'a': '1', 'b': '0'}, self.master[1:2])
+        self.time += 3600
+        self.merge = self.commit({'a': '2', 'b': '0'},
+                                 [self.master[2], self.feature])
+        self.graph, added = update_commit_graph(self.repo, [self.merge])
+
+    def _ordinals(self, *shas):
+        return [self.graph.ordinal(sha) for sha in shas]
+
+    def test_parents_come_first(self):
+        self.assertEqual(5, len(self.graph))
+        for ordinal in xrange(len(self.graph)):
+            for parent in self.graph.parents(ordinal):
+                self.assertTrue(parent < ordinal)
+        m0, m1, m2, f0, merge = self._ordinals(*self.master +
+                                               [self.feature, self.merge])
+        self.assertEqual([m2, f0], list(self.graph.parents(merge)))
+        self.assertTrue(f0 > m1)
+        self.assertEqual(m0, self.graph.oldest())
+        self.assertEqual([1, 2, 3, 3, 4],
+                         [self.graph.generation(ordinal) for ordinal in
+                          (m0, m1, m2, f0, merge)])
+
+    def test_is_ancestor(self):
+        m0, m1, m2, f0, merge = self._ordinals(*self.master +
+                                               [self.feature, self.merge])
+        for ancestor in (m0, m1, m2, f0, merge):
+            self.assertTrue(self.graph.is_ancestor(ancestor, merge))
+        self.assertTrue(self.graph.is_ancestor(m1, f0))
+        self.assertTrue(self.graph.is_ancestor(f0, f0))
+        self.assertFalse(self.graph.is_ancestor(m2, f0))
+        self.assertFalse(self.graph.is_ancestor(f0, m2))
+        self.assertFalse(self.graph.is_ancestor(merge, m0))
+
+    def test_previous_and_next(self):
+        m0, m1, m2, f0, merge = self._ordinals(*self.master +
+                                               [self.feature, self.merge])
+        # the walk by date visits m2 before the older f0
+        self.assertEqual(m2, self.graph.previous(merge))
+        self.assertEqual(m1, self.graph.previous(f0))
+        self.assertEqual(None, self.graph.previous(m0))
+        self.assertEqual(f0, self.graph.next(m1, merge))
+        self.assertEqual(m2, self.graph.next(m1, m2))
+        self.assertEqual(None, self.graph.next(merge, merge))
+
+    def test_incremental_update(self):
+        ordinals = self._ordinals(*self.master + [self.feature, self.merge])
+        child = self.commit({'a': '3', 'b': '0'}, [self.merge])
+        graph, added = update_commit_graph(self.repo, [child, self.merge])
+        self.assertEqual(1, added)
+        self.assertEqual(ordinals, [graph.ordinal(sha) for sha in
+                                    self.master + [self.feature,
+                                                   self.merge]])
+        self.assertEqual(5, graph.ordinal(child))
+        loaded = load_commit_graph(self.repo)
+        self.assertEqual([graph.sha(ordinal) for ordinal in xrange(6)],
+                         [loaded.sha(ordinal) for ordinal in xrange(6)])
+        self.assertEqual(None, loaded.ordinal('0' * 40))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CommitGraphTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
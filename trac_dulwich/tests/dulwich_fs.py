@@ -0,0 +1,218 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import hashlib
+import unittest
+
+from dulwich.objects import Blob
+
+from trac.perm import PermissionCache
+from trac.util.datefmt import to_datetime, utc
+from trac.versioncontrol.api import NoSuchChangeset
+
+from trac_dulwich import dulwich_fs
+from trac_dulwich.cache import sync_repository
+from trac_dulwich.dulwich_fs import MAX_CANDIDATES
+from trac_dulwich.tests.base import GitRepositoryTestCase
+
+
+_blobs = {} # {prefix: [contents, ...]}
+
+
+def _blobs_with_prefix(prefix, count):
+    """Return the contents of `count` blobs whose shas start with the hex
+    `prefix`.
+    """
+    found = _blobs.setdefault(prefix, [])
+    i = len(found) and int(found[-1]) + 1 or 0
+    while len(found) < count:
+        data = str(i)
+        if hashlib.sha1('blob %d\0%s' % (len(data), data)).hexdigest() \
+                .startswith(prefix):
+            found.append(data)
+        i += 1
+    return found[:count]
+
+
+class ResolveRevTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        self.shas = self.history([{'README': 'one'}, {'README': 'two'}])
+        self.repo.refs['refs/tags/v1'] = self.shas[0]
+
+    def _add_blobs(self, prefix, count):
+        """Add `count` blobs whose shas start with `prefix`."""
+        for data in _blobs_with_prefix(prefix, count):
+            self.store.add_object(Blob.from_string(data))
+
+    def test_full_sha_and_refs(self):
+        repos = self.repository()
+        self.assertEqual(self.shas[1], repos.normalize_rev(self.shas[1]))
+        self.assertEqual(self.shas[1], repos.normalize_rev('master'))
+        self.assertEqual(self.shas[0], repos.normalize_rev('v1'))
+        self.assertEqual(self.shas[0], repos.normalize_rev('refs/tags/v1'))
+        self.assertEqual(self.shas[1], repos.normalize_rev(None))
+
+    def test_abbreviated_sha(self):
+        repos = self.repository()
+        self.assertEqual(self.shas[0], repos.normalize_rev(self.shas[0][:7]))
+        self.assertEqual(self.shas[0],
+                         repos.normalize_rev(self.shas[0][:5].upper()))
+        self.assertRaises(NoSuchChangeset, repos.normalize_rev,
+                          self.shas[0][:3])
+
+    def test_prefix_of_one_commit_and_other_objects(self):
+        prefix = self.shas[0][:4]
+        self._add_blobs(prefix, MAX_CANDIDATES - 1)
+        repos = self.repository()
+        self.assertEqual(self.shas[0], repos.normalize_rev(prefix))
+
+    def test_prefix_of_too_many_objects(self):
+        # the commit can be among the objects that are not checked, so the
+        # prefix is ambiguous
+        prefix = self.shas[0][:4]
+        self._add_blobs(prefix, MAX_CANDIDATES)
+        repos = self.repository()
+        self.assertRaises(NoSuchChangeset, repos.normalize_rev, prefix)
+
+    def test_short_rev(self):
+        repos = self.repository()
+        self.assertEqual(self.shas[0][:7], repos.short_rev(self.shas[0]))
+
+
+class LastChangeTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        # the third commit reverts src/sub to its tree of the first
+        self.shas = self.history([
+            {'README': '1', 'src/sub/a': '1'},
+            {'README': '1', 'src/sub/a': '2'},
+            {'README': '1', 'src/sub/a': '1'},
+            {'README': '2', 'src/sub/a': '1'}])
+
+    def _test_reverted_directory(self, repos):
+        node = repos.get_node('/src/sub', self.shas[3])
+        self.assertEqual(self.shas[2], node.created_rev)
+        self.assertEqual(self.shas[1], node.get_previous_change())
+        self.assertEqual([self.shas[2], self.shas[1], self.shas[0]],
+                         [rev for path, rev, change in node.get_history()])
+
+    def test_reverted_directory(self):
+        self._test_reverted_directory(self.repository())
+
+    def test_reverted_directory_cached(self):
+        repos = self.repository(cache=True)
+        sync_repository(self.env, repos)
+        self._test_reverted_directory(repos)
+
+
+class LazyNodeTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        self.shas = self.history([
+            {'README': '1', 'src/a': '1', 'src/b': '1'},
+            {'README': '2', 'src/a': '1', 'src/b': '1'},
+            {'README': '2', 'src/a': '2', 'src/b': '1'}])
+
+    def test_permission_checks_do_not_resolve(self):
+        repos = self.repository()
+        entries = list(repos.get_node('/src', self.shas[2]).get_entries())
+        perm = PermissionCache(self.env, 'anonymous')
+        for entry in entries:
+            self.assertEqual(self.shas[2], entry.resource.version)
+            entry.can_view(perm)
+            self.assertEqual(None, entry._created_rev)
+        self.assertEqual([self.shas[2], self.shas[0]],
+                         [entry.rev for entry in entries])
+
+    def test_entries_resolved_at_once(self):
+        repos = self.repository()
+        entries = dict((entry.name, entry) for entry in
+                       repos.get_node('/', self.shas[2]).get_entries())
+        self.assertEqual(self.shas[1], entries['README'].rev)
+        # the first entry resolved the last changes of all entries
+        self.assertEqual({'README': self.shas[1], 'src': self.shas[2]},
+                         entries['src']._last_changes._changes)
+        self.assertEqual(self.shas[2], entries['src'].rev)
+
+
+class TimelineTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        self.shas = self.history([{'README': str(i)} for i in xrange(5)])
+
+    def _revs(self, repos, start=0):
+        return [changeset.rev for changeset in
+                repos.get_changesets(to_datetime(start, utc),
+                                     to_datetime(self.time + 1, utc))]
+
+    def test_not_synchronized(self):
+        repos = self.repository(cache=True)
+        self.assertEqual(self.shas[::-1], self._revs(repos))
+
+    def test_synchronized(self):
+        sync_repository(self.env, self.repository(cache=True))
+        repos = self.repository(cache=True)
+        self.assertEqual(self.shas[::-1], self._revs(repos))
+        self.assertEqual(self.shas[:2:-1], self._revs(repos, self.time - 60))
+
+    def test_commits_since_synchronization(self):
+        sync_repository(self.env, self.repository(cache=True))
+        new = self.commit({'README': 'new'}, self.shas[-1:])
+        self.repo.refs['refs/heads/master'] = new
+        repos = self.repository(cache=True)
+        self.assertEqual([new] + self.shas[::-1], self._revs(repos))
+
+
+class AnnotateTestCase(GitRepositoryTestCase):
+
+    renames = {'rename_threshold': 50, 'max_pairs': 100,
+               'find_copies_harder': False}
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        self.shas = self.history([{'old.txt': 'one\ntwo\nthree\n'},
+                                  {'new.txt': 'one\ntwo\nthree\nfour\n'}])
+
+    def _annotate(self, repos):
+        return repos.get_node('new.txt', self.shas[1]).get_annotations()
+
+    def test_follows_renames(self):
+        repos = self.repository(rename_detection=self.renames)
+        self.assertEqual([self.shas[0]] * 3 + [self.shas[1]],
+                         self._annotate(repos))
+
+    def test_without_renames(self):
+        repos = self.repository()
+        self.assertEqual([self.shas[1]] * 4, self._annotate(repos))
+
+    def test_keyed_by_rename_detection(self):
+        for cache in (False, True):
+            dulwich_fs._annotations.clear()
+            plain = self.repository(cache=cache)
+            self.assertEqual([self.shas[1]] * 4, self._annotate(plain))
+            renames = self.repository(cache=cache,
+                                      rename_detection=self.renames)
+            self.assertEqual([self.shas[0]] * 3 + [self.shas[1]],
+                             self._annotate(renames))
+            dulwich_fs._annotations.clear()
+            self.assertEqual([self.shas[1]] * 4, self._annotate(plain))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ResolveRevTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(LastChangeTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(LazyNodeTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(TimelineTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(AnnotateTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,83 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import unittest
+
+from trac_dulwich.objectcache import CachingObjectStore, LRUObjectCache, \
+                                     open_repository
+from trac_dulwich.tests.base import GitRepositoryTestCase
+
+
+class LRUObjectCacheTestCase(unittest.TestCase):
+
+    def test_get_and_put(self):
+        cache = LRUObjectCache(100)
+        self.assertEqual(None, cache.get('a'))
+        cache.put('a', 1, 10)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('a', 2, 20)
+        self.assertEqual(2, cache.get('a'))
+        self.assertEqual((1, 20, 2, 1), (len(cache), cache.size, cache.hits,
+                                         cache.misses))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUObjectCache(100)
+        for key in 'abcd':
+            cache.put(key, key, 30)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual('b', cache.get('b'))
+        cache.put('e', 'e', 30)
+        # `c` was used less recently than `b`
+        self.assertEqual(None, cache.get('c'))
+        self.assertEqual(['b', 'd', 'e'],
+                         [key for key in 'bcde' if cache.get(key)])
+        self.assertEqual((90, 2), (cache.size, cache.evictions))
+
+    def test_too_large(self):
+        cache = LRUObjectCache(100)
+        cache.put('a', 'a', 60)
+        cache.put('b', 'b', 101)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual('a', cache.get('a'))
+
+    def test_resize_and_clear(self):
+        cache = LRUObjectCache(100)
+        for key in 'abc':
+            cache.put(key, key, 30)
+        cache.resize(50)
+        self.assertEqual((1, 30), (len(cache), cache.size))
+        self.assertEqual('c', cache.get('c'))
+        cache.clear()
+        self.assertEqual((0, 0), (len(cache), cache.size))
+        self.assertEqual(None, cache.get('c'))
+
+
+class CachingObjectStoreTestCase(GitRepositoryTestCase):
+
+    def test_caches_commits_and_trees(self):
+        sha = self.commit({'README': 'text'})
+        cache = LRUObjectCache(1024 * 1024)
+        repo = open_repository(self.tmpdir, cache)
+        self.assertTrue(isinstance(repo.object_store, CachingObjectStore))
+        commit = repo[sha]
+        self.assertTrue(repo[sha] is commit)
+        self.assertTrue(repo[commit.tree] is repo[commit.tree])
+        blob_sha = repo[commit.tree]['README'][1]
+        self.assertEqual('text', repo[blob_sha].data)
+        # a commit and a tree
+        self.assertEqual(2, len(cache))
+        # the thread keeps its object store
+        self.assertTrue(open_repository(self.tmpdir, cache).object_store
+                        is repo.object_store)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LRUObjectCacheTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CachingObjectStoreTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
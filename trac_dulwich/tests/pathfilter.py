@@ -0,0 +1,98 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import unittest
+
+from trac_dulwich import pathfilter
+from trac_dulwich.commitgraph import update_commit_graph
+from trac_dulwich.pathfilter import PathFilteredWalker, load_path_filters, \
+                                    update_path_filters
+from trac_dulwich.stats import Stats
+from trac_dulwich.tests.base import GitRepositoryTestCase
+
+
+class PathFiltersTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        files = {'README': '0', 'src/a': '0', 'src/b': '0', 'doc/c': '0'}
+        changes = [dict(files)]
+        for i in xrange(1, 30):
+            files = dict(files)
+            files[('README', 'src/a', 'src/b', 'doc/c')[i % 4]] = str(i)
+            changes.append(files)
+        changes.append(dict(files))
+        self.shas = self.history(changes)
+
+    def _update(self):
+        graph, added = update_commit_graph(self.repo, [self.shas[-1]])
+        filters, added = update_path_filters(self.repo, graph)
+        return graph, filters, added
+
+    def test_changed_paths(self):
+        graph, filters, added = self._update()
+        self.assertEqual(len(self.shas), added)
+        first = graph.ordinal(self.shas[0])
+        for path in ('README', 'src', 'src/a', 'src/b', 'doc', 'doc/c', ''):
+            self.assertTrue(filters.may_have_changed(first, [path]))
+        changed = graph.ordinal(self.shas[1])
+        for path in ('src', 'src/a', ''):
+            self.assertTrue(filters.may_have_changed(changed, [path]))
+        # the commit that changes nothing has an empty filter
+        self.assertFalse(filters.may_have_changed(
+            graph.ordinal(self.shas[-1]), ['README', 'src', 'doc/c']))
+
+    def test_too_many_paths(self):
+        max_changed_paths = pathfilter.MAX_CHANGED_PATHS
+        pathfilter.MAX_CHANGED_PATHS = 3
+        try:
+            graph, filters, added = self._update()
+        finally:
+            pathfilter.MAX_CHANGED_PATHS = max_changed_paths
+        first = graph.ordinal(self.shas[0])
+        self.assertTrue(filters.may_have_changed(first, ['missing']))
+
+    def test_walk(self):
+        graph, filters, added = self._update()
+        for path in ('README', 'src', 'src/b', 'doc/c', 'missing'):
+            expected = [entry.commit.id for entry in
+                        self.repo.get_walker(paths=[path])]
+            stats = Stats()
+            walker = PathFilteredWalker(self.store, [self.shas[-1]], filters,
+                                        graph, stats, paths=[path])
+            self.assertEqual(expected,
+                             [entry.commit.id for entry in walker])
+            self.assertTrue(stats.counters['commits filtered'] > 0)
+
+    def test_incremental_update(self):
+        self._update()
+        self.shas.append(self.commit({'README': 'new'}, self.shas[-1:]))
+        self.repo.refs['refs/heads/master'] = self.shas[-1]
+        graph, filters, added = self._update()
+        self.assertEqual(1, added)
+        self.assertEqual(len(self.shas), len(filters))
+        self.assertTrue(filters.may_have_changed(
+            graph.ordinal(self.shas[-1]), ['README']))
+        self.assertEqual(len(self.shas),
+                         len(load_path_filters(self.repo, graph)))
+
+    def test_commits_without_filter(self):
+        graph, filters, added = self._update()
+        self.shas.append(self.commit({'README': 'new'}, self.shas[-1:]))
+        graph, added = update_commit_graph(self.repo, [self.shas[-1]])
+        filters = load_path_filters(self.repo, graph)
+        self.assertEqual(len(self.shas) - 1, len(filters))
+        # commits added to the graph after the filters are always compared
+        self.assertTrue(filters.may_have_changed(
+            graph.ordinal(self.shas[-1]), ['missing']))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PathFiltersTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
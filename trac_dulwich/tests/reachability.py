@@ -0,0 +1,102 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import unittest
+
+from dulwich.objects import Tag
+
+from trac_dulwich.commitgraph import update_commit_graph
+from trac_dulwich.reachability import iter_ordinals, update_reachability
+from trac_dulwich.tests.base import GitRepositoryTestCase
+
+
+class ContainingRefsTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        # master: m0 - m1 - m2 - merge
+        #                \         /
+        # feature:        f0 ----
+        self.master = self.history([{'a': '0'}, {'a': '1'}, {'a': '2'}])
+        self.feature = self.commit({'a': '1', 'b': '0'}, self.master[1:2])
+        self.merge = self.commit({'a': '2', 'b': '0'},
+                                 [self.master[2], self.feature])
+        self.repo.refs['refs/heads/master'] = self.merge
+        self.repo.refs['refs/heads/feature'] = self.feature
+        self.repo.refs['refs/heads/old'] = self.master[0]
+        tag = Tag()
+        tag.name = 'v1'
+        tag.object = (self.store[self.master[1]].__class__, self.master[1])
+        tag.tagger = 'Tester <tester@example.org>'
+        tag.tag_time = self.time
+        tag.tag_timezone = 0
+        tag.message = 'Release'
+        self.store.add_object(tag)
+        self.repo.refs['refs/tags/v1'] = tag.id
+
+    def _index(self):
+        repos = self.repository()
+        snapshot = repos.ref_snapshot
+        graph, added = update_commit_graph(repos.dulwichrepo,
+                                           snapshot.get_heads())
+        index, computed = update_reachability(repos.dulwichrepo, graph,
+                                              snapshot.refs)
+        return graph, index, computed
+
+    def test_without_index(self):
+        self.assertEqual([], self.repository().get_containing_refs(
+                                 self.master[0]))
+
+    def test_containing_refs(self):
+        self._index()
+        repos = self.repository()
+        self.assertEqual(['refs/heads/feature', 'refs/heads/master',
+                          'refs/heads/old', 'refs/tags/v1'],
+                         repos.get_containing_refs(self.master[0]))
+        self.assertEqual(['refs/heads/feature', 'refs/heads/master',
+                          'refs/tags/v1'],
+                         repos.get_containing_refs(self.master[1]))
+        self.assertEqual(['refs/heads/feature', 'refs/heads/master'],
+                         repos.get_containing_refs(self.feature))
+        self.assertEqual(['refs/heads/master'],
+                         repos.get_containing_refs(self.merge))
+
+    def test_moved_ref_is_left_out(self):
+        self._index()
+        self.repo.refs['refs/heads/old'] = self.master[2]
+        repos = self.repository()
+        self.assertEqual(['refs/heads/feature', 'refs/heads/master',
+                          'refs/tags/v1'],
+                         repos.get_containing_refs(self.master[0]))
+
+    def test_incremental_update(self):
+        graph, index, computed = self._index()
+        self.assertEqual(4, computed)
+        self.repo.refs['refs/heads/old'] = self.master[2]
+        graph, index, computed = self._index()
+        self.assertEqual(1, computed)
+        ordinals = set(iter_ordinals(index.bitmap(graph.ordinal(
+                                                   self.master[2]))))
+        self.assertEqual(set(graph.ordinal(sha) for sha in self.master),
+                         ordinals)
+
+    def test_missing_revs(self):
+        self._index()
+        repos = self.repository()
+        self.assertEqual([self.merge, self.master[2]],
+                         repos.get_missing_revs('master', 'feature'))
+        self.assertEqual([], repos.get_missing_revs('old', 'master'))
+        # without bitmaps for the revisions, the history is walked
+        self.assertEqual([self.merge, self.feature],
+                         repos.get_missing_revs(self.merge, self.master[2]))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ContainingRefsTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
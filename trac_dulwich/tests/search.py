@@ -0,0 +1,100 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import unittest
+
+from trac.perm import PermissionCache, PermissionSystem
+from trac.test import Mock
+from trac.versioncontrol import RepositoryManager
+from trac.web.href import Href
+
+from trac_dulwich.cache import sync_repository
+from trac_dulwich.search import MAX_TOKEN_LENGTH, DulwichSearchModule, \
+                                tokenize
+from trac_dulwich.tests.base import GitRepositoryTestCase
+
+
+class TokenizeTestCase(unittest.TestCase):
+
+    def test_words(self):
+        self.assertEqual(set(['fix', 'the', 'parser', 'tester', 'example',
+                              'org']),
+                         tokenize('Fix the parser, a\n'
+                                  'Tester <tester@example.org>'))
+
+    def test_unicode(self):
+        self.assertEqual(set([u'caf\xe9', u'na\xefve']),
+                         tokenize(u'Caf\xe9 na\xefve'.encode('utf-8')))
+
+    def test_long_words_are_cut(self):
+        self.assertEqual(set(['x' * MAX_TOKEN_LENGTH]),
+                         tokenize('x' * (MAX_TOKEN_LENGTH + 10)))
+
+
+class SearchTestCase(GitRepositoryTestCase):
+
+    def setUp(self):
+        GitRepositoryTestCase.setUp(self)
+        self.shas = [self.commit({'a': '1'}, message='Add the parser')]
+        self.shas.append(self.commit({'a': '2'}, self.shas,
+                                     'Fix a crash of the parser'))
+        self.shas.append(self.commit({'a': '3'}, self.shas[1:],
+                                     'Document the crash reporter'))
+        self.repo.refs['refs/heads/master'] = self.shas[-1]
+        self.env.config.set('repositories', '.dir', self.tmpdir)
+        self.env.config.set('repositories', '.type', 'dulwich')
+        self.env.config.set('dulwich', 'enable_cache', 'true')
+        self.env.config.set('trac', 'repository_sync_per_request', '')
+        self.rm = RepositoryManager(self.env)
+        self.repos = self.rm.get_repository('')
+        sync_repository(self.env, self.repos)
+
+    def tearDown(self):
+        self.rm.shutdown()
+        GitRepositoryTestCase.tearDown(self)
+
+    def _search(self, *terms):
+        return sorted(self.repos.cache.search_commits(terms))
+
+    def test_prefixes(self):
+        self.assertEqual(sorted(self.shas), self._search('the'))
+        self.assertEqual(sorted(self.shas[:2]), self._search('pars'))
+        self.assertEqual(sorted(self.shas[1:]), self._search('CRASH'))
+        self.assertEqual(sorted(self.shas), self._search('tester'))
+        self.assertEqual([], self._search('lexer'))
+
+    def test_every_word_matches(self):
+        self.assertEqual([self.shas[1]], self._search('crash parser'))
+        self.assertEqual([self.shas[1]], self._search('crash', 'pars'))
+
+    def test_no_indexed_words(self):
+        self.assertEqual([], self._search('a'))
+        self.assertEqual([], self._search())
+
+    def test_search_results(self):
+        PermissionSystem(self.env).grant_permission('anonymous',
+                                                    'CHANGESET_VIEW')
+        req = Mock(perm=PermissionCache(self.env, 'anonymous'),
+                   href=Href('/trac'))
+        results = DulwichSearchModule(self.env).get_search_results(
+            req, ['crash', 'pars'], ['changeset'])
+        self.assertEqual(['/trac/changeset/' + self.shas[1]],
+                         [result[0] for result in results])
+        # the candidates are checked against the complete terms
+        self.assertEqual(sorted(self.shas[1:]), self._search('the crash'))
+        results = DulwichSearchModule(self.env).get_search_results(
+            req, ['the crash'], ['changeset'])
+        self.assertEqual(['/trac/changeset/' + self.shas[2]],
+                         [result[0] for result in results])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TokenizeTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SearchTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
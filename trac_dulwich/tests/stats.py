@@ -0,0 +1,70 @@
+#
+# Copyright 2010-2012 Niels Sascha Reedijk, niels.reedijk@gmail.com
+# All rights reserved. Distributed under the terms of the MIT License.
+#
+
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from trac_dulwich.stats import Stats, flush_stats, load_stats, \
+                               reset_stats, save_stats
+
+
+class SaveStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'db', 'stats.json')
+        self.stats = Stats()
+        self.stats.count('walkers', 2)
+        self.stats.add_time('walk', 0.5)
+
+    def tearDown(self):
+        reset_stats(self.path)
+        shutil.rmtree(self.tmpdir)
+
+    def test_buffered(self):
+        save_stats(self.path, self.stats)
+        save_stats(self.path, self.stats)
+        self.assertFalse(os.path.exists(self.path))
+        flush_stats()
+        totals = load_stats(self.path)
+        self.assertEqual(2, totals['requests'])
+        self.assertEqual({'walkers': 4}, totals['counters'])
+        self.assertEqual({'walk': 1.0}, totals['timers'])
+
+    def test_flush_without_module_globals(self):
+        # at exit the globals of the module can already be cleared
+        save_stats(self.path, self.stats)
+        flush = types.FunctionType(flush_stats.func_code,
+                                   {'__builtins__': __builtins__},
+                                   'flush_stats', flush_stats.func_defaults)
+        flush()
+        self.assertEqual(1, load_stats(self.path)['requests'])
+
+    def test_unwritable(self):
+        path = os.path.join(self.tmpdir, 'file')
+        open(path, 'w').close()
+        save_stats(os.path.join(path, 'stats.json'), self.stats)
+        flush_stats()
+        self.assertEqual(0, load_stats(path + '/stats.json')['requests'])
+
+    def test_reset(self):
+        save_stats(self.path, self.stats)
+        flush_stats()
+        save_stats(self.path, self.stats)
+        reset_stats(self.path)
+        flush_stats()
+        self.assertEqual(0, load_stats(self.path)['requests'])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SaveStatsTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')